@@ -1,6 +1,6 @@
 import argparse, os
 parser = argparse.ArgumentParser()
-parser.add_argument("astinfo")
+parser.add_argument("astinfo", help="Orbit file (.npy), or a glob or @file listing several of them to extract many objects in one pass")
 parser.add_argument("ifiles", nargs="+") 
 parser.add_argument("odir")
 parser.add_argument("-N", "--name",  type=str,   default=None)
@@ -10,6 +10,7 @@ parser.add_argument("-t", "--tol",   type=float, default=0.0)
 parser.add_argument("-l", "--lknee", type=float, default=1500)
 parser.add_argument("-a", "--alpha", type=float, default=3.5)
 parser.add_argument("-b", "--beam",  type=float, default=0)
+parser.add_argument("-i", "--index", type=str,   default=None, help="File to store the index of map boxes and time ranges in. Reused and extended between runs")
 parser.add_argument("-v", "--verbose", default=1, action="count")
 parser.add_argument("-e", "--quiet",   default=0, action="count")
 args = parser.parse_args()
@@ -23,15 +24,21 @@ import matplotlib.pyplot as plt
 def in_box(box, point): #checks if points are inside box or not
 	box   = np.asarray(box)
 	point = np.asarray(point)
-	point[1] = utils.rewind(point[1], box[0,1])
+	ra    = utils.rewind(point[1], box[...,0,1])
 	# This assumes reverse RA axis in box
-	return point[0] > box[0,0] and point[0] < box[1,0] and point[1] > box[1,1] and point[1] < box[0,1]
+	return (point[0] > box[...,0,0]) & (point[0] < box[...,1,0]) & (ra > box[...,1,1]) & (ra < box[...,0,1])
 
 def make_box(point, rad): #making box
 	box     = np.array([point - rad, point + rad])
 	box[:,1]= box[::-1,1] # reverse ra
 	return box
 
+def union_box(boxes):
+	"""Bounding box of a list of boxes made by make_box, which must
+	already have consistent RA wrapping"""
+	boxes = np.asarray(boxes)
+	return np.array([[np.min(boxes[:,0,0]),np.max(boxes[:,0,1])],[np.max(boxes[:,1,0]),np.min(boxes[:,1,1])]])
+
 def filter_map(map, lknee=3000, alpha=-3, beam=0): #filtering map somehow (FFT)
 	fmap  = enmap.fft(map)
 	l     = np.maximum(0.5, map.modlmap())
@@ -78,6 +85,47 @@ def geocentric_to_site(pos, dist, site_pos, site_alt, ctime):
 	pos_rel  = utils.rect2ang(vec_rel)
 	return pos_rel, dist_rel
 
+def read_orbit(fname):
+	info  = np.load(fname).view(np.recarray)
+	return interpolate.interp1d(info.ctime, [utils.unwind(info.ra*utils.degree), info.dec*utils.degree, info.r, info.ang*utils.arcsec], kind=3)
+
+# The map index records the mean time, period and bounding box of each
+# depth-1 map, so that we don't need to open every info.hdf for every object.
+# It's a plain text file with one line per map:
+# ifile t period1 period2 dec1 ra1 dec2 ra2
+def read_map_index(fname):
+	index = {}
+	try:
+		with open(fname, "r") as ifile:
+			for line in ifile:
+				toks = line.split()
+				if len(toks) != 8 or line.startswith("#"): continue
+				index[toks[0]] = np.array([float(w) for w in toks[1:]])
+	except IOError: pass
+	return index
+
+def write_map_index(fname, index):
+	with open(fname, "w") as ofile:
+		for key in sorted(index):
+			ofile.write("%s %.0f %.3f %.3f %.8f %.8f %.8f %.8f\n" % ((key,)+tuple(index[key])))
+
+def update_map_index(index, ifiles, comm):
+	"""Add the maps in ifiles that aren't already in index to it"""
+	missing = [i for i, ifile in enumerate(ifiles) if ifile not in index]
+	myinds, mydata = [], []
+	for i in missing[comm.rank::comm.size]:
+		try: info = bunch.read(utils.replace(ifiles[i], "map.fits", "info.hdf"))
+		except (OSError, IOError, KeyError):
+			print("Error reading info for %s. Skipping" % ifiles[i])
+			continue
+		myinds.append(i)
+		mydata.append(np.concatenate([[info.t], info.period, np.asarray(info.box).reshape(-1)]))
+	inds = utils.allgatherv(np.array(myinds, int), comm)
+	data = utils.allgatherv(np.array(mydata, float).reshape(-1,7), comm)
+	for i, d in zip(inds, data):
+		index[ifiles[i]] = d
+	return index
+
 comm    = mpi.COMM_WORLD
 verbose = args.verbose - args.quiet
 
@@ -86,7 +134,6 @@ r_thumb = args.rad*utils.arcmin
 # ... and temporary radius to use before we know the true position
 r_full  = r_thumb + args.pad*utils.arcmin
 
-name     = args.name or utils.replace(os.path.basename(args.astinfo), ".npy", "").lower()
 lknee    = args.lknee
 alpha    = -args.alpha
 beam     = args.beam*utils.fwhm*utils.arcmin
@@ -97,65 +144,97 @@ time_sane = 3600*24
 
 # Expand any globs in the input file names
 ifiles  = sum([sorted(utils.glob(ifile)) for ifile in args.ifiles],[]) 
-# Read in and spline the orbit
-info    = np.load(args.astinfo).view(np.recarray)
-orbit   = interpolate.interp1d(info.ctime, [utils.unwind(info.ra*utils.degree), info.dec*utils.degree, info.r, info.ang*utils.arcsec], kind=3)
+# Read in and spline the orbits
+if args.astinfo.startswith("@"):
+	with open(args.astinfo[1:], "r") as afile:
+		astfiles = [line.strip() for line in afile if line.strip() and not line.startswith("#")]
+else: astfiles = sorted(utils.glob(args.astinfo))
+names   = [utils.replace(os.path.basename(astfile), ".npy", "").lower() for astfile in astfiles]
+if args.name and len(astfiles) == 1: names = [args.name]
+orbits  = [read_orbit(astfile) for astfile in astfiles]
 utils.mkdir(args.odir)
 
-for fi in range(comm.rank, len(ifiles), comm.size):
+# Get the time and bounding box of each map
+index = read_map_index(args.index) if args.index else {}
+index = update_map_index(index, ifiles, comm)
+if args.index and comm.rank == 0:
+	write_map_index(args.index, index)
+ifiles  = [ifile for ifile in ifiles if ifile in index]
+idata   = np.array([index[ifile] for ifile in ifiles]).reshape(-1,7)
+ctime0s = np.mean(idata[:,1:3],1)
+boxes   = idata[:,3:].reshape(-1,2,2)
+
+# Find which objects are inside each map, evaluating each orbit only once
+hits = [[] for ifile in ifiles]
+for oi, orbit in enumerate(orbits):
+	good = np.where((ctime0s >= orbit.x[0]) & (ctime0s <= orbit.x[-1]))[0]
+	if len(good) == 0: continue
+	pos0 = utils.rewind(orbit(ctime0s[good])[1::-1])
+	for fi in good[in_box(boxes[good], pos0)]:
+		hits[fi].append(oi)
+work = [fi for fi in range(len(ifiles)) if len(hits[fi]) > 0]
+if comm.rank == 0 and verbose >= 1:
+	print("%d objects in %d of %d maps" % (sum([len(hit) for hit in hits]), len(work), len(ifiles)))
+
+for wi in range(comm.rank, len(work), comm.size):
+	fi       = work[wi]
 	ifile    = ifiles[fi]
-	infofile = utils.replace(ifile, "map.fits", "info.hdf")
 	tfile    = utils.replace(ifile, "map.fits", "time.fits")
-	ofname   = "%s/%s_%s" % (args.odir, name, os.path.basename(ifile))
-	info     = bunch.read(infofile)
-	# Get the asteroid coordinates
-	ctime0   = np.mean(info.period)
-	adata0   = orbit(ctime0)
-	ast_pos0 = utils.rewind(adata0[1::-1])
-	message  = "%.0f  %8.3f %8.3f  %8.3f %8.3f %8.3f %8.3f" % (info.t, ast_pos0[1]/utils.degree, ast_pos0[0]/utils.degree, info.box[0,1]/utils.degree, info.box[1,1]/utils.degree, info.box[0,0]/utils.degree, info.box[1,0]/utils.degree)
-	# Check if we're in bounds
-	if not in_box(info.box, ast_pos0):
-		if verbose >= 3:
-			print(colors.lgray + message + " outside" + colors.reset)
-			continue
-	# Ok, should try to read in this map. Decide on bounding box to read in
-	full_box  = make_box(ast_pos0, r_full)
-	# Read it and check if we have enough hits in the area we want to use
+	t, box   = idata[fi,0], boxes[fi]
+	ctime0   = ctime0s[fi]
+	# Get the asteroid coordinates, with consistent wrapping for all of them
+	ast_pos0s = []
+	for oi in hits[fi]:
+		ast_pos0 = utils.rewind(orbits[oi](ctime0)[1::-1])
+		if len(ast_pos0s) > 0: ast_pos0[1] = utils.rewind(ast_pos0[1], ast_pos0s[0][1])
+		ast_pos0s.append(ast_pos0)
+	full_boxes = [make_box(ast_pos0, r_full) for ast_pos0 in ast_pos0s]
+	# Read the part of the map covering all our objects once
+	ubox = union_box(full_boxes)
 	try:
-		tmap = enmap.read_map(tfile, box=full_box)
-		tmap[tmap!=0] += info.t
+		tmap_all = enmap.read_map(tfile, box=ubox)
+		tmap_all[tmap_all!=0] += t
 	except (TypeError, FileNotFoundError):
 		print("Error reading %s. Skipping" % ifile)
 		continue
-	# Break out early if nothing is hit
-	if np.all(tmap == 0):
-		if verbose >= 2: 
-			print(colors.white + message + " unhit" + colors.reset)
+	imap_all = None
+	for oi, ast_pos0, full_box in zip(hits[fi], ast_pos0s, full_boxes):
+		orbit    = orbits[oi]
+		ofname   = "%s/%s_%s" % (args.odir, names[oi], os.path.basename(ifile))
+		message  = "%-12s %.0f  %8.3f %8.3f  %8.3f %8.3f %8.3f %8.3f" % (names[oi], t, ast_pos0[1]/utils.degree, ast_pos0[0]/utils.degree, box[0,1]/utils.degree, box[1,1]/utils.degree, box[0,0]/utils.degree, box[1,0]/utils.degree)
+		tmap     = tmap_all.submap(full_box)
+		# Break out early if nothing is hit
+		if np.all(tmap == 0):
+			if verbose >= 2: 
+				print(colors.white + message + " unhit" + colors.reset)
 			continue
-	# Figure out what time the asteroid was actually observed
-	ctime, err = calc_obs_ctime(orbit, tmap, ctime0)
-	if err > time_tol or abs(ctime-ctime0) > time_sane:
-		if verbose >= 2:
-			print(colors.white + message + " time" + colors.reset)
-		continue
-	# Now that we have the proper time, get the asteroids actual position
-	adata     = orbit(ctime)
-	ast_pos   = utils.rewind(adata[1::-1])
-	thumb_box = make_box(ast_pos, r_thumb)
-	# Read the actual data
-	try:
-		imap = enmap.read_map(ifile, box=full_box)
-	except (TypeError, FileNotFoundError):
-		print("Error reading %s. Skipping" % ifile)
-		continue
-	if np.mean(imap.submap(thumb_box) == 0) > args.tol:
-		if verbose >= 2:
-			print(colors.white + message + " unhit" + colors.reset)
+		# Figure out what time the asteroid was actually observed
+		ctime, err = calc_obs_ctime(orbit, tmap, ctime0)
+		if err > time_tol or abs(ctime-ctime0) > time_sane:
+			if verbose >= 2:
+				print(colors.white + message + " time" + colors.reset)
+			continue
+		# Now that we have the proper time, get the asteroids actual position
+		adata     = orbit(ctime)
+		ast_pos   = utils.rewind(adata[1::-1])
+		ast_pos[1]= utils.rewind(ast_pos[1], ast_pos0[1])
+		thumb_box = make_box(ast_pos, r_thumb)
+		# Read the actual data
+		if imap_all is None:
+			try:
+				imap_all = enmap.read_map(ifile, box=ubox)
+			except (TypeError, FileNotFoundError):
+				print("Error reading %s. Skipping" % ifile)
+				break
+		imap = imap_all.submap(full_box)
+		if np.mean(imap.submap(thumb_box) == 0) > args.tol:
+			if verbose >= 2:
+				print(colors.white + message + " unhit" + colors.reset)
 			continue
-	# Filter the map
-	wmap     = filter_map(imap, lknee=lknee, alpha=alpha, beam=beam)
-	# And reproject it
-	omap = reproject.thumbnails(wmap, ast_pos, r=r_thumb)
-	enmap.write_map(ofname, omap)
-	if verbose >= 1:
-		print(colors.lgreen + message + " ok" + colors.reset)
+		# Filter the map
+		wmap     = filter_map(imap, lknee=lknee, alpha=alpha, beam=beam)
+		# And reproject it
+		omap = reproject.thumbnails(wmap, ast_pos, r=r_thumb)
+		enmap.write_map(ofname, omap)
+		if verbose >= 1:
+			print(colors.lgreen + message + " ok" + colors.reset)
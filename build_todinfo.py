@@ -6,6 +6,8 @@ parser = config.ArgumentParser(os.environ["HOME"] + "/.enkirc")
 parser.add_argument("tagfile")
 parser.add_argument("sel", nargs="?", default="")
 parser.add_argument("ofile")
+parser.add_argument("-n", "--chunk", type=int, default=20, help="Number of tods each task processes between each reduction and checkpoint")
+parser.add_argument("--full", action="store_true", help="Recompute stats for all tods instead of reusing the ones in ofile and its checkpoint file")
 args = parser.parse_args()
 
 file_db = filedb.setup_filedb()
@@ -17,34 +19,142 @@ comm    = mpi.COMM_WORLD
 scan_db = scan_db.select(scan_db.query(args.sel, apply_default_query=False))
 ids     = scan_db.ids
 
-stats = []
-for ind in range(comm.rank, len(ids), comm.size):
-	id    = ids[ind]
-	entry = file_db[id]
-	try:
-		stats.append(todinfo.build_tod_stats(entry))
-	except (errors.DataMissing,AttributeError) as e:
-		print("%3d %4d/%d %5.1f%% Skipping %s (%s)" % (comm.rank, ind+1, len(ids), (ind+1)/float(len(ids))*100, id, str(e)))
-		continue
-	print("%3d %4d/%d %5.1f%% %s" % (comm.rank, ind+1, len(ids), (ind+1)/float(len(ids))*100, id))
-stats = todinfo.merge_tod_stats(stats)
-
-if comm.rank == 0: print("Reducing")
-comm.Barrier()
-for key in stats:
-	stats[key] = utils.allgatherv(stats[key],comm)
-
-# Sort by id and move id index last
-inds = np.argsort(stats["id"])
-for key in stats:
-	stats[key] = utils.moveaxis(stats[key][inds],0,-1)
-stat_db = todinfo.Todinfo(stats)
-# Merge with original tags. Rightmost overrides for overridable fields.
-# For tags, we get the union. This means that stat_db can't override incorrect
-# tags in scan_db, just add to them.
-stat_db = scan_db + stat_db
+def get_mtime(entry):
+	"""The modification time of the tod file of entry, used to decide
+	whether its stats need to be recomputed. 0 if it can't be determined."""
+	try: return os.path.getmtime(entry.tod)
+	except (AttributeError, TypeError, OSError): return 0.0
+
+def concat_stats(a, b):
+	if a is None: return b
+	if b is None: return a
+	return {key: np.concatenate([a[key],b[key]]) for key in b if key in a}
+
+def write_chunk(fname, stats):
+	"""Append the merged stats of one chunk as a new group in the checkpoint
+	file fname. The group is only marked complete once it has been fully
+	written, so an interrupted append is ignored when reading."""
+	with h5py.File(fname, "a") as hfile:
+		group = hfile.create_group("%06d" % len(hfile))
+		for key in stats:
+			val = np.asarray(stats[key])
+			if val.dtype.kind == "U":
+				group[key] = np.char.encode(val)
+				group[key].attrs["unicode"] = True
+			else: group[key] = val
+		group.attrs["complete"] = True
+
+def read_chunks(fname):
+	"""Read the stats of the complete chunks in the checkpoint file fname,
+	with the id axis first. Returns None if there are none."""
+	if not os.path.isfile(fname): return None
+	res = None
+	with h5py.File(fname, "r") as hfile:
+		for name in sorted(hfile):
+			group = hfile[name]
+			if not group.attrs.get("complete", False): continue
+			stats = {}
+			for key in group:
+				stats[key] = group[key][()]
+				if group[key].attrs.get("unicode", False): stats[key] = np.char.decode(stats[key])
+			res = concat_stats(res, stats)
+	return res
+
+def read_old_stats(fname, cname):
+	"""Read the stat fields of a previous output file and of the chunks in
+	its checkpoint file, with the id axis first. Entries in the checkpoint file
+	override those in the output file. Returns None if neither has any stats,
+	or if the output file predates mtime tracking."""
+	if args.full: return None
+	old = None
+	if os.path.isfile(fname):
+		old_db = todinfo.read(fname)
+		if "mtime" in old_db.data:
+			# Tags and fields from the tag file are taken from scan_db, so only
+			# keep the fields that came from build_tod_stats
+			keys = [key for key in old_db.data if key == "id" or key not in scan_db.data]
+			old  = {key: utils.moveaxis(np.asarray(old_db.data[key]),-1,0) for key in keys}
+	old = concat_stats(old, read_chunks(cname))
+	if old is None: return None
+	# Keep the last entry for each id
+	inds = len(old["id"])-1-np.unique(old["id"][::-1], return_index=True)[1]
+	return {key: old[key][inds] for key in old}
+
+def build_db(old, new):
+	"""Sort the reused stats and the list of merged new chunk stats by id,
+	move the id index last and merge with the original tags. Rightmost overrides
+	for overridable fields. For tags, we get the union. This means that stat_db
+	can't override incorrect tags in scan_db, just add to them."""
+	stats = old
+	for chunk in new: stats = concat_stats(stats, chunk)
+	if stats is None: return scan_db
+	inds = np.argsort(stats["id"])
+	stats = {key: utils.moveaxis(stats[key][inds],0,-1) for key in stats}
+	return scan_db + todinfo.Todinfo(stats)
+
+def write_db(db, fname):
+	# Write to a temporary file first so an interrupted write doesn't
+	# destroy the previous checkpoint
+	base, ext = os.path.splitext(fname)
+	tname = base + ".tmp" + ext
+	db.write(tname)
+	os.rename(tname, fname)
+
+# Stats are checkpointed by appending each chunk to a side file, which is
+# merged into ofile at the end. Rewriting ofile for every chunk would make
+# the total checkpoint cost quadratic in the number of tods.
+cfile = os.path.splitext(args.ofile)[0] + "_ckpt.hdf"
+if comm.rank == 0 and args.full and os.path.isfile(cfile): os.remove(cfile)
+
+# Only the writer holds the stats. Everybody needs to know which
+# ids are up to date, though.
+old = read_old_stats(args.ofile, cfile) if comm.rank == 0 else None
+old_mtimes = comm.bcast(dict(zip(old["id"], old["mtime"])) if old is not None else {})
+
+# Find the tods that are new or have changed since the last run
+myinds = np.arange(comm.rank, len(ids), comm.size)
+mtimes = np.zeros(len(ids))
+mtimes[myinds] = [get_mtime(file_db[ids[ind]]) for ind in myinds]
+mtimes = utils.allreduce(mtimes, comm)
+todo   = [ind for ind, id in enumerate(ids) if id not in old_mtimes or mtimes[ind] == 0 or old_mtimes[id] != mtimes[ind]]
+if comm.rank == 0:
+	print("Reusing %d tods, computing %d" % (len(ids)-len(todo), len(todo)))
+	# Drop reused entries that are no longer in the selection or need to be recomputed
+	if old is not None:
+		keep = set(ids) - set([ids[ind] for ind in todo])
+		mask = np.array([id in keep for id in old["id"]], bool)
+		old  = {key: old[key][mask] for key in old}
+del old_mtimes
+
+# Process the tods in chunks. After each chunk the new stats are
+# sent to the writer, which appends them to the checkpoint file.
+new    = []
+csize  = args.chunk*comm.size
+for c1 in range(0, len(todo), csize):
+	stats = []
+	for i in range(c1+comm.rank, min(c1+csize, len(todo)), comm.size):
+		ind   = todo[i]
+		id    = ids[ind]
+		entry = file_db[id]
+		try:
+			stat = todinfo.build_tod_stats(entry)
+		except (errors.DataMissing,AttributeError) as e:
+			print("%3d %4d/%d %5.1f%% Skipping %s (%s)" % (comm.rank, i+1, len(todo), (i+1)/float(len(todo))*100, id, str(e)))
+			continue
+		stat["mtime"] = mtimes[ind]
+		stats.append(stat)
+		print("%3d %4d/%d %5.1f%% %s" % (comm.rank, i+1, len(todo), (i+1)/float(len(todo))*100, id))
+	stats = comm.gather(stats, root=0)
+	if comm.rank == 0:
+		stats = [stat for s in stats for stat in s]
+		if len(stats) == 0: continue
+		new.append(todinfo.merge_tod_stats(stats))
+		if c1+csize < len(todo):
+			print("Checkpointing %d new tods" % len(stats))
+			write_chunk(cfile, new[-1])
 
 if comm.rank == 0:
 	print("Writing")
-	stat_db.write(args.ofile)
+	write_db(build_db(old, new), args.ofile)
+	if os.path.isfile(cfile): os.remove(cfile)
 	print("Done")
@@ -1,6 +1,7 @@
-import numpy as np, argparse, glob, h5py, os, re, sys, shutil
+import numpy as np, argparse, glob, os, re, sys
 from enlib import utils, sampcut, flagrange, mpi
 from enact import files
+import flatdb
 parser = argparse.ArgumentParser()
 parser.add_argument("iglobs", nargs="+")
 parser.add_argument("ofile")
@@ -32,42 +33,63 @@ if len(dups) > 0:
 	sys.exit(1)
 
 nfile = len(ifiles)
-# Make tmp directory for output
-tmpdir  = args.ofile + ".tmp"
-tmpfmt  = tmpdir + "/cut%03d.hdf"
-utils.mkdir(tmpdir)
-
 permissive = args.mode == "permissive"
 
-# Process each of our blocks
-nplus, nminus = 0,0
-with h5py.File(tmpfmt % comm.rank, "w") as hfile:
-	for j, i in enumerate(range(comm.rank*nfile/comm.size, (comm.rank+1)*nfile/comm.size)):
-		ifile, id = ifiles[i], ids[i]
-		progress = min(comm.rank + j*comm.size, nfile-1)
-		dets, cuts, offset = files.read_cut(ifile, permissive=permissive)
-		#_, moo, _ = files.read_cut(ifile, permissive=not permissive)
-		#diff = (cuts.size-cuts.sum())-(moo.size-moo.sum())
-		#if diff > 0: nplus  += diff
-		#else:        nminus -= diff
-		#print "%5d/%d %5.1f%% %s %6dM %6dM %6dM" % (progress+1, nfile, 100.0*(progress+1)/nfile, id, diff/1e6, nplus/1e6, nminus/1e6)
-		print "%5d/%d %5.1f%% %s" % (progress+1, nfile, 100.0*(progress+1)/nfile, id)
-		flags= flagrange.from_sampcut(cuts, dets=dets, sample_offset=offset)
-		flags.write(hfile, group=id)
+# The output uses the flat layout described in flatdb, and can be read
+# with flatdb.read_cut
 
-# Then concatenate them into the final file
-comm.Barrier()
+# Read our block of files
+i1, i2 = comm.rank*nfile/comm.size, (comm.rank+1)*nfile/comm.size
+nsamps, offsets, dets, detmaps, ranges = [], [], [], [], []
+nrange = 0
+for j, i in enumerate(range(i1, i2)):
+	ifile, id = ifiles[i], ids[i]
+	progress = min(comm.rank + j*comm.size, nfile-1)
+	print "%5d/%d %5.1f%% %s" % (progress+1, nfile, 100.0*(progress+1)/nfile, id)
+	tdets, cuts, offset = files.read_cut(ifile, permissive=permissive)
+	flags = flagrange.from_sampcut(cuts, dets=tdets, sample_offset=offset)
+	nsamps.append(flags.nsamp)
+	offsets.append(flags.sample_offset)
+	dets.append(np.asarray(flags.dets))
+	detmaps.append(flags.detmap[:-1]+nrange)
+	ranges.append(np.asarray(flags.ranges).reshape(-1,2))
+	nrange += len(ranges[-1])
+ndet   = sum([len(d) for d in dets])
+ndets  = comm.allgather(ndet)
+nranges= comm.allgather(nrange)
+det0, range0 = sum(ndets[:comm.rank]), sum(nranges[:comm.rank])
+ndet_tot, nrange_tot = sum(ndets), sum(nranges)
+det_offsets = det0 + np.cumsum([0]+[len(d) for d in dets])[:-1]
+
+fields = {
+	"ids":           ((nfile,),         flatdb.id_dtype(ids)),
+	"nsamp":         ((nfile,),         int),
+	"sample_offset": ((nfile,),         int),
+	"det_offsets":   ((nfile+1,),       int),
+	"dets":          ((ndet_tot,),      int),
+	"detmap":        ((ndet_tot+1,),    int),
+	"ranges":        ((nrange_tot,2),   np.int32),
+}
+mydata = []
+if i2 > i1:
+	mydata += [
+		("nsamp",         slice(i1,i2),             np.array(nsamps)),
+		("sample_offset", slice(i1,i2),             np.array(offsets)),
+		("det_offsets",   slice(i1,i2),             det_offsets)]
+if ndet > 0:
+	mydata += [
+		("dets",          slice(det0,det0+ndet),    np.concatenate(dets)),
+		("detmap",        slice(det0,det0+ndet),    np.concatenate(detmaps)+range0)]
+if nrange > 0:
+	mydata += [
+		("ranges",        slice(range0,range0+nrange), np.concatenate(ranges))]
 if comm.rank == 0:
-	print "Reducing"
-	i = 0
-	with h5py.File(args.ofile, "w") as ohdf:
-		for rank in range(comm.size):
-			tmpfile = tmpfmt % rank
-			with h5py.File(tmpfile, "r") as ihdf:
-				for key in ihdf.keys():
-					ihdf.copy(key, ohdf)
-					print "%5d/%d %5.1f%% %s" % (i+1, nfile, 100.0*(i+1)/nfile, id)
-					i += 1
-	print "Done"
-	# Remove our tmp files
-	shutil.rmtree(tmpdir)
+	mydata += [
+		("ids",           slice(None),              ids.astype("S")),
+		("det_offsets",   slice(nfile,nfile+1),     [ndet_tot]),
+		("detmap",        slice(ndet_tot,ndet_tot+1), [nrange_tot])]
+
+if comm.rank == 0: print "Writing %s" % args.ofile
+flatdb.write_parallel(args.ofile, fields, mydata, comm)
+comm.Barrier()
+if comm.rank == 0: print "Done"
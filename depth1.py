@@ -2,6 +2,7 @@ import numpy as np, time, os
 from pixell import utils, enmap, mpi, bunch
 from enact import filedb, files, actscan, actdata
 from enlib import config, scanutils, log, coordinates, mapmaking, sampcut, cg, dmap, errors
+from scheduling import schedule_lpt
 
 config.default("dmap_format", "merged")
 config.default("map_bits", 32, "Bit-depth to use for maps and TOD")
@@ -103,17 +104,31 @@ def bounds_helper(t1, t2, az1, az2, el, sys, acenter, site):
 	opoints[1] = utils.unwind(opoints[1])
 	return opoints # [{dec,ra},:]
 
-def find_bounding_box(scandb, entrydb, sys="cel"):
+# The site and detector offsets are needed several times per group, by
+# find_bounding_box for the whole group and for each task's part of it, and
+# by find_scan_profile. Cache them so each tod's metadata is only read once.
+array_info_cache = {}
+def read_array_info(id, entrydb):
+	"""Return the site and detector pointing offsets for the given tod id, or
+	raise errors.DataMissing if the offsets can't be read"""
+	if id not in array_info_cache:
+		entry = entrydb[id]
+		try: array_info_cache[id] = (files.read_site(entry.site), actdata.read_point_offsets(entry).point_offset)
+		except errors.DataMissing as e: array_info_cache[id] = e
+	res = array_info_cache[id]
+	if isinstance(res, errors.DataMissing): raise res
+	return res
+
+def find_array_info(scandb, entrydb):
 	# all tods in group have same site. We also assume the same detector layout.
 	# We need to loop in case some tods are missing pointing, though
-	detpos = None
 	for id in scandb.ids:
-		entry    = entrydb[scandb.ids[0]]
-		site     = files.read_site(entry.site)
-		try: detpos = actdata.read_point_offsets(entry).point_offset
+		try: return read_array_info(id, entrydb)
 		except errors.DataMissing: continue
-		break
-	if detpos is None: raise errors.DataMissing("No pointing found")
+	raise errors.DataMissing("No pointing found")
+
+def find_bounding_box(scandb, entrydb, sys="cel"):
+	site, detpos = find_array_info(scandb, entrydb)
 	# Array center and radius in focalplane coordinates
 	acenter  = np.mean(detpos,0)
 	arad     = np.max(np.sum((detpos-acenter)**2,1)**0.5)
@@ -136,10 +151,7 @@ def find_bounding_box(scandb, entrydb, sys="cel"):
 
 def find_scan_profile(scandb, entrydb, sys="cel",npoint=100):
 	# This is a bit redundant with find_bounding_box...
-	# all tods in group have same site. We also assume the same detector layout
-	entry    = entrydb[scandb.ids[0]]
-	site     = files.read_site(entry.site)
-	detpos   = actdata.read_point_offsets(entry).point_offset
+	site, detpos = find_array_info(scandb, entrydb)
 	# Array center and radius in focalplane coordinates
 	acenter  = np.mean(detpos,0)
 	arad     = np.max(np.sum((detpos-acenter)**2,1)**0.5)
@@ -226,6 +238,12 @@ def build_maps(scans, shape, wcs, tref=0, dtype=np.float32, sys="cel", comm=None
 	ivar = signal_sky.precon.div[0,0]
 	return bunch.Bunch(map=map, ivar=ivar, tmap=tmap, signal=signal_sky)
 
+def split_by_cost(costs, n):
+	"""Split the sequence of items with the given costs into n consecutive
+	chunks with roughly equal total cost. Returns the chunk edges [n+1]"""
+	ccost = np.concatenate([[0],np.cumsum(costs)])
+	return np.searchsorted(ccost, np.arange(n+1)*ccost[-1]/n)
+
 def write_maps(prefix, data):
 	data.signal.write(prefix, "map",  data.map)
 	data.signal.write(prefix, "ivar", data.ivar)
@@ -259,12 +277,19 @@ narr        = len(arrays)
 apids       = pids*narr + aid
 # And loop over these
 gvals, order, edges = utils.find_equal_groups_fast(apids)
+# The cost of mapping each tod is roughly proportional to its duration
+tod_costs  = np.nan_to_num(db.data["dur"])
+tod_costs[tod_costs<=0] = np.mean(tod_costs[tod_costs>0]) if np.any(tod_costs>0) else 1
+group_costs= np.add.reduceat(tod_costs[order], edges[:-1]) if len(gvals) > 0 else np.zeros(0)
+my_groups  = schedule_lpt(group_costs, comm_inter.size)[comm_inter.rank]
 # Loop over each such group. We will map each group
-for gi in range(comm_inter.rank, len(gvals), comm_inter.size):
+for gi in my_groups:
 	apid     = gvals[gi]
 	pid, aid = np.divmod(apid, narr)
 	inds     = order[edges[gi]:edges[gi+1]]
 	ntod     = len(inds)
+	# We only need the cached metadata for the tods in the current group
+	array_info_cache.clear()
 	# Make a tag for this group we can use when printing progress
 	tag      = "%4d/%d" % (gi+1, len(gvals))
 	# Build our output prefix. Will use sub-directories to make things like ls faster
@@ -300,10 +325,9 @@ for gi in range(comm_inter.rank, len(gvals), comm_inter.size):
 		write_info(prefix + "_info.hdf", info)
 	if args.cont and (args.meta_only or maps_done): continue
 	# Decide which scans we should own. We do them consecutively to give each
-	# task a compact area
-	i1 = comm_intra.rank*ntod//comm_intra.size
-	i2 = min(ntod,(comm_intra.rank+1)*ntod//comm_intra.size)
-	my_inds = inds[i1:i2]
+	# task a compact area, with about the same total duration for each task
+	iedges  = split_by_cost(tod_costs[inds], comm_intra.size)
+	my_inds = inds[iedges[comm_intra.rank]:iedges[comm_intra.rank+1]]
 	# Read in our scans (minus the actual samples)
 	my_inds, scans = scanutils.read_scans(db.ids, my_inds, actscan.ACTScan, db=filedb.data, downsample=down)
 	if detslice:
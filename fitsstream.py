@@ -0,0 +1,38 @@
+"""Helpers for writing a fits map in row blocks, so that several tasks can
+stream their parts of a big map directly into the output file without any
+of them holding the whole map.
+
+The blocks are written with plain rb+ writes at their byte offsets, and
+neighbouring blocks from different tasks will in general share a filesystem
+page. This is fine on local disks and on parallel filesystems with byte-range
+coherent writes like lustre and gpfs, but not on NFS-like filesystems with
+client-side page caching, where concurrent writes to the same page can be lost.
+Write to such filesystems from a single task only."""
+from __future__ import division
+import numpy as np
+from astropy.io import fits
+
+def prepare_output(fname, shape, wcs, dtype):
+	"""Write the header of fname and allocate space for the data, so that
+	the blocks can be streamed into it as they are done. Returns the header length."""
+	hdu    = fits.PrimaryHDU(np.zeros((1,)*len(shape), dtype), header=wcs.to_header(relax=True))
+	header = hdu.header
+	for i, n in enumerate(shape[::-1]):
+		header["NAXIS%d" % (i+1)] = n
+	header.tofile(fname, overwrite=True)
+	hlen   = len(header.tostring())
+	nbyte  = int(np.prod(shape))*np.dtype(dtype).itemsize
+	with open(fname, "rb+") as f:
+		f.seek(hlen + (nbyte+2879)//2880*2880 - 1)
+		f.write(b"\0")
+	return hlen
+
+def write_rows(fname, hlen, shape, block, r1):
+	"""Write the rows r1:r1+block.shape[-2] of each component of a map
+	with the given shape to the fits file prepared by prepare_output"""
+	block = np.ascontiguousarray(block.reshape((-1,)+block.shape[-2:]), block.dtype.newbyteorder(">"))
+	ny, nx= shape[-2:]
+	with open(fname, "rb+") as f:
+		for ci, cblock in enumerate(block):
+			f.seek(hlen + (ci*ny+r1)*nx*block.itemsize)
+			f.write(cblock.tobytes())
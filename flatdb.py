@@ -0,0 +1,69 @@
+"""Flat, columnar hdf files of per-detector data for many tods, as written by
+cut_reformat.py and gain_reformat.py. Instead of one group per tod, each
+quantity is a single dataset covering all the tods, so readers can slice out
+a single tod without iterating over groups:
+  ids[nfile]            sorted tod ids
+  det_offsets[nfile+1]  tod i has entries det_offsets[i]:det_offsets[i+1]
+                        of the per-detector datasets
+The cut files additionally have
+  nsamp[nfile], sample_offset[nfile]
+  dets[ndet_tot]
+  detmap[ndet_tot+1]    global det j has ranges[detmap[j]:detmap[j+1]]
+  ranges[nrange_tot,2]  sample ranges relative to the tod's sample_offset
+and the gain files
+  det_uid[ndet_tot], cal[ndet_tot]"""
+import numpy as np, h5py
+
+def write_parallel(fname, fields, mydata, comm):
+	"""Create the datasets given by fields = {name:(shape,dtype)} in fname, and
+	let each task fill in its parts, given as a list of (name, slice, data).
+	Uses parallel hdf5 if available, and otherwise lets the tasks write in turn."""
+	if comm.size > 1 and h5py.get_config().mpi:
+		with h5py.File(fname, "w", driver="mpio", comm=comm) as hfile:
+			for name in sorted(fields):
+				hfile.create_dataset(name, fields[name][0], fields[name][1])
+			for name, sel, data in mydata:
+				hfile[name][sel] = data
+	else:
+		if comm.rank == 0:
+			with h5py.File(fname, "w") as hfile:
+				for name in sorted(fields):
+					hfile.create_dataset(name, fields[name][0], fields[name][1])
+		for rank in range(comm.size):
+			comm.Barrier()
+			if rank != comm.rank: continue
+			with h5py.File(fname, "r+") as hfile:
+				for name, sel, data in mydata:
+					hfile[name][sel] = data
+
+def id_dtype(ids):
+	"""String dtype big enough for all of ids, which may be empty"""
+	return "S%d" % max([1]+[len(id) for id in ids])
+
+def find_tod(hfile, id):
+	"""Index of the tod with the given id in the open flat file hfile"""
+	ids = hfile["ids"]
+	if isinstance(id, str) and not isinstance(id, bytes): id = id.encode()
+	i   = np.searchsorted(ids[()], id)
+	if i >= len(ids) or ids[i] != id: raise KeyError(id)
+	return i
+
+def read_gain(fname, id):
+	"""Read the gains of the tod with the given id from the flat gain file
+	fname. Returns det_uid[ndet], cal[ndet]"""
+	with h5py.File(fname, "r") as hfile:
+		i    = find_tod(hfile, id)
+		d1, d2 = hfile["det_offsets"][i:i+2]
+		return hfile["det_uid"][d1:d2], hfile["cal"][d1:d2]
+
+def read_cut(fname, id):
+	"""Read the cuts of the tod with the given id from the flat cut file fname.
+	Returns dets[ndet], detmap[ndet+1], ranges[nrange,2], nsamp, sample_offset,
+	which are the fields of the flagrange.Flagrange the file was built from.
+	detmap is relative to the returned ranges."""
+	with h5py.File(fname, "r") as hfile:
+		i    = find_tod(hfile, id)
+		d1, d2 = hfile["det_offsets"][i:i+2]
+		detmap = hfile["detmap"][d1:d2+1]
+		ranges = hfile["ranges"][detmap[0]:detmap[-1]]
+		return hfile["dets"][d1:d2], detmap-detmap[0], ranges, hfile["nsamp"][i], hfile["sample_offset"][i]
@@ -1,6 +1,7 @@
-import numpy as np, argparse, glob, h5py, os, re, sys, shutil
+import numpy as np, argparse, glob, os, re, sys
 from enlib import utils, sampcut, flagrange, mpi
 from enact import files
+import flatdb
 parser = argparse.ArgumentParser()
 parser.add_argument("iglobs", nargs="+")
 parser.add_argument("ofile")
@@ -31,37 +32,45 @@ if len(dups) > 0:
 	sys.exit(1)
 
 nfile = len(ifiles)
-# Make tmp directory for output
-tmpdir  = args.ofile + ".tmp"
-tmpfmt  = tmpdir + "/cut%03d.hdf"
-utils.mkdir(tmpdir)
 
-# Process each of our blocks
-with h5py.File(tmpfmt % comm.rank, "w") as hfile:
-	for j, i in enumerate(range(comm.rank*nfile/comm.size, (comm.rank+1)*nfile/comm.size)):
-		ifile, id = ifiles[i], ids[i]
-		progress = min(comm.rank + j*comm.size, nfile-1)
-		print "%5d/%d %5.1f%% %s" % (progress+1, nfile, 100.0*(progress+1)/nfile, id)
-		dets, gain = files.read_gain(ifile)
-		dtype = [("det_uid","i"),("cal","f")]
-		res = np.zeros(len(dets),dtype)
-		res["det_uid"] = dets
-		res["cal"] = gain
-		hfile[id] = res
+# The output uses the flat layout described in flatdb, and can be read
+# with flatdb.read_gain
 
-# Then concatenate them into the final file
-comm.Barrier()
+# Read our block of files
+i1, i2 = comm.rank*nfile/comm.size, (comm.rank+1)*nfile/comm.size
+dets, gains = [], []
+for j, i in enumerate(range(i1, i2)):
+	ifile, id = ifiles[i], ids[i]
+	progress = min(comm.rank + j*comm.size, nfile-1)
+	print "%5d/%d %5.1f%% %s" % (progress+1, nfile, 100.0*(progress+1)/nfile, id)
+	tdets, gain = files.read_gain(ifile)
+	dets.append(np.asarray(tdets))
+	gains.append(np.asarray(gain))
+ndet   = sum([len(d) for d in dets])
+ndets  = comm.allgather(ndet)
+det0   = sum(ndets[:comm.rank])
+ndet_tot = sum(ndets)
+det_offsets = det0 + np.cumsum([0]+[len(d) for d in dets])[:-1]
+
+fields = {
+	"ids":         ((nfile,),    flatdb.id_dtype(ids)),
+	"det_offsets": ((nfile+1,),  int),
+	"det_uid":     ((ndet_tot,), "i"),
+	"cal":         ((ndet_tot,), "f"),
+}
+mydata = []
+if i2 > i1:
+	mydata += [("det_offsets", slice(i1,i2), det_offsets)]
+if ndet > 0:
+	mydata += [
+		("det_uid",    slice(det0,det0+ndet),  np.concatenate(dets)),
+		("cal",        slice(det0,det0+ndet),  np.concatenate(gains))]
 if comm.rank == 0:
-	print "Reducing"
-	i = 0
-	with h5py.File(args.ofile, "w") as ohdf:
-		for rank in range(comm.size):
-			tmpfile = tmpfmt % rank
-			with h5py.File(tmpfile, "r") as ihdf:
-				for key in ihdf.keys():
-					ihdf.copy(key, ohdf)
-					print "%5d/%d %5.1f%% %s" % (i+1, nfile, 100.0*(i+1)/nfile, id)
-					i += 1
-	print "Done"
-	# Remove our tmp files
-	shutil.rmtree(tmpdir)
+	mydata += [
+		("ids",        slice(None),            ids.astype("S")),
+		("det_offsets",slice(nfile,nfile+1),   [ndet_tot])]
+
+if comm.rank == 0: print "Writing %s" % args.ofile
+flatdb.write_parallel(args.ofile, fields, mydata, comm)
+comm.Barrier()
+if comm.rank == 0: print "Done"
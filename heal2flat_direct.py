@@ -1,9 +1,10 @@
 import numpy as np, argparse, os, healpy
-from enlib import utils, enmap, curvedsky, log, coordinates
+from enlib import utils, enmap, curvedsky, log, coordinates, mpi
+from fitsstream import prepare_output, write_rows
 parser = argparse.ArgumentParser()
-parser.add_argument("ihealmap")
+parser.add_argument("ihealmaps", nargs="+")
 parser.add_argument("template")
-parser.add_argument("ofile")
+parser.add_argument("ofile", help="Output map if a single input map is given, otherwise output directory")
 parser.add_argument("-n", "--ncomp", type=int, default=1)
 parser.add_argument("-i", "--first", type=int, default=0)
 parser.add_argument("-v", "--verbosity", type=int, default=2)
@@ -11,61 +12,161 @@ parser.add_argument("-r", "--rot",   type=str, default=None)
 parser.add_argument("-u", "--unit",  type=float, default=1)
 parser.add_argument("-O", "--order", type=int, default=0)
 parser.add_argument("-s", "--scalar", action="store_true")
+parser.add_argument("-b", "--bsize", type=int, default=100)
+parser.add_argument("-g", "--group", type=int, default=0, help="Number of input maps to hold in memory at once. 0 for all")
 args = parser.parse_args()
 
+comm = mpi.COMM_WORLD
 log_level = log.verbosity2level(args.verbosity)
-L = log.init(level=log_level)
+L = log.init(level=log_level, rank=comm.rank)
 ncomp = args.ncomp
+bsize = args.bsize
 assert ncomp == 1 or ncomp == 3, "Only 1 or 3 components supported"
 
-# Read the input maps
-L.info("Reading " + args.ihealmap)
-imap    = np.atleast_2d(healpy.read_map(args.ihealmap, field=tuple(range(args.first,args.first+ncomp))))
-nside   = healpy.npix2nside(imap.shape[-1])
-mask    = imap < -1e20
-dtype   = imap.dtype
-bsize   = 100
+def read_healmap(fname):
+	imap = np.atleast_2d(healpy.read_map(fname, field=tuple(range(args.first,args.first+ncomp))))
+	mask = imap < -1e20
+	if args.unit != 1: imap[~mask]/= args.unit
+	return imap
 
-if args.unit != 1: imap[~mask]/= args.unit
+def get_ring_theta(nside):
+	_, _, costheta, _, _ = healpy.ringinfo(nside, np.arange(1,4*nside))
+	return np.arccos(costheta)
 
-# Read the template
-shape, wcs = enmap.read_map_geometry(args.template)
-shape = (args.ncomp,)+shape[-2:]
+def get_interp_weights_separable(nside, theta, phi, ring_theta):
+	"""Separable version of healpy.get_interp_weights for a cylindrical grid
+	where every row has the same theta[ny] and every column the same phi[nx].
+	The bracketing rings and theta weights are computed once per row, and the
+	pixels within each ring follow from phi alone. Returns pix[4,ny,nx], weights[4,ny,nx]."""
+	nring = 4*nside-1
+	ny, nx= len(theta), len(phi)
+	phi   = phi % (2*np.pi)
+	pix   = np.zeros((4,ny,nx),int)
+	wgt   = np.zeros((4,ny,nx))
+	# ir1 is the ring north of each row, with 0 meaning north of all rings
+	ir1   = np.searchsorted(ring_theta, theta)
+	ir2   = ir1+1
+	for k, ir in [(0,ir1),(2,ir2)]:
+		start, nr, _, _, shifted = healpy.ringinfo(nside, np.clip(ir,1,nring))
+		tmp = phi[None,:]/(2*np.pi/nr[:,None]) - 0.5*shifted[:,None]
+		i1  = np.floor(tmp).astype(int)
+		w1  = tmp - i1
+		pix[k]   = start[:,None] + i1 % nr[:,None]
+		pix[k+1] = start[:,None] + (i1+1) % nr[:,None]
+		wgt[k]   = 1-w1
+		wgt[k+1] = w1
+	theta1 = ring_theta[np.clip(ir1-1,0,nring-1)]
+	theta2 = ring_theta[np.clip(ir2-1,0,nring-1)]
+	north  = ir1 == 0
+	south  = ir2 == 4*nside
+	mid    = ~north & ~south
+	# Normal case: linear interpolation between the two rings
+	wtheta = ((theta-theta1)/np.where(mid, theta2-theta1, 1))[mid,None]
+	wgt[0:2,mid] *= 1-wtheta
+	wgt[2:4,mid] *= wtheta
+	# North of the first ring: interpolate towards the mean of the 4 polar pixels
+	if np.any(north):
+		wtheta = (theta/theta2)[north,None]
+		fac    = (1-wtheta)*0.25
+		wgt[2:4,north] = wgt[2:4,north]*wtheta + fac
+		wgt[0:2,north] = fac
+		pix[0:2,north] = (pix[2:4,north]+2)&3
+	# South of the last ring: same thing for the south pole
+	if np.any(south):
+		wtheta = ((theta-theta1)/(np.pi-theta1))[south,None]
+		fac    = wtheta*0.25
+		wgt[0:2,south] = wgt[0:2,south]*(1-wtheta) + fac
+		wgt[2:4,south] = fac
+		pix[2:4,south] = ((pix[0:2,south]+2)&3) + 12*nside**2-4
+	return pix, wgt
 
-# Allocate our output map
-omap   = enmap.zeros(shape, wcs, dtype)
-nblock = (omap.shape[-2]+bsize-1)//bsize
-
-for bi in range(nblock):
-	r1 = bi*bsize
-	r2 = (bi+1)*bsize
-	print("Processing row %5d/%d" % (r1, omap.shape[-2]))
-	
-	# Output map coordinates
-	osub = omap[...,r1:r2,:]
-	pmap = osub.posmap()
+def get_lookup(shape, wcs, ring_theta):
+	"""Compute the healpix pixels and interpolation weights needed for the
+	output block with the given geometry. These only depend on the geometry,
+	so they are shared by all the input maps. Returns pix[nw,ny,nx], weights[nw,ny,nx] or None, psi or None."""
+	psi = None
+	if separable:
+		# theta only depends on the row and phi on the column
+		ny, nx = shape[-2:]
+		theta  = np.pi/2-enmap.pix2sky(shape, wcs, [np.arange(ny),np.zeros(ny)])[0]
+		phi    = enmap.pix2sky(shape, wcs, [np.zeros(nx),np.arange(nx)])[1]
+		if args.order == 0:
+			return healpy.ang2pix(nside, theta[:,None], phi[None,:])[None], None, psi
+		else:
+			pix, wgt = get_interp_weights_separable(nside, theta, phi, ring_theta)
+			return pix, wgt, psi
+	# General case. Output map coordinates
+	pmap = enmap.posmap(shape, wcs)
 	# Coordinate transformation
 	if args.rot:
-			s1,s2 = args.rot.split(",")
-			opos  = coordinates.transform(s2, s1, pmap[::-1], pol=ncomp==3)
-			pmap[...] = opos[1::-1]
-			if len(opos) == 3: psi = -opos[2].copy()
-			del opos
+		s1,s2 = args.rot.split(",")
+		opos  = coordinates.transform(s2, s1, pmap[::-1], pol=ncomp==3)
+		pmap[...] = opos[1::-1]
+		if len(opos) == 3: psi = -opos[2].copy()
+		del opos
 	# Switch to healpix convention
 	theta = np.pi/2-pmap[0]
 	phi   = pmap[1]
-	# Evaluate map at these locations
 	if args.order == 0:
-		pix  = healpy.ang2pix(nside, theta, phi)
-		osub[:] = imap[:,pix]
-	elif args.order == 1:
-		for i in range(ncomp):
-			osub[i] = healpy.get_interp_val(imap[i], theta, phi)
+		return healpy.ang2pix(nside, theta, phi)[None], None, psi
+	else:
+		pix, wgt = healpy.get_interp_weights(nside, theta, phi)
+		return pix, wgt, psi
+
+def apply_lookup(imap, pix, wgt, psi):
+	if wgt is None: res = imap[:,pix[0]]
+	else:           res = np.sum(imap[:,pix]*wgt,1)
 	# Rotate polarization if necessary
-	if args.rot and ncomp==3:
-		osub[1:3] = enmap.rotate_pol(osub[1:3], psi)
+	if psi is not None and ncomp==3:
+		res[1:3] = enmap.rotate_pol(res[1:3], psi)
+	return res
+
+# Read the template
+shape, wcs = enmap.read_map_geometry(args.template)
+shape = (args.ncomp,)+shape[-2:]
+oshape= shape[-2:] if args.scalar else shape
+# The posmap can be skipped for cylindrical projections without rotation
+separable = args.rot is None and wcs.wcs.ctype[0][-3:] in ["CAR","CEA"]
+
+# Determine our output files
+if len(args.ihealmaps) == 1: ofiles = [args.ofile]
+else:
+	if comm.rank == 0: utils.mkdir(args.ofile)
+	ofiles = [args.ofile + "/" + os.path.splitext(os.path.basename(ifile))[0] + ".fits" for ifile in args.ihealmaps]
 
-print("Writing")
-if args.scalar: omap = omap.preflat[0]
-enmap.write_map(args.ofile, omap)
-print("Done")
+# Process the maps in groups that share the pixel lookups
+gsize  = args.group or len(args.ihealmaps)
+nblock = (shape[-2]+bsize-1)//bsize
+for g1 in range(0, len(args.ihealmaps), gsize):
+	ifiles = args.ihealmaps[g1:g1+gsize]
+	gfiles = ofiles[g1:g1+gsize]
+	imaps  = []
+	for ifile in ifiles:
+		L.info("Reading " + ifile)
+		imaps.append(read_healmap(ifile))
+	nside = healpy.npix2nside(imaps[0].shape[-1])
+	dtype = imaps[0].dtype
+	assert all([imap.shape[-1] == imaps[0].shape[-1] for imap in imaps]), "All input maps in a group must have the same nside"
+	ring_theta = get_ring_theta(nside) if separable and args.order == 1 else None
+	# Allocate our output maps on disk
+	hlens = [prepare_output(ofile, oshape, wcs, dtype) for ofile in gfiles] if comm.rank == 0 else None
+	hlens = comm.bcast(hlens)
+	# Each task handles its own blocks of rows, and writes them directly.
+	# See fitsstream for the filesystem requirements this implies.
+	for bi in range(comm.rank, nblock, comm.size):
+		r1 = bi*bsize
+		r2 = min((bi+1)*bsize, shape[-2])
+		L.info("Processing row %5d/%d" % (r1, shape[-2]))
+		bshape, bwcs  = enmap.slice_geometry(shape, wcs, (slice(r1,r2),slice(None)))
+		pix, wgt, psi = get_lookup(bshape, bwcs, ring_theta)
+		for imap, ofile, hlen in zip(imaps, gfiles, hlens):
+			res = apply_lookup(imap, pix, wgt, psi).astype(dtype)
+			# The scalar output only has room for the first component
+			if args.scalar: res = res[0]
+			write_rows(ofile, hlen, oshape, res, r1)
+		del pix, wgt, psi
+	del imaps
+	comm.Barrier()
+	if comm.rank == 0:
+		for ofile in gfiles: L.info("Wrote " + ofile)
+if comm.rank == 0: L.info("Done")
@@ -1,6 +1,6 @@
 from __future__ import division, print_function
-import numpy as np, argparse
-from enlib import enmap
+import numpy as np, argparse, sys
+from enlib import enmap, mpi, utils
 parser = argparse.ArgumentParser()
 parser.add_argument("ifiles", nargs="+")
 parser.add_argument("ofile")
@@ -13,36 +13,62 @@ parser.add_argument("-O", "--order", type=int, default=3)
 args = parser.parse_args()
 
 # Compute total 2d spectrum for the given input files, which must
-# all have compatible geometry
+# all have compatible geometry. The files are distributed over the
+# mpi tasks. Since we only keep the real part in the end, and both that
+# and the downgrade are linear, we accumulate the pregraded real part of
+# each component pair directly, so the full-resolution ncomp x ncomp
+# spectrum is never held in memory.
 
+def pair_spec(m, i, j, pregrade):
+	return enmap.downgrade((m[i]*np.conj(m[j])).real, pregrade)
+
+def add_pairs(ps, m, pregrade):
+	ncomp = len(m)
+	for i in range(ncomp):
+		for j in range(i, ncomp):
+			ps[i,j] += pair_spec(m, i, j, pregrade)
+			if j != i: ps[j,i] = ps[i,j]
+
+comm    = mpi.COMM_WORLD
 nfile   = len(args.ifiles)
 ftot    = None
 ps_auto = None
-for ifile in args.ifiles:
-	print("Reading %s" % ifile)
+for ifile in args.ifiles[comm.rank::comm.size]:
+	print("%3d Reading %s" % (comm.rank, ifile))
 	m = enmap.read_map(ifile)
 	m = eval("m"+args.slice)
 	m = m.apod(args.apod)
 	m = enmap.map2harm(m)
 	if ftot is None:
 		ftot = m*0
-		ps_auto = enmap.zeros(m.shape[:1]+m.shape, m.wcs, m.dtype)
+		dref    = enmap.downgrade(m[0].real, args.pregrade)
+		ps_auto = enmap.zeros(m.shape[:1]+m.shape[:1]+dref.shape, dref.wcs, dref.dtype)
+		del dref
 	ftot += m
-	ps_auto += m[:,None]*np.conj(m[None,:])
+	add_pairs(ps_auto, m, args.pregrade)
+	del m
+
+# Tasks that didn't get any files still need the right shapes for the reduction
+if comm.size > 1:
+	ref = comm.bcast(None if ftot is None else (ftot.shape, ftot.wcs, ftot.dtype, ps_auto.shape, ps_auto.wcs), root=0)
+	if ftot is None:
+		ftot    = enmap.zeros(ref[0], ref[1], ref[2])
+		ps_auto = enmap.zeros(ref[3], ref[4], ftot.real.dtype)
+	ftot    = utils.allreduce(ftot,    comm)
+	ps_auto = utils.allreduce(ps_auto, comm)
+if comm.rank > 0: sys.exit(0)
 
 print("Computing cross spectrum")
 # Compute auto spectrum
 ps_auto /= nfile**2
 ftot /= nfile
 # Compute total spectrum
-ps_tot = ftot[:,None]*np.conj(ftot[None,:])
+ps_cross = ps_auto*0
+add_pairs(ps_cross, ftot, args.pregrade)
 if len(args.ifiles) > 1:
 	# Subtract to get cross spectrum
-	ps_cross = ps_tot - ps_auto
-else:
-	ps_cross = ps_tot
-del ps_tot, ps_auto, ftot
-ps_cross = enmap.downgrade(ps_cross, args.pregrade)
+	ps_cross -= ps_auto
+del ps_auto, ftot
 print(ps_cross.shape)
 
 print("Normalizing")
@@ -72,8 +98,5 @@ ospec = ps_cross.project(oshape, owcs, order=3)
 print("Downgrading")
 ospec = enmap.downgrade(ospec, args.downgrade)
 
-# Keep only the real part for now
-ospec = ospec.real
-
 print("Writing")
 enmap.write_map(args.ofile, ospec)
@@ -1,6 +1,6 @@
 from __future__ import division, print_function
 import numpy as np, os, h5py
-from enlib import enmap, pmat, utils, scan, cg, bench, nmat, config, mpi, errors, array_ops
+from enlib import enmap, pmat, utils, scan, cg, bench, nmat, config, mpi, errors, array_ops, bunch
 from enact import actdata, filedb, actscan
 from pixell import fft
 parser = config.ArgumentParser(os.environ["HOME"]+"/.enkirc")
@@ -12,6 +12,11 @@ parser.add_argument("-m", "--method",type=str, default="messenger")
 parser.add_argument(      "--ndet",  type=int, default=None)
 parser.add_argument("-p", "--precompute", action="store_true")
 parser.add_argument("-o", "--ostep", type=int, default=10)
+parser.add_argument("-L", "--levels", type=int, default=1, help="Number of multigrid levels for the messenger method. Each coarser level has 2x larger pixels")
+parser.add_argument(      "--cycles", type=int, default=2, help="Number of multigrid V-cycles when --levels > 1")
+parser.add_argument(      "--smooth", type=int, default=5, help="Number of messenger steps at the final lambda before and after each coarse grid correction")
+parser.add_argument("-t", "--tol",   type=float, default=0, help="If nonzero, step through the cooling schedule based on convergence instead of a fixed number of steps per lambda. Iteration on each lambda stops when the relative map change is below this. nstep is then the max number of steps per level.")
+parser.add_argument(      "--maxiter-lam", type=int, default=50, help="Max number of steps per lambda when --tol is used")
 args = parser.parse_args()
 
 print("Setting fft engine to numpy for now, until I can fix my installation")
@@ -27,174 +32,280 @@ area   = enmap.zeros((ncomp,)+area.shape[-2:],area.wcs,dtype)
 Tscale = 0.9
 nstep  = args.nstep
 downsample = config.get("downsample")
+nlevel = args.levels if args.method == "messenger" else 1
+if nlevel > 1 and args.precompute:
+	raise ValueError("--precompute can't be used with --levels > 1, since the coarse levels need Nb\"d for each tod")
 
 filedb.init()
 ids   = filedb.scans[args.sel]
 # Was 1e7
 cooldown = sum([[10**j]*5 for j in range(6,0,-1)],[])+[1]
 
-# Read my scans
-njunk_tot = 0
-cg_rhs    = area*0
-cg_rjunk  = []
-if args.precompute:
-	prec_NNmap  = {lam: area*0 for lam in np.unique(cooldown)}
-	prec_NNjunk = {lam: [] for lam in np.unique(cooldown)}
-scans = []
-for ind in range(comm.rank, len(ids), comm.size):
-	id    = ids[ind]
-	entry = filedb.data[id]
-	try:
-		scan  = actscan.ACTScan(entry)
-		if scan.ndet == 0 or scan.nsamp == 0:
-			raise errors.DataMissing("No samples in scan")
-		if args.ndet:
-			scan = scan[:args.ndet]
-		if downsample > 1:
-			scan = scan[:,::downsample]
-		scan.pmap = pmat.PmatMap(scan, area)
-		scan.pcut = pmat.PmatCut(scan)
-		# Build the noise model
-		tod = scan.get_samples()
-		tod -= np.mean(tod,1)[:,None]
-		tod  = tod.astype(dtype)
-		scan.noise = scan.noise.update(tod, scan.srate)
-		scan.T = np.min(scan.noise.D)*Tscale
-		scan.noise_bar = nmat.NmatDetvecs(
-			scan.noise.D-scan.T, scan.noise.V, scan.noise.E,
-			scan.noise.bins, scan.noise.ebins, scan.noise.dets)
-		# Set up cuts
-		scan.cut_range = [njunk_tot,njunk_tot+scan.pcut.njunk]
-		njunk_tot += scan.pcut.njunk
-		# Prepare our filtered data. We do this one of two ways.
-		# Either store Nb"d for each TOD, which can end up taking
-		# up a lot of memory, or precompute P'(Nb"+(lT)")"Nbd"d for
-		# each value of lambda. This saves memory if the maps aren't
-		# too big and if the number of lambdas is reasonably small.
-		# For 6 lambdas and deep56 size, we get 240 MB * 6 = 1.4 GB.
-		# That corresponds to storing 4 downsampled tods.
-		if args.precompute:
-			iNbd = scan.noise_bar.apply(tod.copy())
-			for lam in np.unique(cooldown):
-				# Could cache this too, but it's fast to compute
-				iNbt = nmat.NmatDetvecs(
-						scan.noise_bar.iD + 1/(lam*scan.T), scan.noise_bar.iV,
-						scan.noise_bar.iE, scan.noise_bar.bins,
-						scan.noise_bar.ebins, scan.noise_bar.dets)
-				work = iNbt.apply(iNbd.copy())
-				work/= scan.T
-				pjunk= np.zeros(scan.pcut.njunk, dtype)
-				scan.pcut.backward(work, pjunk)
-				scan.pmap.backward(work, prec_NNmap[lam])
-				prec_NNjunk[lam].append(pjunk)
-			del iNbd
-		else:
-			# Compute Nbd, which we need to store
-			scan.Nbd = scan.noise_bar.apply(tod.copy())
-		if args.method == "cg":
-			scan.noise.apply(tod)
-			tmp = np.zeros(scan.pcut.njunk,dtype)
-			scan.pcut.backward(tod, tmp)
-			scan.pmap.backward(tod, cg_rhs)
-			cg_rjunk.append(tmp)
-	except errors.DataMissing as e:
-		print("Skipping %s (%s)" % (id, str(e)))
-		continue
-	print("Read %s" % id)
-	scans.append(scan)
-
-if args.precompute:
-	for lam in prec_NNjunk:
-		prec_NNmap[lam]  = utils.allreduce(prec_NNmap[lam], comm)
-		prec_NNjunk[lam] = np.concatenate(prec_NNjunk[lam])
-
-if args.method == "cg":
-	cg_rhs = utils.allreduce(cg_rhs, comm)
-	cg_rjunk = np.concatenate(cg_rjunk)
-	if comm.rank == 0:
-		enmap.write_map(args.odir + "/map_rhs.fits", cg_rhs)
-	with h5py.File(args.odir + "/cut_rhs_%02d.hdf" % comm.rank, "w") as hfile:
-		hfile["data"] = cg_rjunk
-
-# Build div, which we need in both cases
-div  = enmap.zeros((ncomp,)+area.shape,area.wcs,dtype)
-for i in range(ncomp):
-	work    = div[0]*0
-	work[i] = 1
+def setup_scans(area):
+	"""Read the scans and build their noise models, filtered data and everything
+	else the solvers need that doesn't depend on the multigrid level. area is
+	the geometry of the finest level."""
+	# Read my scans
+	njunk_tot = 0
+	cg_rhs    = area*0
+	cg_rjunk  = []
+	prec_NNmap, prec_NNjunk = None, None
+	if args.precompute:
+		prec_NNmap  = {lam: area*0 for lam in np.unique(cooldown)}
+		prec_NNjunk = {lam: [] for lam in np.unique(cooldown)}
+	scans = []
+	for ind in range(comm.rank, len(ids), comm.size):
+		id    = ids[ind]
+		entry = filedb.data[id]
+		try:
+			scan  = actscan.ACTScan(entry)
+			if scan.ndet == 0 or scan.nsamp == 0:
+				raise errors.DataMissing("No samples in scan")
+			if args.ndet:
+				scan = scan[:args.ndet]
+			if downsample > 1:
+				scan = scan[:,::downsample]
+			scan.pmap = pmat.PmatMap(scan, area)
+			# The pointing matrices of each multigrid level
+			scan.pmaps= [scan.pmap]
+			scan.pcut = pmat.PmatCut(scan)
+			# Build the noise model
+			tod = scan.get_samples()
+			tod -= np.mean(tod,1)[:,None]
+			tod  = tod.astype(dtype)
+			scan.noise = scan.noise.update(tod, scan.srate)
+			scan.T = np.min(scan.noise.D)*Tscale
+			scan.noise_bar = nmat.NmatDetvecs(
+				scan.noise.D-scan.T, scan.noise.V, scan.noise.E,
+				scan.noise.bins, scan.noise.ebins, scan.noise.dets)
+			# Set up cuts
+			scan.cut_range = [njunk_tot,njunk_tot+scan.pcut.njunk]
+			njunk_tot += scan.pcut.njunk
+			# Prepare our filtered data. We do this one of two ways.
+			# Either store Nb"d for each TOD, which can end up taking
+			# up a lot of memory, or precompute P'(Nb"+(lT)")"Nbd"d for
+			# each value of lambda. This saves memory if the maps aren't
+			# too big and if the number of lambdas is reasonably small.
+			# For 6 lambdas and deep56 size, we get 240 MB * 6 = 1.4 GB.
+			# That corresponds to storing 4 downsampled tods.
+			if args.precompute:
+				iNbd = scan.noise_bar.apply(tod.copy())
+				for lam in np.unique(cooldown):
+					# Could cache this too, but it's fast to compute
+					iNbt = nmat.NmatDetvecs(
+							scan.noise_bar.iD + 1/(lam*scan.T), scan.noise_bar.iV,
+							scan.noise_bar.iE, scan.noise_bar.bins,
+							scan.noise_bar.ebins, scan.noise_bar.dets)
+					work = iNbt.apply(iNbd.copy())
+					work/= scan.T
+					pjunk= np.zeros(scan.pcut.njunk, dtype)
+					scan.pcut.backward(work, pjunk)
+					scan.pmap.backward(work, prec_NNmap[lam])
+					prec_NNjunk[lam].append(pjunk)
+				del iNbd
+			else:
+				# Compute Nbd, which we need to store
+				scan.Nbd = scan.noise_bar.apply(tod.copy())
+			if args.method == "cg":
+				scan.noise.apply(tod)
+				tmp = np.zeros(scan.pcut.njunk,dtype)
+				scan.pcut.backward(tod, tmp)
+				scan.pmap.backward(tod, cg_rhs)
+				cg_rjunk.append(tmp)
+		except errors.DataMissing as e:
+			print("Skipping %s (%s)" % (id, str(e)))
+			continue
+		print("Read %s" % id)
+		scans.append(scan)
+
+	if args.precompute:
+		for lam in prec_NNjunk:
+			prec_NNmap[lam]  = utils.allreduce(prec_NNmap[lam], comm)
+			prec_NNjunk[lam] = np.concatenate(prec_NNjunk[lam])
+
+	if args.method == "cg":
+		cg_rhs = utils.allreduce(cg_rhs, comm)
+		cg_rjunk = np.concatenate(cg_rjunk)
+		if comm.rank == 0:
+			enmap.write_map(args.odir + "/map_rhs.fits", cg_rhs)
+		with h5py.File(args.odir + "/cut_rhs_%02d.hdf" % comm.rank, "w") as hfile:
+			hfile["data"] = cg_rjunk
+
+	# Build the junk div, which we need in both cases
+	jdiv = np.full(njunk_tot, 1.0, dtype)
 	for scan in scans:
 		tod = np.zeros((scan.ndet,scan.nsamp),dtype)
-		scan.pmap.forward(tod,  work)
+		scan.pcut.forward(tod, jdiv[scan.cut_range[0]:scan.cut_range[1]])
 		if args.method == "cg":
 			scan.noise.white(tod)
 		else: tod /= scan.T
-		scan.pcut.backward(tod, np.zeros(scan.pcut.njunk,dtype))
-		scan.pmap.backward(tod, div[i])
-div = utils.allreduce(div, comm)
-#idiv = utils.eigpow(div,-1,[0,1])
-idiv = array_ops.eigpow(div,-1,[0,1], lim=1e-6)
-if comm.rank == 0:
-	enmap.write_map(args.odir + "/map_div.fits",  div)
-	enmap.write_map(args.odir + "/map_idiv.fits", idiv)
-del work, div
-# And the same for junk
-jdiv = np.full(njunk_tot, 1.0, dtype)
-for scan in scans:
-	tod = np.zeros((scan.ndet,scan.nsamp),dtype)
-	scan.pcut.forward(tod, jdiv[scan.cut_range[0]:scan.cut_range[1]])
+		scan.pcut.backward(tod, jdiv[scan.cut_range[0]:scan.cut_range[1]])
+	del tod
+
 	if args.method == "cg":
-		scan.noise.white(tod)
-	else: tod /= scan.T
-	scan.pcut.backward(tod, jdiv[scan.cut_range[0]:scan.cut_range[1]])
-del tod
+		with h5py.File(args.odir + "/cut_div_%02d.hdf" % comm.rank, "w") as hfile:
+			hfile["data"] = jdiv
+	return bunch.Bunch(scans=scans, njunk_tot=njunk_tot, jdiv=jdiv,
+			cg_rhs=cg_rhs, cg_rjunk=cg_rjunk, prec_NNmap=prec_NNmap, prec_NNjunk=prec_NNjunk)
 
-if args.method == "cg":
-	with h5py.File(args.odir + "/cut_div_%02d.hdf" % comm.rank, "w") as hfile:
-		hfile["data"] = jdiv
+def setup_level(data, area, li):
+	"""Build the pointing matrices and map preconditioner of multigrid level li
+	with the given geometry for the scans in data, as returned by setup_scans.
+	Level 0 is the finest one, whose pointing matrices setup_scans already built.
+	The levels must be set up in order."""
+	if li > 0:
+		for scan in data.scans:
+			scan.pmaps.append(pmat.PmatMap(scan, area))
+	# Build div, which we need in both cases
+	div  = enmap.zeros((ncomp,)+area.shape,area.wcs,dtype)
+	for i in range(ncomp):
+		work    = div[0]*0
+		work[i] = 1
+		for scan in data.scans:
+			tod = np.zeros((scan.ndet,scan.nsamp),dtype)
+			scan.pmaps[li].forward(tod,  work)
+			if args.method == "cg":
+				scan.noise.white(tod)
+			else: tod /= scan.T
+			scan.pcut.backward(tod, np.zeros(scan.pcut.njunk,dtype))
+			scan.pmaps[li].backward(tod, div[i])
+	div = utils.allreduce(div, comm)
+	#idiv = utils.eigpow(div,-1,[0,1])
+	idiv = array_ops.eigpow(div,-1,[0,1], lim=1e-6)
+	if comm.rank == 0 and li == 0:
+		enmap.write_map(args.odir + "/map_div.fits",  div)
+		enmap.write_map(args.odir + "/map_idiv.fits", idiv)
+	del work, div
+	return bunch.Bunch(area=area, li=li, idiv=idiv, **{key: data[key] for key in data})
+
+def messenger_step(level, map, junk, lam, Nbds=None):
+	"""Perform one messenger iteration at the given lambda, updating map and junk in place.
+	Nbds is a list of the filtered data Nb"d to solve for for each scan. If None, the
+	real data is used, through either scan.Nbd or the precomputed terms."""
+	for scan in level.scans:
+		# Precompute Nb"+(lT)". Nb" = iD + iV iE iV'. since
+		# T is diagonal, we can just add it to iD directly.
+		# Could there be a fourier space unit issue, though?
+		scan.iNbT = nmat.NmatDetvecs(
+				scan.noise_bar.iD + 1/(lam*scan.T), scan.noise_bar.iV,
+				scan.noise_bar.iE, scan.noise_bar.bins,
+				scan.noise_bar.ebins, scan.noise_bar.dets)
+	# solve for t. We only use t[si] once, so we don't
+	# actually need to store it separately like I do here.
+	rhs = level.area*0
+	for si, scan in enumerate(level.scans):
+		pmap = scan.pmaps[level.li]
+		t = np.zeros([scan.ndet,scan.nsamp],dtype)
+		pmap.forward(t, (lam*scan.T)**-1*map)
+		scan.pcut.forward(t, (lam*scan.T)**-1*junk[scan.cut_range[0]:scan.cut_range[1]])
+		if Nbds is not None:
+			t += Nbds[si]
+		elif not args.precompute:
+			t += scan.Nbd
+		t  = scan.iNbT.apply(t)
+		t /= scan.T
+		scan.pcut.backward(t, junk[scan.cut_range[0]:scan.cut_range[1]])
+		pmap.backward(t, rhs)
+	rhs    = utils.allreduce(rhs, comm)
+	if args.precompute and Nbds is None:
+		rhs  += level.prec_NNmap[lam]
+		junk += level.prec_NNjunk[lam]
+	junk  /= level.jdiv
+	map[:] = enmap.map_mul(level.idiv, rhs)
+
+def messenger_solve(level, map, junk=None, prefix="", Nbds=None, cool=True):
+	"""Run the messenger cooling schedule on the given level, starting from map
+	and junk, which are updated in place. With --tol, each lambda is iterated until
+	the relative change in the map drops below tol, up to --maxiter-lam steps, with
+	at most nstep steps in total. Otherwise the fixed cooldown schedule is followed
+	for nstep steps. If cool is False, only the final lambda is used. Nbds is passed
+	on to messenger_step."""
+	if junk is None: junk = np.zeros(level.njunk_tot, dtype)
+	if not cool:
+		schedule = [(1, nstep)]
+	elif args.tol > 0:
+		lams = np.unique(cooldown)[::-1]
+		schedule = [(lam, args.maxiter_lam if lam != lams[-1] else nstep) for lam in lams]
+	else:
+		schedule = [(cooldown[i] if i < len(cooldown) else 1, 1) for i in range(nstep)]
+	i = 0
+	for lam, maxiter in schedule:
+		for it in range(maxiter):
+			if i >= nstep: break
+			if args.tol > 0: old = map.copy()
+			messenger_step(level, map, junk, lam, Nbds)
+			i += 1
+			if args.tol > 0:
+				change = (np.sum((map-old)**2)/max(np.sum(map**2),1e-300))**0.5
+			if comm.rank == 0:
+				if args.tol > 0: print("%s%4d %15.7e %8.1f %15.7e" % (prefix, i, np.std(map), lam, change))
+				else:            print("%s%4d %15.7e %8.1f" % (prefix, i, np.std(map), lam))
+				if i % args.ostep == 0:
+					enmap.write_map(args.odir + "/%smap%04d.fits" % (prefix, i), map)
+			if args.tol > 0 and change < args.tol: break
+	return map
+
+def residual_data(level, map, junk, Nbds=None):
+	"""Compute Nb"(d-P map-Pcut junk) for each scan on the given level. This is the
+	filtered data the correction to map and junk must solve for. Nbds is the
+	filtered data d, as in messenger_step."""
+	res = []
+	for si, scan in enumerate(level.scans):
+		t = np.zeros([scan.ndet,scan.nsamp],dtype)
+		scan.pmaps[level.li].forward(t, map)
+		scan.pcut.forward(t, junk[scan.cut_range[0]:scan.cut_range[1]])
+		t = scan.noise_bar.apply(t)
+		res.append((Nbds[si] if Nbds is not None else scan.Nbd) - t)
+	return res
+
+def vcycle(levels, li, map, junk, Nbds=None, prefix="", cool=True):
+	"""Do one multigrid V-cycle for the messenger system on level li, updating map
+	and junk in place. The other levels do --smooth messenger steps at the final
+	lambda, restrict their residual to the next coarser level by projecting the
+	residual data onto its pixels, solve for the correction there, prolong the
+	correction back and add it, and then do --smooth more steps. The coarsest level
+	is solved with nstep messenger steps, following the cooling schedule if cool
+	is True. The higher lambdas have a different fixed point than the final one,
+	so cooling only helps while the large scales are still missing, i.e. in the
+	first cycle. Nbds is passed on to messenger_step."""
+	level = levels[li]
+	if li == len(levels)-1:
+		messenger_solve(level, map, junk, prefix=prefix + "lev%d_" % li, Nbds=Nbds, cool=cool)
+		return
+	for it in range(args.smooth):
+		messenger_step(level, map, junk, 1, Nbds)
+	Nbds_coarse = residual_data(level, map, junk, Nbds)
+	cmap  = levels[li+1].area*0
+	cjunk = np.zeros(level.njunk_tot, dtype)
+	vcycle(levels, li+1, cmap, cjunk, Nbds_coarse, prefix=prefix, cool=cool)
+	del Nbds_coarse
+	map  += enmap.project(cmap, map.shape, map.wcs, order=1).astype(dtype)
+	junk += cjunk
+	for it in range(args.smooth):
+		messenger_step(level, map, junk, 1, Nbds)
 
 if args.method == "messenger":
 	print(cooldown)
 	#cooldown = [1e8]*1 + [1e6]*2 + [1e5]*5 + [1e4]*7 + [1e3]*7 + [1e2]*10 + [1e1] * 10
 
-	map  = area*0
-	junk = np.zeros(njunk_tot, dtype)
-	plam = 0
-	for i in range(nstep):
-		lam = cooldown[i] if i < len(cooldown) else 1
-		#lam = max(1,10**(6-i*0.4))
-		for scan in scans:
-			# Precompute Nb"+(lT)". Nb" = iD + iV iE iV'. since
-			# T is diagonal, we can just add it to iD directly.
-			# Could there be a fourier space unit issue, though?
-			scan.iNbT = nmat.NmatDetvecs(
-					scan.noise_bar.iD + 1/(lam*scan.T), scan.noise_bar.iV,
-					scan.noise_bar.iE, scan.noise_bar.bins,
-					scan.noise_bar.ebins, scan.noise_bar.dets)
-		plam = lam
-		# solve for t. We only use t[si] once, so we don't
-		# actually need to store it separately like I do here.
-		rhs = area*0
-		for si, scan in enumerate(scans):
-			t = np.zeros([scan.ndet,scan.nsamp],dtype)
-			scan.pmap.forward(t, (lam*scan.T)**-1*map)
-			scan.pcut.forward(t, (lam*scan.T)**-1*junk[scan.cut_range[0]:scan.cut_range[1]])
-			if not args.precompute:
-				t += scan.Nbd
-			t  = scan.iNbT.apply(t)
-			t /= scan.T
-			scan.pcut.backward(t, junk[scan.cut_range[0]:scan.cut_range[1]])
-			scan.pmap.backward(t, rhs)
-		rhs    = utils.allreduce(rhs, comm)
-		if args.precompute:
-			rhs  += prec_NNmap[lam]
-			junk += prec_NNjunk[lam]
-		junk  /= jdiv
-		map[:] = enmap.map_mul(idiv, rhs)
-		if comm.rank == 0:
-			print("%4d %15.7e %8.1f" % (i+1, np.std(map), lam))
-			if (i+1) % args.ostep == 0:
-				enmap.write_map(args.odir + "/map%04d.fits" % (i+1), map)
+	data   = setup_scans(area)
+	levels = [setup_level(data, enmap.downgrade(area, 2**li) if li > 0 else area, li) for li in range(nlevel)]
+	map    = area*0
+	if nlevel == 1:
+		messenger_solve(levels[0], map)
+	else:
+		junk = np.zeros(data.njunk_tot, dtype)
+		for ci in range(args.cycles):
+			vcycle(levels, 0, map, junk, prefix="cycle%d_" % ci, cool=ci == 0)
+			if comm.rank == 0:
+				print("cycle %2d %15.7e" % (ci+1, np.std(map)))
+				enmap.write_map(args.odir + "/cycle%02d_map.fits" % (ci+1), map)
+	if comm.rank == 0:
+		enmap.write_map(args.odir + "/map.fits", map)
 
 elif args.method == "cg":
+	level = setup_level(setup_scans(area), area, 0)
+	scans, cg_rhs, cg_rjunk, idiv, jdiv = level.scans, level.cg_rhs, level.cg_rjunk, level.idiv, level.jdiv
 	def A(x):
 		map  = x[:area.size].reshape(area.shape)
 		junk = x[area.size:]
@@ -0,0 +1,39 @@
+"""Blockwise pointing evaluation for accumulating per-sample quantities into
+maps with bincount. Evaluating the pointing for a few detectors at a time and
+compressing to the pixels actually hit avoids both tod-sized pointing arrays
+and map-sized bincounts."""
+import numpy as np
+from enlib import utils
+
+bsize_help = "Number of detectors to evaluate the pointing for at once when projecting"
+
+def get_nphi(wcs):
+	"""Number of pixels around the sky in the x direction for cylindrical
+	geometries, or 0 for other projections, which are not wrapped"""
+	if wcs.wcs.ctype[0][-3:] not in ["CAR","CEA","MER"]: return 0
+	return utils.nint(np.abs(360/wcs.wcs.cdelt[0]))
+
+def pixel_blocks(pmap, scan, shape, wcs, bsize=32, bins=None):
+	"""Iterate over the detectors of scan in blocks of bsize, evaluating the
+	pointing of pmap for each. Yields d1, d2, upix, inv, ok, phase, where
+	ok[d2-d1,nsamp] is True for uncut samples that fall inside a map with
+	the given shape and wcs, upix are the flattened pixel indices hit by those samples,
+	inv gives the index into upix of each sample in tod[d1:d2][ok], and
+	phase[nok,ncomp] is their response. If bins[nsamp] is passed, the samples
+	are also split by bin, and upix indexes a [nbin,ny,nx] stack instead.
+	Like PmatMap, x pixels are wrapped by the number of pixels around the sky for
+	cylindrical geometries, so samples on the other branch of the ra cut aren't lost."""
+	ny, nx = shape[-2:]
+	nphi   = get_nphi(wcs)
+	for d1 in range(0, scan.ndet, bsize):
+		d2   = min(d1+bsize, scan.ndet)
+		pix, phase = pmap.translate(scan.boresight, scan.offsets[d1:d2], scan.comps[d1:d2])
+		iy, ix = utils.nint(pix[...,0]), utils.nint(pix[...,1])
+		if nphi > 0: ix %= nphi
+		ok   = (iy >= 0) & (iy < ny) & (ix >= 0) & (ix < nx) & ~scan.cut[d1:d2].to_mask()
+		inds = iy*nx+ix
+		if bins is not None: inds += bins[None,:]*(ny*nx)
+		del pix, iy, ix
+		# Compress to the pixels actually hit
+		upix, inv = np.unique(inds[ok], return_inverse=True)
+		yield d1, d2, upix, inv, ok, phase[ok]
@@ -477,10 +477,13 @@ elif mode == "filter":
 	parser.add_argument(      "--noiseref",  type=str,   default=None)
 	parser.add_argument("-R", "--ref",       type=str,   default=None, help="Reference map to keep downgrades compatible")
 	parser.add_argument("-d", "--downgrade", type=int,   default=1)
+	parser.add_argument(      "--opcache",   type=str,   default=None, help="Directory to cache the filter operators in between runs")
+	parser.add_argument(      "--opcache-size", type=int, default=4, help="Number of filter operators to keep in memory")
+	parser.add_argument(      "--opcache-tol",  type=float, default=0.02, help="Relative precision the fitted noise parameters are rounded to, so that chunks can share filter operators. 0 disables rounding")
 	args = parser.parse_args()
 	from enlib import utils
 	with utils.nowarn(): import h5py
-	import numpy as np, glob, sys, os, healpy
+	import numpy as np, glob, sys, os, healpy, hashlib, pickle, collections
 	from scipy import ndimage
 	from enlib import enmap, mpi, planet9, cython, bench, bunch
 
@@ -501,6 +504,59 @@ elif mode == "filter":
 		else:
 			ref_shape, ref_wcs = enmap.read_map_geometry(args.ref)
 
+	# The filter operators only depend on the shape, pixel scale and projection of the
+	# geometry, the beam and the filter parameters, which are usually shared by many
+	# chunks. Building them involves setting up the harmonic transforms and kernels, so
+	# we cache them in memory and optionally on disk. rfact is just an overall scale,
+	# so the operators are built for rfact = 1 and scaled per chunk, and the fitted
+	# noise parameters are rounded to --opcache-tol so that similar chunks can share them.
+	class ScaledRmat:
+		"""A cached Rmat built for rfact = 1, applied with a chunk's rfact and wcs"""
+		def __init__(self, R, scale):
+			self.R, self.scale, self.q = R, scale, R.q
+		def apply(self, map):
+			return enmap.ndmap(self.R.apply(map)*self.scale, map.wcs)
+	def quantize(x, tol):
+		if x is None or x == 0 or tol <= 0: return x
+		return np.sign(x)*np.exp(np.round(np.log(np.abs(x))/tol)*tol)
+	def check_pickle(R, shape, wcs):
+		"""Check that R survives a pickle round-trip, so that it can be cached on disk"""
+		try: R2 = pickle.loads(pickle.dumps(R, protocol=pickle.HIGHEST_PROTOCOL))
+		except (pickle.PicklingError, TypeError, AttributeError) as e:
+			print("Can't pickle filter operator (%s). Not caching it on disk" % str(e))
+			return False
+		test = enmap.zeros(shape, wcs)
+		test[...,shape[-2]//2,shape[-1]//2] = 1
+		if not np.allclose(R.apply(test), R2.apply(test)):
+			print("Filter operator changed in pickle round-trip. Not caching it on disk")
+			return False
+		return True
+	rcache = collections.OrderedDict()
+	if args.opcache and comm.rank == 0: utils.mkdir(args.opcache)
+	comm.Barrier()
+	def get_rmat(shape, wcs, beam, rfact, pow=1, **kwargs):
+		kwargs = {key: quantize(val, args.opcache_tol) if key != "lmax" else val for key, val in kwargs.items()}
+		h = hashlib.md5()
+		h.update(repr((tuple(shape), tuple(wcs.wcs.cdelt), tuple(wcs.wcs.ctype), pow, sorted(kwargs.items()))).encode())
+		h.update(np.ascontiguousarray(beam, dtype=float).tobytes())
+		key = h.hexdigest()
+		if key in rcache:
+			rcache[key] = rcache.pop(key)
+			return ScaledRmat(rcache[key], rfact**pow)
+		fname = args.opcache + "/rmat_%s.pickle" % key if args.opcache else None
+		if fname and os.path.isfile(fname):
+			with open(fname, "rb") as f: R = pickle.load(f)
+		else:
+			R = planet9.Rmat(shape, wcs, beam, 1.0, pow=pow, **kwargs)
+			if fname and check_pickle(R, shape, wcs):
+				# Write to a temporary file first, so other tasks never see a partial file
+				tname = fname + ".tmp%d" % comm.rank
+				with open(tname, "wb") as f: pickle.dump(R, f, protocol=pickle.HIGHEST_PROTOCOL)
+				os.rename(tname, fname)
+		rcache[key] = R
+		while len(rcache) > max(args.opcache_size,1): rcache.popitem(last=False)
+		return ScaledRmat(R, rfact**pow)
+
 	for ind in range(comm.rank, len(dirs), comm.size):
 		dirpath = dirs[ind]
 		if args.cont and os.path.isfile(dirpath + "/kmap.fits"): continue
@@ -509,8 +565,8 @@ elif mode == "filter":
 		# First we'll build frhs = F*R*rhs
 		rhs     = enmap.read_map(dirpath + "/rhs.fits")
 		fit     = planet9.setup_noise_fit(rhs, args.lknee, dirpath, disable=not args.extra_filter, dump=True)
-		R       = planet9.Rmat(rhs.shape, rhs.wcs, info.beam, info.rfact, lmax=args.lmax, lknee1=fit.lknee1, alpha1=fit.alpha1, lknee2=fit.lknee2, alpha2=fit.alpha2)
-		R2      = planet9.Rmat(rhs.shape, rhs.wcs, info.beam, info.rfact, lmax=args.lmax, pow=2)
+		R       = get_rmat(rhs.shape, rhs.wcs, info.beam, info.rfact, lmax=args.lmax, lknee1=fit.lknee1, alpha1=fit.alpha1, lknee2=fit.lknee2, alpha2=fit.alpha2)
+		R2      = get_rmat(rhs.shape, rhs.wcs, info.beam, info.rfact, lmax=args.lmax, pow=2)
 		wmask   = None
 		def nmul(a,b):
 			if a is None: return b
@@ -1,10 +1,11 @@
 from __future__ import division, print_function
-import numpy as np, sys, os
+import numpy as np, sys, os, glob
 from enlib import utils
 with utils.nowarn(): import h5py
 from enlib import config, pmat, mpi, errors, gapfill, enmap, bench, sampcut, cg
-from enlib import fft, array_ops
+from enlib import fft, array_ops, nmat
 from enact import filedb, actscan, actdata, cuts, nmat_measure
+import pixblocks
 
 config.set("pmat_cut_type",  "full")
 
@@ -23,6 +24,8 @@ parser.add_argument("--noiseless",      action="store_true", help="Replace signa
 parser.add_argument("--dbox",          type=str,   default=None, help="Select only detectors in y1:y2,x1:x2 in the focalplane, relative to the center of the array, in degrees.")
 parser.add_argument("--tags",          type=str,   default=None)
 parser.add_argument("-m", "--model",   type=str,   default="joneig")
+parser.add_argument("-b", "--bsize",   type=int,   default=32, help=pixblocks.bsize_help)
+parser.add_argument(      "--fits",    action="store_true", help="Write separate map, rhs and div fits files for each tod instead of one hdf container per task")
 args = parser.parse_args()
 
 zenith = args.zenith - args.equator
@@ -50,7 +53,7 @@ else: dbox = None
 
 if args.sim:
 	sim_ids = filedb.scans[args.sim][:len(ids)]
-	area    = enmap.read_map(args.area).astype(dytpe)
+	area    = enmap.read_map(args.area).astype(dtype)
 
 def smooth(tod, srate):
 	ft   = fft.rfft(tod)
@@ -72,10 +75,17 @@ def broaden_beam_hor(tod, d, ibeam, obeam):
 def calc_model_joneig(tod, cut, srate=400):
 	return smooth(gapfill.gapfill_joneig(tod, cut, inplace=False), srate)
 
-def calc_model_constrained(tod, cut, srate=400, mask_scale=0.3, lim=3e-4, maxiter=50, verbose=False):
+def calc_model_constrained(tod, cut, srate=400, mask_scale=0.3, lim=3e-4, maxiter=50, verbose=False, noise_tod=None):
+	"""Constrained realization model of the correlated noise in tod, which is
+	also valid inside cut. The model is linear in tod for a fixed noise model,
+	so noise_tod can be used to estimate the noise model from other data with
+	the same noise properties."""
 	# First do some simple gapfilling to avoid messing up the noise model
 	tod = sampcut.gapfill_linear(cut, tod, inplace=False)
-	ft = fft.rfft(tod) * tod.shape[1]**-0.5
+	if noise_tod is None: noise_tod = tod
+	else: noise_tod = sampcut.gapfill_linear(cut, noise_tod, inplace=False)
+	ft = fft.rfft(noise_tod) * tod.shape[1]**-0.5
+	del noise_tod
 	iN = nmat_measure.detvecs_jon(ft, srate)
 	del ft
 	iV = iN.ivar*mask_scale
@@ -84,9 +94,15 @@ def calc_model_constrained(tod, cut, srate=400, mask_scale=0.3, lim=3e-4, maxite
 		Ax  = iN.apply(x.copy())
 		Ax += sampcut.gapfill_const(cut, x*iV[:,None], 0, inplace=True)
 		return Ax.reshape(-1)
+	# Preconditioner (iN+iV)" ignoring the cut. iN" = iD + iV iE iV' per bin, and
+	# our iV is diagonal, so it can be added to iD to get another detvecs matrix.
+	# Its apply() then applies (iN+iV)", which handles the correlated noise too.
+	prec = nmat.NmatDetvecs(iN.iD + iV[None,:], iN.iV, iN.iE, iN.bins, iN.ebins, iN.dets)
+	def M(x):
+		return prec.apply(x.reshape(tod.shape).copy()).reshape(-1)
 	b  = sampcut.gapfill_const(cut, tod*iV[:,None], 0, inplace=True).reshape(-1)
 	x0 = sampcut.gapfill_linear(cut, tod).reshape(-1)
-	solver = cg.CG(A, b, x0)
+	solver = cg.CG(A, b, x0, M=M)
 	while solver.i < maxiter and solver.err > lim:
 		solver.step()
 		if verbose:
@@ -95,7 +111,53 @@ def calc_model_constrained(tod, cut, srate=400, mask_scale=0.3, lim=3e-4, maxite
 	res = smooth(res, srate)
 	return res
 
+def project_rhs_div(pmap, scan, tod, ivar, rhs, div, bsize=32):
+	"""Accumulate rhs[ncomp,ny,nx] and div[ncomp,ncomp,ny,nx] for the given tod
+	and detector weights in a single pass over the pointing, instead of one
+	backward projection for rhs and ncomp forward and backward pairs for div.
+	Cut samples and samples outside the map are skipped."""
+	ncomp  = rhs.shape[0]
+	rflat  = rhs.reshape(ncomp,-1)
+	dflat  = div.reshape(ncomp,ncomp,-1)
+	for d1, d2, upix, inv, ok, ph in pixblocks.pixel_blocks(pmap, scan, rhs.shape, rhs.wcs, bsize):
+		w    = np.broadcast_to(ivar[d1:d2,None], ok.shape)[ok]
+		v    = tod[d1:d2][ok]*w
+		for i in range(ncomp):
+			rflat[i,upix] += np.bincount(inv, v*ph[:,i], minlength=len(upix))
+			for j in range(i, ncomp):
+				dij = np.bincount(inv, w*ph[:,i]*ph[:,j], minlength=len(upix))
+				dflat[i,j,upix] += dij
+				if j != i: dflat[j,i,upix] += dij
+
+# Unless --fits is passed, the per-tod maps are written to one hdf file per
+# task, with a group per tod containing map, rhs and div. The wcs is the same
+# for all of them, and is stored as a file attribute. planet_map2fits.py reads
+# these, and converts them to the --fits layout.
+def get_container_name(prefix, rank):
+	return "%splanet_maps_%03d.hdf" % (prefix, rank)
+
+def read_container_ids(prefix):
+	ids = set()
+	for fname in glob.glob(prefix + "planet_maps_*.hdf"):
+		with h5py.File(fname, "r") as hfile:
+			ids |= set(hfile.keys())
+	return ids
+
+def write_container(fname, bid, map, rhs, div, **attrs):
+	with h5py.File(fname, "a") as hfile:
+		if "wcs" not in hfile.attrs:
+			hfile.attrs["wcs"] = map.wcs.to_header_string()
+		if bid in hfile: del hfile[bid]
+		group = hfile.create_group(bid)
+		group["map"] = map
+		group["rhs"] = rhs
+		group["div"] = div
+		for key in attrs:
+			group.attrs[key] = attrs[key]
+
 calc_model = {"joneig": calc_model_joneig, "constrained": calc_model_constrained}[args.model]
+done_ids   = read_container_ids(prefix) if args.cont and not args.fits else set()
+cname      = get_container_name(prefix, comm.rank)
 
 for ind in range(comm.rank, len(ids), comm.size):
 	id    = ids[ind]
@@ -103,7 +165,7 @@ for ind in range(comm.rank, len(ids), comm.size):
 	entry = filedb.data[id]
 	if args.tags: entry.tag = args.tags
 	oname = "%s%s_map.fits" % (prefix, bid)
-	if args.cont and os.path.isfile(oname):
+	if args.cont and (os.path.isfile(oname) if args.fits else bid in done_ids):
 		print("Skipping %s (already done)" % (id))
 		continue
 	# Read the tod as usual
@@ -148,10 +210,8 @@ for ind in range(comm.rank, len(ids), comm.size):
 		scan = actscan.ACTScan(entry, d=d)
 	with bench.show("pmat"):
 		pmap = pmat.PmatMap(scan, area, sys=sys)
-		pcut = pmat.PmatCut(scan)
 		rhs  = enmap.zeros((ncomp,)+shape, wcs, dtype)
 		div  = enmap.zeros((ncomp,ncomp)+shape, wcs, dtype)
-		junk = np.zeros(pcut.njunk, dtype)
 	# Generate planet cut
 	with bench.show("planet cut"):
 		planet_cut = cuts.avoidance_cut(d.boresight, d.point_offset, d.site,
@@ -162,29 +222,27 @@ for ind in range(comm.rank, len(ids), comm.size):
 			pmap.forward(tod, area)
 	# Compute atmospheric model
 	with bench.show("atm model"):
-		model  = calc_model(tod, planet_cut, d.srate)
-	if args.sim and args.noiseless:
-		model -= calc_model(tod_orig, planet_cut, d.srate)
-		tod   -= tod_orig
-		del tod_orig
+		if args.sim and args.noiseless and args.model == "constrained":
+			# The constrained model is linear, so the model of the noiseless
+			# sim is just the model of the difference, with the noise model
+			# from the real data. This replaces a second full solve.
+			tod   -= tod_orig
+			model  = calc_model(tod, planet_cut, d.srate, noise_tod=tod_orig)
+			del tod_orig
+		else:
+			model  = calc_model(tod, planet_cut, d.srate)
+			if args.sim and args.noiseless:
+				model -= calc_model(tod_orig, planet_cut, d.srate)
+				tod   -= tod_orig
+				del tod_orig
 	with bench.show("atm subtract"):
 		tod -= model
 		del model
 		tod  = tod.astype(dtype, copy=False)
 	# Should now be reasonably clean of correlated noise.
 	# Proceed to make simple binned map
-	with bench.show("rhs"):
-		tod *= ivar[:,None]
-		pcut.backward(tod, junk)
-		pmap.backward(tod, rhs)
-	with bench.show("hits"):
-		for i in range(ncomp):
-			div[i,i] = 1
-			pmap.forward(tod, div[i])
-			tod *= ivar[:,None]
-			pcut.backward(tod, junk)
-			div[i] = 0
-			pmap.backward(tod, div[i])
+	with bench.show("rhs div"):
+		project_rhs_div(pmap, scan, tod, ivar, rhs, div, bsize=args.bsize)
 	with bench.show("map"):
 		idiv = array_ops.eigpow(div, -1, axes=[0,1], lim=1e-5, fallback="scalar")
 		map  = enmap.map_mul(idiv, rhs)
@@ -196,7 +254,10 @@ for ind in range(comm.rank, len(ids), comm.size):
 	amp   = np.max(mcent)
 	print("%s amp %7.3f asens %7.3f" % (id, amp/1e6, asens))
 	with bench.show("write"):
-		enmap.write_map("%s%s_map.fits" % (prefix, bid), map)
-		enmap.write_map("%s%s_rhs.fits" % (prefix, bid), rhs)
-		enmap.write_map("%s%s_div.fits" % (prefix, bid), div)
-	del d, scan, pmap, pcut, tod, map, rhs, div, idiv, junk
+		if args.fits:
+			enmap.write_map("%s%s_map.fits" % (prefix, bid), map)
+			enmap.write_map("%s%s_rhs.fits" % (prefix, bid), rhs)
+			enmap.write_map("%s%s_div.fits" % (prefix, bid), div)
+		else:
+			write_container(cname, bid, map, rhs, div, amp=amp, asens=asens)
+	del d, scan, pmap, tod, map, rhs, div, idiv
@@ -0,0 +1,37 @@
+# Convert the per-task planet_maps_RRR.hdf containers written by planet_map.py
+# into the separate <prefix><id>_map/rhs/div.fits files it writes with --fits,
+# for tools that expect those. read_container can also be imported to read
+# the containers directly.
+from __future__ import division, print_function
+import numpy as np, glob, os, h5py
+from astropy.io import fits
+from astropy import wcs as awcs
+from enlib import enmap
+
+def read_container(fname, bids=None):
+	"""Iterate over the tods in the planet_map container fname, yielding
+	bid, map, rhs, div, attrs for each. If bids is given, only those are read."""
+	with h5py.File(fname, "r") as hfile:
+		wcs = awcs.WCS(fits.Header.fromstring(hfile.attrs["wcs"]))
+		for bid in sorted(hfile.keys()):
+			if bids is not None and bid not in bids: continue
+			group = hfile[bid]
+			maps  = [enmap.enmap(group[name][()], wcs) for name in ["map","rhs","div"]]
+			yield (bid,) + tuple(maps) + (dict(group.attrs),)
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument("prefix", help="The output prefix planet_map.py used, i.e. odir/ or odir/tag_")
+	parser.add_argument("oprefix", nargs="?", default=None, help="Prefix of the fits files to write. Defaults to prefix")
+	parser.add_argument("--ids", type=str, default=None, help="Comma-separated list of tod ids to convert. Defaults to all")
+	parser.add_argument("-c", "--cont", action="store_true")
+	args = parser.parse_args()
+	oprefix = args.oprefix or args.prefix
+	bids    = set([id.replace(":","_") for id in args.ids.split(",")]) if args.ids else None
+	for fname in sorted(glob.glob(args.prefix + "planet_maps_*.hdf")):
+		for bid, map, rhs, div, attrs in read_container(fname, bids):
+			if args.cont and os.path.isfile("%s%s_map.fits" % (oprefix, bid)): continue
+			for name, m in [("map",map),("rhs",rhs),("div",div)]:
+				enmap.write_map("%s%s_%s.fits" % (oprefix, bid, name), m)
+			print("%s amp %7.3f asens %7.3f" % (bid, attrs.get("amp",np.nan)/1e6, attrs.get("asens",np.nan)))
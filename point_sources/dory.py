@@ -42,6 +42,8 @@ parser.add_argument("-b", "--beam",    type=str,   default="1.4",help="The beam
 parser.add_argument("-f", "--freq",    type=float, default=150,  help="The observing frequency in GHz. Only matters for flux calculations.")
 parser.add_argument("-R", "--regions", type=str,   default=None, help="Which regions to consider to have comogeneous noise correlations. 'full': Use whole map, 'tile:npix': split map into npix*npix sized tiles. Or specify the file name to a ds9 region file containing boxes.")
 parser.add_argument(      "--rsplit",  type=int,   default=0,  help="Split regions into sub-regions of this size")
+parser.add_argument(      "--autosplit",     type=int, default=0, help="Split the regions into overlapping sub-tiles until there are at least this many per mpi task, so that single large regions are also parallelized. Each sub-tile gets its own noise model, so this can change the results. 0 (default) to disable.")
+parser.add_argument(      "--autosplit-min", type=int, default=None, help="Don't make sub-tiles smaller than this many pixels. Defaults to 4 times --pad.")
 parser.add_argument("-a", "--apod",    type=int,   default=30, help="The width of the apodization region, in pixels.")
 parser.add_argument("--apod-margin",   type=int,   default=10, help="How far away from the apod region a source should be to be valid.")
 parser.add_argument("-s", "--nsigma",  type=float, default=None, help="The number a sigma a source must be to be included. Defaults to 3.5 when finding sources and None when fitting and subtracting")
@@ -78,6 +80,41 @@ regions    = dory.get_regions(args.regions, shape, wcs)
 if args.rsplit:
 	regions = dory.split_regions(regions, args.rsplit)
 
+def autosplit_regions(regions, nmin, minsize):
+	"""Split the largest regions in half along their longest axis until we have
+	at least nmin regions or they would become smaller than minsize pixels. Returns
+	the new regions and their ownership boxes. A sub-tile only reports the sources
+	inside its ownership box, so sources in the overlaps are counted exactly once.
+	Unsplit regions own everything, as before."""
+	regions = [np.sort(np.array(reg),0) for reg in regions]
+	owners  = [np.array([[-np.inf,-np.inf],[np.inf,np.inf]]) for reg in regions]
+	while len(regions) < nmin:
+		sizes = [np.max(reg[1]-reg[0]) for reg in regions]
+		i     = int(np.argmax(sizes))
+		if sizes[i] < 2*minsize: break
+		reg, own = regions[i], owners[i]
+		ax    = np.argmax(reg[1]-reg[0])
+		mid   = (reg[0,ax]+reg[1,ax])//2
+		r1, r2, o1, o2 = reg.copy(), reg.copy(), own.copy(), own.copy()
+		r1[1,ax] = o1[1,ax] = mid
+		r2[0,ax] = o2[0,ax] = mid
+		regions[i:i+1] = [r1,r2]
+		owners [i:i+1] = [o1,o2]
+	return regions, owners
+
+def select_owned(cat, owner):
+	"""Return the subset of cat whose pixel centers are inside the ownership box owner"""
+	if len(cat) == 0 or np.all(np.isinf(owner)): return cat
+	pix  = enmap.sky2pix(shape, wcs, [cat.dec, cat.ra])
+	good = np.all((pix >= owner[0][:,None]-0.5) & (pix < owner[1][:,None]-0.5),0)
+	return cat[good]
+
+if args.autosplit:
+	minsize = args.autosplit_min if args.autosplit_min is not None else 4*args.pad
+	regions, owners = autosplit_regions(regions, args.autosplit*comm.size, minsize)
+else:
+	owners  = [np.array([[-np.inf,-np.inf],[np.inf,np.inf]]) for reg in regions]
+
 def divdiag(div):
 	if   div.ndim == 2: return div.preflat
 	elif div.ndim == 3: return div
@@ -98,8 +135,8 @@ if args.mode == "find":
 	map_keys = ["map","snmap","model","resid","resid_snmap"]
 	utils.mkdir(args.odir)
 	write_args(args.odir + "/args.txt")
-	# Mpi-parallelization over regions is simple, but a bit lazy. It means that there will be
-	# no speedup for single-region maps
+	# Mpi-parallelization is over regions. Large regions are split into overlapping
+	# sub-tiles by autosplit_regions when --autosplit is given, so that single-region maps also get a speedup
 	for ri in range(comm.rank, len(regions), comm.size):
 		reg_fid = regions[ri]
 		reg_pad = dory.pad_region(reg_fid, args.pad)
@@ -125,6 +162,8 @@ if args.mode == "find":
 			# FIXME: artifacts are act-specific
 			if args.prune:
 				result = dory.prune_artifacts(result)
+			# Leave sources in the overlap with other sub-tiles to them
+			result.cat = select_owned(result.cat, owners[ri])
 		except Exception as e:
 			print("Exception for task %d region %d: %s" % (comm.rank, ri, str(e)))
 			raise
@@ -230,6 +269,7 @@ elif args.mode == "fit":
 			# that this object is part of a source, even if its own amplitude might be
 			# negative due to trying to fit an extended source or similar.
 			reg_cat.status= 1 + (local_amps < 0)
+			reg_cat = select_owned(reg_cat, owners[ri])
 			# Sort by S/N catalog order
 			reg_cat = reg_cat[np.argsort(reg_cat.amp[:,0]/reg_cat.damp[:,0])[::-1]]
 			# Write region output
@@ -1,7 +1,6 @@
 import numpy as np, argparse, sys, itertools, os, errno
 from enlib import enmap, powspec, utils, fft, array_ops, gibbs, log
 from enlib.degrees_of_freedom import DOF
-from enlib.cg import CG
 from scipy import ndimage
 parser = argparse.ArgumentParser()
 parser.add_argument("map")
@@ -18,6 +17,9 @@ parser.add_argument("--mindist", type=int, default=2)
 parser.add_argument("--nmax", type=int, default=350)
 parser.add_argument("--noise-max", type=float, default=1e5)
 parser.add_argument("--nocrop", action="store_true")
+parser.add_argument("--nsim", type=int, default=2)
+parser.add_argument("--sim-block", type=int, default=0, help="Number of simulations to solve together with block CG. 0 for all")
+parser.add_argument("--nmin", type=int, default=50, help="Minimum number of CG iterations per solve")
 args = parser.parse_args()
 
 log_level = log.verbosity2level(args.verbose+1)
@@ -57,7 +59,7 @@ map[np.isnan(map)] = 0
 L.info("Removing extreme outliers above 1e6")
 map = np.minimum(1e6,np.maximum(-1e6,map))
 
-nmin = 50
+nmin = args.nmin
 #cut = 0x100
 #map = map[:,h/2-cut:h/2+cut,w/2-cut:w/2+cut]
 #inoise = inoise[:,:,h/2-cut:h/2+cut,w/2-cut:w/2+cut]
@@ -100,51 +102,75 @@ enmap.write_map(args.odir + "/map_apod.fits", map)
 def mul(mat, vec, axes=[0,1]):
 	return enmap.samewcs(array_ops.matmul(mat.astype(vec.dtype),vec,axes=axes),mat,vec)
 def pow(mat, exp, axes=[0,1]): return enmap.samewcs(array_ops.eigpow(mat,exp,axes=axes),mat,exp)
+def mulv(mat, vec):
+	"""Like mul, but broadcasts over any extra leading dimensions of vec"""
+	return enmap.samewcs(np.einsum("abyx,...byx->...ayx",mat,vec),vec)
 
 class Trifilter:
 	"""Solves the equation (S+N+P)P"x = map, where S is the CMB noise covariance,
 	N is the noise covariance and P is the beam-point-source covariance.
-	This looks like a wiener filter. But is it?"""
+	This looks like a wiener filter. But is it?
+	(S+N+P)P" isn't symmetric, but S+N+P is, so we solve (S+N+P)y = map
+	with CG and then compute x = Py."""
 	def __init__(self, map, iP, S, noise):
 		self.map, self.iP, self.S, self.noise = map, iP, S, noise
-		# Construct preconditioner. This assumes constant noise
-		pixarea = map.area()/np.prod(map.shape[-2:])
-		ntyp = (np.median(inoise[inoise>np.max(inoise)*0.1])/pixarea)**-0.5
-		lmax = np.max(np.sum(map.lmap()**2,0)**0.5)+1
-		ps_ntyp = np.zeros(lmax)[None,None]+ntyp**2
-		Ntyp = enmap.spec2flat(map.shape, map.wcs, ps_ntyp, 1.0)
-		self.prec = pow(mul(S+Ntyp,iP)+1,-1)
-	def A(self, xmap):
-		#enmap.write_map(args.odir + "/A1.fits", xmap)
-		iPx   = mul(self.iP,enmap.map2harm(xmap))
-		#enmap.write_map(args.odir + "/A2.fits", iPx.real)
-		SiPx  = enmap.harm2map(mul(self.S, iPx))
-		#enmap.write_map(args.odir + "/A3.fits", SiPx)
-		NiPx  = mul(self.noise,enmap.harm2map(iPx))
-		#enmap.write_map(args.odir + "/A3.fits", NiPx)
-		res = xmap + SiPx + NiPx
-		#enmap.write_map(args.odir + "/A4.fits", res)
-		return res
-	def M(self, xmap):
-		#enmap.write_map(args.odir + "/M1.fits", xmap)
-		res = enmap.harm2map(mul(self.prec,enmap.map2harm(xmap)))
-		#enmap.write_map(args.odir + "/M2.fits", res)
-		return res
-	def solve(self, b, x0=None, verbose=False, nmin=0):
-		if x0 is None: x0 = b*0
-		def wrap(fun):
-			def foo(x):
-				xmap = enmap.samewcs(x.reshape(b.shape),b)
-				return fun(xmap).reshape(-1)
-			return foo
-		solver = CG(wrap(self.A), b.reshape(-1), x0=x0.reshape(-1), M=wrap(self.M))
-		#for i in range(50):
-		#while solver.err > 1e-6:
-		while solver.err > 1e-2 or solver.i < nmin:
-			solver.step()
+		self.P  = pow(iP,-1)
+		self.SP = S+self.P
+		# Construct preconditioner. This approximates the noise as white with
+		# the typical pixel variance. A constant pixel variance is also constant
+		# in harmonic space, so no unit conversion is needed.
+		nvar     = np.einsum("aayx->ayx", noise)
+		nvar_typ = np.median(nvar[nvar < np.min(nvar)*10])
+		self.prec = pow(self.SP + nvar_typ*np.eye(len(nvar))[:,:,None,None],-1)
+	def A(self, ymap):
+		return enmap.harm2map(mulv(self.SP,enmap.map2harm(ymap))) + mulv(self.noise,ymap)
+	def M(self, ymap):
+		return enmap.harm2map(mulv(self.prec,enmap.map2harm(ymap)))
+	def apply_harm(self, mat, xmap):
+		return enmap.harm2map(mulv(mat,enmap.map2harm(xmap)))
+	def solve(self, b, x0=None, verbose=False, nmin=0, tol=1e-2):
+		"""Solve for b[ncomp,ny,nx], or for several right hand sides b[nrhs,ncomp,ny,nx]
+		at once using block CG, where all the right hand sides share the same
+		Krylov space. x0 is an optional starting point for x with the same shape as b.
+		Convergence is always measured relative to the residual for x = 0, so a
+		good starting point saves iterations. nmin is not enforced when x0 is given."""
+		single = b.ndim == 3
+		if single:
+			b  = b[None]
+			x0 = x0[None] if x0 is not None else None
+		n = len(b)
+		def dot(a, c): return a.reshape(n,-1).dot(c.reshape(n,-1).T)
+		def comb(a, coeffs): return enmap.samewcs(np.einsum("i...,ij->j...", a, coeffs), b)
+		if x0 is None:
+			y = b*0
+			r = b.copy()
+		else:
+			y = self.apply_harm(self.iP, x0)
+			r = b - self.A(y)
+			nmin = 0
+		z   = self.M(r)
+		p   = z
+		rz  = dot(r,z)
+		rz0 = np.diag(rz).copy() if x0 is None else np.diag(dot(b,self.M(b)))
+		i, err = 0, np.max(np.diag(rz)/rz0)
+		while err > tol or i < nmin:
+			# lstsq instead of solve keeps the block coefficients stable if some
+			# of the right hand sides converge before the others
+			q     = self.A(p)
+			alpha = np.linalg.lstsq(dot(p,q), rz, rcond=None)[0]
+			y    += comb(p, alpha)
+			r    -= comb(q, alpha)
+			z     = self.M(r)
+			rz_new= dot(r,z)
+			beta  = np.linalg.lstsq(rz, rz_new, rcond=None)[0]
+			p     = z + comb(p, beta)
+			rz    = rz_new
+			i    += 1
+			err   = np.max(np.diag(rz)/rz0)
 			if verbose:
-				print "%5d %15.7e %15.7e" % (solver.i, solver.err, solver.err_true)
-		return enmap.samewcs(solver.x.reshape(b.shape),b)
+				print "%5d %15.7e" % (i, err)
+		x = self.apply_harm(self.P, y)
+		return x[0] if single else x
 
 # Try solving
 trifilter = Trifilter(map, iP, S, N)
@@ -153,18 +179,28 @@ pmap = trifilter.solve(map, verbose=args.verbose, nmin=nmin)
 L.info("Writing pmap")
 enmap.write_map(args.odir+"/pmap.fits",pmap[0])
 
-# Estimate uncertainty with a couple of other realizations
+# Estimate uncertainty with a couple of other realizations. These all
+# share the same system, so solve them in blocks. The sims are independent
+# of each other and of the data, so earlier solutions are no use as a
+# starting point.
 varmap = inoise*0
-nsim = 2
-for i in range(nsim):
-	L.info("Filtering sim %d" % i)
-	r = enmap.rand_gauss(map.shape, map.wcs)*(inoise+np.max(inoise)*1e-4)[0]**-0.5
-	c = enmap.rand_map(map.shape, map.wcs, ps_cmb)
-	sim = r+c
-	sim_flt = trifilter.solve(sim, verbose=args.verbose, nmin=nmin)
-	enmap.write_map(args.odir+"/sim%d.fits" % i, sim[0])
-	enmap.write_map(args.odir+"/sim_flt%d.fits" % i, sim_flt[0])
-	varmap += sim_flt[None,:]*sim_flt[:,None]
+nsim   = args.nsim
+bsize  = args.sim_block or nsim
+for i1 in range(0, nsim, bsize):
+	i2 = min(i1+bsize, nsim)
+	L.info("Filtering sims %d:%d" % (i1,i2))
+	sims = []
+	for i in range(i1, i2):
+		r = enmap.rand_gauss(map.shape, map.wcs)*(inoise+np.max(inoise)*1e-4)[0]**-0.5
+		c = enmap.rand_map(map.shape, map.wcs, ps_cmb)
+		sims.append(r+c)
+	sims     = enmap.samewcs(np.array(sims), map)
+	sim_flts = trifilter.solve(sims, verbose=args.verbose, nmin=nmin)
+	for i, sim, sim_flt in zip(range(i1,i2), sims, sim_flts):
+		enmap.write_map(args.odir+"/sim%d.fits" % i, sim[0])
+		enmap.write_map(args.odir+"/sim_flt%d.fits" % i, sim_flt[0])
+		varmap += sim_flt[None,:]*sim_flt[:,None]
+	del sims, sim_flts
 varmap /= nsim
 
 L.info("Writing pstd_raw")
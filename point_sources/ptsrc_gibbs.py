@@ -21,6 +21,8 @@ parser.add_argument("-v", "--verbose", action="store_true")
 parser.add_argument("-i", type=int, default=0)
 parser.add_argument("--nmax", type=int, default=0)
 parser.add_argument("--mindist-group", type=float, default=10)
+parser.add_argument("--mindist-block", type=float, default=5, help="Sources further apart than this (in arcmin) have their shapes updated simultaneously. Only used with --nchain > 1")
+parser.add_argument("-C", "--nchain", type=int, default=1, help="Number of independent chains to run in lockstep per group. With more than one, the chain index is written as an extra last column of the sample files")
 parser.add_argument("-c", "--cont", action="store_true")
 args = parser.parse_args()
 
@@ -113,6 +115,20 @@ def build_groups(poss):
 groups = build_groups(poss)
 print "Found %d groups" % len(groups)
 
+# Within a group, sources that are far enough apart hardly affect each other's
+# likelihood, so their shapes can be updated at the same time. Split each group
+# into such blocks.
+def build_blocks(poss, mindist):
+	def dist(a,b): return np.sum((poss[a]-poss[b])**2)**0.5*180*60/np.pi
+	blocks = []
+	for i in range(len(poss)):
+		for block in blocks:
+			if all([dist(i,j) >= mindist for j in block]):
+				block.append(i)
+				break
+		else: blocks.append([i])
+	return [np.array(block) for block in blocks]
+
 # We will sample (cmb,A,pos,ibeam) jointly in gibbs fashion:
 #  cmb,A   <- P(cmb,A|data,A,pos,ibeam)   # direct, but requires cr
 #  pos,ibeam <- P(pos,ibeam|data,cmb,A)   # MCMC
@@ -196,6 +212,54 @@ class CMBSampler:
 		self.x = self.solve(self.b, self.x, verbose)
 		return self.dof.unzip(self.x)
 
+def mmul(mat, vec, ref):
+	"""Pixel-wise matrix product mat[...,a,b,y,x] vec[...,b,y,x], broadcasting
+	over the leading dimensions. The result gets the wcs of ref."""
+	return en.samewcs(np.einsum("...abyx,...byx->...ayx", mat, vec), ref)
+
+class CMBSamplerMulti(CMBSampler):
+	"""Like CMBSampler, but draws samples for nchain independent chains at once.
+	All quantities get an extra leading chain dimension, so that the harmonic
+	transforms are done for all chains in a single call. T[nchain,ntemp,nfreq,ncomp,ny,nx]
+	is the set of templates for each chain, and a[nchain,ntemp] the amplitudes."""
+	def __init__(self, maps, inoise, ps, nchain, T=None):
+		self.nchain = nchain
+		CMBSampler.__init__(self, maps, inoise, ps, T)
+	def set_template(self, T):
+		if T is None: T = np.zeros((self.nchain,0)+self.d.shape)
+		self.T   = T
+		self.TT  = np.einsum("caijyx,cbijyx->cab",self.T,self.T)
+		self.dof = DOF(Arg(default=self.stack(self.d[0])), Arg(shape=T.shape[:2]))
+	def stack(self, m):
+		return en.samewcs(np.repeat(m[None],self.nchain,0),self.d)
+	def P(self, u):
+		s, a = self.dof.unzip(u)
+		return en.samewcs(s[:,None,:,:,:] + np.einsum("ctfayx,ct->cfayx",self.T,a),self.d)
+	def PT(self, d):
+		return self.dof.zip(np.sum(d,1), np.einsum("ctfayx,cfayx->ct",self.T,d))
+	def A(self, u):
+		s, a = self.dof.unzip(u)
+		Uu   = self.dof.zip(en.harm2map(mmul(self.iS, en.map2harm(s), s)),a*0)
+		PNPu = self.PT(mmul(self.iN, self.P(u), self.d))
+		return Uu + PNPu
+	def M(self, u):
+		s, a = self.dof.unzip(u)
+		res_s = en.harm2map(mmul(self.S_prec, en.map2harm(s), s))
+		res_a = np.linalg.solve(self.TT, a[:,:,None])[:,:,0]
+		return self.dof.zip(res_s, res_a)
+	def calc_b(self):
+		shape = (self.nchain,)+self.d.shape
+		PNd   = self.PT(self.stack(mmul(self.iN, self.d, self.d)))
+		Uw1_s = en.harm2map(mmul(self.hS, en.rand_gauss_harm(shape[:1]+shape[-3:],self.d.wcs), self.d))
+		Uw1   = self.dof.zip(Uw1_s, np.zeros(self.T.shape[:2]))
+		PNw2  = self.PT(mmul(self.hN, en.rand_gauss(shape, self.d.wcs), self.d))
+		return PNd + Uw1 + PNw2
+	def sample(self, verbose=False):
+		self.b = self.calc_b()
+		if self.x is None: self.x = self.dof.zip(self.stack(self.d[0]), np.zeros(self.T.shape[:2]))
+		self.x = self.solve(self.b, self.x, verbose)
+		return self.dof.unzip(self.x)
+
 class PtsrcModel:
 	"""This class converts from point source shape parameters to amplitude
 	basis functions."""
@@ -212,6 +276,23 @@ class PtsrcModel:
 		return profile[None,None,None]*bases[:,:,:,None,None]
 	def get_model(self, amps, pos, irads):
 		return np.sum((self.get_templates(pos, irads).T*amps.T).T,0)
+	def get_profiles(self, pos, irads):
+		"""Vectorized profile evaluation for pos[...,2] and irads[...,3]. Returns [...,ny,nx]"""
+		x   = utils.rewind(self.pos - pos[...,:,None,None],0,2*np.pi)
+		xWx = irads[...,0,None,None]*x[...,0,:,:]**2 + irads[...,1,None,None]*x[...,1,:,:]**2 + 2*irads[...,2,None,None]*x[...,0,:,:]*x[...,1,:,:]
+		return np.exp(-0.5*xWx)
+	def get_models(self, amps, pos, irads):
+		"""Vectorized get_model for amps[...,nparam]. Returns [...,nfreq,ncomp,ny,nx]"""
+		amps = amps.reshape(amps.shape[:-1]+(self.nfreq,self.ncomp))
+		return self.get_profiles(pos, irads)[...,None,None,:,:]*amps[...,None,None]
+	def get_templates_multi(self, pos, irads):
+		"""Vectorized get_templates for pos[nchain,nsrc,2], irads[nchain,nsrc,3].
+		Returns [nchain,nsrc*nparam,nfreq,ncomp,ny,nx], with the same ordering as
+		concatenating get_templates for each source."""
+		profile = self.get_profiles(pos, irads)
+		bases   = np.eye(self.nparam).reshape(self.nparam,self.nfreq,self.ncomp)
+		res     = profile[:,:,None,None,None]*bases[None,None,:,:,:,None,None]
+		return res.reshape((res.shape[0],-1)+res.shape[3:])
 
 class ShapeSampler:
 	def __init__(self, maps, inoise, model, amps, pos, pos0, irads, nsamp=200, stepsize=0.02, maxdist=1.5*np.pi/180/60):
@@ -270,6 +351,16 @@ class ShapeSampler:
 		for i in range(self.nsamp): self.subsample(verbose)
 		return self.amps, self.pos, self.irads
 
+def beam_ok(irads):
+	"""Vectorized version of the beam prior in ShapeSampler.getlik"""
+	C = np.array([[irads[...,0],irads[...,2]],[irads[...,2],irads[...,1]]])
+	C = np.rollaxis(np.rollaxis(C,0,C.ndim),0,C.ndim)
+	ok = (irads[...,0] >= 0) & (irads[...,1] >= 0) & (irads[...,0]*irads[...,1]-irads[...,2]**2 > 0)
+	E = np.linalg.eigvalsh(C)
+	sigma = np.where(ok[...,None], E, 1)**-0.5
+	smin, smax = np.min(sigma,-1), np.max(sigma,-1)
+	return ok & (smin >= beam_range[0]) & (smax <= beam_range[1]) & (smax/smin <= beam_max_asym)
+
 class ShapeSamplerMulti:
 	def __init__(self, maps, inoise, model, amps, pos, pos0, irads, nsamp=1500, stepsize=0.02, maxdist=1.5*np.pi/180/60):
 		self.samplers = [ShapeSampler(maps, inoise, model, amp1, pos1, pos01, irads1, nsamp=1, stepsize=stepsize, maxdist=maxdist) for amp1, pos1, pos01, irads1 in zip(amps, pos, pos0, irads)]
@@ -283,6 +374,64 @@ class ShapeSamplerMulti:
 		irads= np.array([s.irads for s in self.samplers])
 		return amps, pos, irads
 
+class ShapeSamplerChains:
+	"""Metropolis sampler for the shape parameters of several sources in several chains.
+	maps[nchain,nfreq,ncomp,ny,nx] should have the cmb subtracted. amps[nchain,nsrc,nparam],
+	pos[nchain,nsrc,2] and irads[nchain,nsrc,3] are the starting points. The likelihood
+	is evaluated with all the other sources subtracted. The sources in each block are
+	updated simultaneously for all chains, which assumes that they are far enough apart
+	that their models don't overlap."""
+	def __init__(self, maps, inoise, model, amps, pos, pos0, irads, blocks, nsamp=1500, stepsize=0.02, maxdist=1.5*np.pi/180/60):
+		self.inoise = inoise
+		self.model  = model
+		self.amps, self.pos, self.irads = amps.copy(), pos.copy(), irads.copy()
+		self.pos0   = pos0
+		self.blocks = blocks
+		self.nsamp  = nsamp
+		self.stepsize = stepsize
+		self.maxdist  = maxdist
+		self.resid  = maps - np.sum(model.get_models(self.amps, self.pos, self.irads),1)
+		self.chisq  = self.calc_chisq(self.resid)
+	def calc_chisq(self, resid):
+		return np.sum(np.einsum("fabyx,...fbyx->...fayx", self.inoise, resid)*resid,(-4,-3,-2,-1))
+	def calc_penalty(self, pos, pos0):
+		deviation = np.sum((pos-pos0)**2,-1)**0.5/self.maxdist
+		return 1+np.maximum(deviation-1,0)**2
+	def subsample(self, block, amps, pos, irads):
+		"""Propose the new parameters amps, pos, irads[nchain,nblock,:] for the sources in block,
+		and accept or reject each of them"""
+		pos0  = self.pos0[block]
+		old   = self.model.get_models(self.amps[:,block], self.pos[:,block], self.irads[:,block])
+		new   = self.model.get_models(amps, pos, irads)
+		delta = old-new
+		lik_old = 0.5*self.chisq[:,None]*self.calc_penalty(self.pos[:,block], pos0)
+		lik_new = 0.5*self.calc_chisq(self.resid[:,None]+delta)*self.calc_penalty(pos, pos0)
+		lik_new[~beam_ok(irads)] = np.inf
+		with utils.nowarn():
+			accept = np.random.uniform(size=lik_new.shape) < np.exp(lik_old-lik_new)
+		for arr, prop in [(self.amps,amps),(self.pos,pos),(self.irads,irads)]:
+			sub = arr[:,block]
+			sub[accept] = prop[accept]
+			arr[:,block] = sub
+		self.resid += np.sum(delta*accept[:,:,None,None,None,None],1)
+		self.chisq  = self.calc_chisq(self.resid)
+	def sample(self, verbose=False):
+		step = self.stepsize
+		for i in range(self.nsamp):
+			for block in self.blocks:
+				n = self.pos.shape[:1]+block.shape
+				a, p, r = [arr[:,block] for arr in [self.amps, self.pos, self.irads]]
+				self.subsample(block, a, p + np.random.standard_normal(n+(2,)) * beam_fiducial * step, r)
+				a, p, r = [arr[:,block] for arr in [self.amps, self.pos, self.irads]]
+				self.subsample(block, a, p, r + np.random.standard_normal(n+(3,)) * 1.0/beam_fiducial**2 * step * 0.5)
+				a, p, r = [arr[:,block] for arr in [self.amps, self.pos, self.irads]]
+				self.subsample(block, a + np.random.standard_normal(n+a.shape[-1:]) * 1000 * step, p, r)
+			if verbose:
+				for amps, pos, irads in zip(self.amps[0], self.pos[0], self.irads[0]):
+					sigma, phi = expand_beam(irads)
+					print (" %9.2f"*len(amps)+" %10.5f %10.5f %8.3f %8.3f %8.3f") % (tuple(amps)+tuple(pos*r2c)+tuple(sigma*r2b)+(phi*r2c,))
+		return self.amps, self.pos, self.irads
+
 class GibbsSampler:
 	def __init__(self, maps, inoise, ps, pos0, amp0, irads0, cmb0):
 		self.maps   = maps
@@ -304,26 +453,49 @@ class GibbsSampler:
 		return self.pos, self.amp, self.irads, self.cmb
 
 class GibbsSamplerMulti:
-	"""Like GibbsSampler, but samples multiple points jointly.
-	This means that the source amplitude parameters will be arrays."""
-	def __init__(self, maps, inoise, ps, pos0, amp0, irads0, cmb0):
+	"""Like GibbsSampler, but samples multiple points jointly, for nchain
+	independent chains in lockstep. The returned parameters have shape
+	pos[nchain,nsrc,2], amp[nchain,nsrc,nparam], irads[nchain,nsrc,3] and
+	cmb[nchain,ncomp,ny,nx]. With a single chain, the original per-source
+	ShapeSamplerMulti is used, so blocks are ignored and the results are the
+	same as before chains were introduced."""
+	def __init__(self, maps, inoise, ps, pos0, amp0, irads0, cmb0, nchain=1, blocks=None):
 		self.maps   = maps
 		self.inoise = inoise
 		self.ps     = ps
+		self.nchain = nchain
 		self.src_model = PtsrcModel(maps)
-		self.pos, self.amp, self.irads, self.cmb = pos0, amp0, irads0, cmb0
+		def stack(a): return np.repeat(np.asarray(a)[None],nchain,0)
+		self.pos, self.amp, self.irads, self.cmb = stack(pos0), stack(amp0), stack(irads0), stack(cmb0)
 		self.pos0 = pos0
-		self.cmb_sampler = CMBSampler(maps, inoise, ps)
+		self.blocks = blocks if blocks is not None else [np.array([i]) for i in range(len(pos0))]
+		if nchain == 1: self.cmb_sampler = CMBSampler(maps, inoise, ps)
+		else:           self.cmb_sampler = CMBSamplerMulti(maps, inoise, ps, nchain)
+	def sample_single(self, verbose=False):
+		pos, irads = self.pos[0], self.irads[0]
+		# First draw cmb,amp <- P(cmb,amp|data,pos,irads)
+		src_template = np.concatenate([self.src_model.get_templates(p, r) for p, r in zip(pos, irads)])
+		self.cmb_sampler.set_template(src_template)
+		cmb, amp = self.cmb_sampler.sample(verbose)
+		# Separate amps for each source
+		amp = amp.reshape(pos.shape[0],-1)
+		# Then draw pos,irads <- P(pos,irads|data,cmb,amp)
+		maps_nocmb = self.maps - cmb[None,:,:,:]
+		shape_sampler = ShapeSamplerMulti(maps_nocmb, self.inoise, self.src_model, amp, pos, self.pos0, irads)
+		amp, pos, irads = shape_sampler.sample(verbose)
+		self.pos, self.amp, self.irads, self.cmb = [a[None] for a in [pos, amp, irads, cmb]]
+		return self.pos, self.amp, self.irads, self.cmb
 	def sample(self, verbose=False):
+		if self.nchain == 1: return self.sample_single(verbose)
 		# First draw cmb,amp <- P(cmb,amp|data,pos,irads)
-		src_template = np.concatenate([self.src_model.get_templates(pos, irads) for pos,irads in zip(self.pos, self.irads)])
+		src_template = self.src_model.get_templates_multi(self.pos, self.irads)
 		self.cmb_sampler.set_template(src_template)
 		self.cmb, self.amp = self.cmb_sampler.sample(verbose)
 		# Separate amps for each source
-		self.amp = self.amp.reshape(self.pos.shape[0],-1)
+		self.amp = self.amp.reshape(self.pos.shape[:2]+(-1,))
 		# Then draw pos,irads <- P(pos,irads|data,cmb,amp)
-		maps_nocmb = self.maps - self.cmb[None,:,:,:]
-		shape_sampler = ShapeSamplerMulti(maps_nocmb, self.inoise, self.src_model, self.amp, self.pos, self.pos0, self.irads)
+		maps_nocmb = self.maps[None] - self.cmb[:,None,:,:,:]
+		shape_sampler = ShapeSamplerChains(maps_nocmb, self.inoise, self.src_model, self.amp, self.pos, self.pos0, self.irads, self.blocks)
 		self.amp, self.pos, self.irads = shape_sampler.sample(verbose)
 		return self.pos, self.amp, self.irads, self.cmb
 
@@ -400,26 +572,35 @@ for i in range(myid, len(groups), nproc):
 	irads    = np.tile(np.array([1/beam_fiducial**2,1/beam_fiducial**2,0]),(len(group),1))
 	amp      = np.zeros([len(group),ncomp*nfreq])
 	cmb      = submap[0]
-	sampler  = GibbsSamplerMulti(submap, subnoise, ps, pos0, amp, irads, cmb)
+	blocks   = build_blocks(pos0, args.mindist_block)
+	sampler  = GibbsSamplerMulti(submap, subnoise, ps, pos0, amp, irads, cmb, nchain=args.nchain, blocks=blocks)
+	# Each step produces one sample per chain
+	nstep    = (args.nsamp+args.nchain-1)//args.nchain
 	# Open ofiles
 	ofiles = [open(args.odir + "/samps%03d.txt" % j, "w") for j in group]
-	for j in xrange(-args.burnin, args.nsamp):
+	for j in xrange(-args.burnin, nstep):
 		pos, amp, irad, cmb = sampler.sample(args.verbose)
-		if j >= 0:
-			for mypos, myamp, myirad, ofile, isrc in zip(pos, amp, irad, ofiles,group):
+		if j < 0: continue
+		for ci in range(args.nchain):
+			isamp  = j*args.nchain+ci
+			mycmb  = en.samewcs(cmb[ci], submap)
+			for mypos, myamp, myirad, ofile, isrc in zip(pos[ci], amp[ci], irad[ci], ofiles,group):
 				sigma, phi = expand_beam(myirad)
 				mJ = uK2mJ(myamp,sigma[0],sigma[1])
-				print >> ofile, (" %10.5f"*2 + " %6.1f"*len(myamp) + "%8.3f %8.3f %8.3f" + " %6.2f"*len(mJ)) % (tuple(mypos*r2c)+tuple(myamp)+tuple(sigma*r2b)+(phi*r2c,)+tuple(mJ))
+				line = (" %10.5f"*2 + " %6.1f"*len(myamp) + "%8.3f %8.3f %8.3f" + " %6.2f"*len(mJ)) % (tuple(mypos*r2c)+tuple(myamp)+tuple(sigma*r2b)+(phi*r2c,)+tuple(mJ))
+				# The chains are interleaved, so tag each sample with its chain
+				if args.nchain > 1: line += " %3d" % ci
+				print >> ofile, line
 				ofile.flush()
-				if args.dump > 0 and j % args.dump == 0:
+				if args.dump > 0 and isamp % args.dump == 0:
 					dumpdir = args.odir + "/dump%03d" % isrc
 					utils.mkdir(dumpdir)
 					src = sampler.src_model.get_model(myamp, mypos, myirad)
-					residual = submap - src - cmb[None]
+					residual = submap - src - mycmb[None]
 					# Cut out our area
 					mybox = np.array([poss[isrc]-R,poss[isrc]+R])
-					mycmb, myres, mymod, mysub = [a.submap(mybox) for a in [cmb,residual,src,submap]]
-					en.write_map(dumpdir + "/cmb%03d.hdf" % j, mycmb)
-					en.write_map(dumpdir + "/residual%03d.hdf" % j, myres)
-					en.write_map(dumpdir + "/model%03d.hdf" % j, mymod)
+					subcmb, myres, mymod, mysub = [a.submap(mybox) for a in [mycmb,residual,src,submap]]
+					en.write_map(dumpdir + "/cmb%03d.hdf" % isamp, subcmb)
+					en.write_map(dumpdir + "/residual%03d.hdf" % isamp, myres)
+					en.write_map(dumpdir + "/model%03d.hdf" % isamp, mymod)
 					en.write_map(dumpdir + "/submap.hdf", mysub)
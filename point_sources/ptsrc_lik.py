@@ -1,4 +1,4 @@
-import numpy as np, argparse, os, time, sys
+import numpy as np, argparse, os, time, sys, errno, shutil, glob
 from astropy.io import fits
 from astropy import table
 from enlib import enmap, utils, powspec, jointmap, bunch, mpi, memory
@@ -150,10 +150,10 @@ def write_padtile(ofile, map):
 
 def output_tile(prefix, tpos, info):
 	shape = info.model.shape[-2:]
-	tname = "tile%(y)03d_%(x)03d.fits" % {"y":tpos,"x":tpos[1]}
+	tname = "tile%(y)03d_%(x)03d.fits" % {"y":tpos[0],"x":tpos[1]}
 	ffpad_slice = (Ellipsis,slice(0,shape[0]-info.ffpad[0]),slice(0,shape[1]-info.ffpad[1]))
 	for maptypename, mapgroup in [("snmap",info.snmaps),("snresid",info.snresid)]:
-		for srctypename, map in mapgroups:
+		for srctypename, map in mapgroup:
 			write_padtile("%s%s_%s/%s" % (prefix, srctypename, maptypename, tname), map[ffpad_slice])
 	if not args.output_full_model:
 		if len(info.model) > 0: model = info.model[0]
@@ -168,6 +168,46 @@ def output_tile(prefix, tpos, info):
 	box        = enmap.box(shape, wcs)
 	jointmap.write_catalogue(prefix + "catalogue" + tname, info.catalogue, box)
 
+# Tile costs vary a lot, from empty tiles to deep ones crowded with sources,
+# so instead of a static assignment each task claims the most expensive
+# remaining tile whenever it's free. Tiles are claimed by atomically creating
+# a file in a claim directory specific to this run, so that other jobs in the
+# same output directory are not affected. The costs are estimated from previous
+# timings where available, and otherwise from how many datasets hit the tile.
+# Each task records its timings in its own file to avoid concurrent appends.
+def read_tile_times(prefix):
+	res = {}
+	# Later runs override earlier ones. The run ids start with the start time
+	for fname in [prefix + "tile_times.txt"] + sorted(glob.glob(prefix + "tile_times_*.txt")):
+		try:
+			with open(fname, "r") as ifile:
+				for line in ifile:
+					toks = line.split()
+					if len(toks) < 3: continue
+					res[(int(toks[0]),int(toks[1]))] = float(toks[2])
+		except IOError: pass
+	return res
+
+def estimate_tile_costs(tyx, tboxes, times):
+	hits  = np.array([sum([overlaps_any(box, boxes[i:i+1]) for i in range(len(boxes))]) for box in tboxes], float)
+	known = np.array([tuple(t) in times for t in tyx], bool)
+	costs = hits.copy()
+	if np.any(known):
+		tknown = np.array([times[tuple(t)] for t, k in zip(tyx, known) if k])
+		good   = hits[known] > 0
+		scale  = np.median(tknown[good]/hits[known][good]) if np.any(good) else 1
+		costs *= scale
+		costs[known] = tknown
+	return costs
+
+def claim_tile(claim_dir, tpos):
+	try: fd = os.open(claim_dir + "/%03d_%03d" % tuple(tpos), os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+	except OSError as e:
+		if e.errno == errno.EEXIST: return False
+		raise
+	os.close(fd)
+	return True
+
 # We have two modes, depending on what args.area is.
 # 1. area is an enmap. Will loop over tiles in that area, and output padded tiles
 #    to output directory
@@ -181,32 +221,45 @@ if bounds is None:
 	tshape = np.array([args.tsize,args.tsize])
 	ntile  = np.floor((shape[-2:]+tshape-1)/tshape).astype(int)
 	tyx    = [(y,x) for y in range(ntile[0]-1,-1,-1) for x in range(ntile[1])]
-	for i in range(comm.rank, len(tyx), comm.size):
+	if debug_tile is not None:
+		tyx = [t for t in tyx if t[0] == debug_tile[0] and t[1] == debug_tile[1]]
+	tboxes = [enmap.pix2sky(shape, wcs, np.array([np.array(t)*tshape,np.minimum((np.array(t)+1)*tshape,shape[-2:])]).T).T for t in tyx]
+	prefix = args.odir + "/"
+	costs  = estimate_tile_costs(tyx, tboxes, read_tile_times(prefix))
+	order  = np.argsort(-costs, kind="mergesort")
+	run_id = comm.bcast("%010.0f_%d" % (time.time(), os.getpid()))
+	tfile  = prefix + "tile_times_%s_%03d.txt" % (run_id, comm.rank)
+	claim_dir = prefix + "claims/" + run_id
+	if comm.rank == 0: utils.mkdir(claim_dir)
+	comm.Barrier()
+	for i in order:
 		y, x = tyx[i]
-		if debug_tile is not None and not (y == debug_tile[0] and x == debug_tile[1]):
-			continue
-		prefix  = args.odir + "/"
-		if args.cont and os.path.isfile(prefix + "catalogue.fits"):
+		if not claim_tile(claim_dir, (y,x)): continue
+		if args.cont and os.path.isfile(prefix + "catalogue" + "tile%03d_%03d.fits" % (y,x)):
 			if verbosity >= 1:
 				print "%3d skipping %3d %3d (already done)" % (comm.rank, y, x)
 			continue
 		if verbosity >= 1:
-			print "%3d processing %3d %3d" % (comm.rank, y, x)
+			print "%3d processing %3d %3d est %7.1f" % (comm.rank, y, x, costs[i])
 		sys.stdout.flush()
 		t1   = time.time()
-		tpos = np.array(tyx[i])
-		pbox = np.array([tpos*tshape,np.minimum((tpos+1)*tshape,shape[-2:])])
-		box  = enmap.pix2sky(shape, wcs, pbox.T).T
 		try:
-			info = eval_tile(mapinfo, box, signals, verbosity=verbosity)
-			output_tile(prefix, [y,x], info)
+			info = eval_tile(mapinfo, tboxes[i], signals, verbosity=verbosity)
+			# Results are written as soon as each tile is done
+			if info is not None: output_tile(prefix, [y,x], info)
 		#except (np.linalg.LinAlgError, MemoryError) as e:
 		except Exception as e:
 			print "%3d error while processing %3d %3d: '%s'. Skipping" % (comm.rank, y, x, str(e))
 			continue
 		t2   = time.time()
+		# Record the timing for scheduling future runs
+		with open(tfile, "a") as ofile:
+			ofile.write("%3d %3d %9.2f\n" % (y, x, t2-t1))
 		if verbosity >= 1:
 			print "%3d processed %3d %3d in %7.1f max-mem %7.3f" % (comm.rank, y, x, t2-t1, memory.max()/1024.**3)
+	# Our claims are only meaningful while we're running
+	comm.Barrier()
+	if comm.rank == 0: shutil.rmtree(claim_dir, ignore_errors=True)
 else:
 	# Single arbitrary tile
 	if not overlaps_any(bounds, boxes):
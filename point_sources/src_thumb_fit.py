@@ -213,14 +213,17 @@ class DposTransFoc:
 				sdat.el ]
 		self.ref_foc = cel2foc(self.ref_cel, self.site, self.mjd, self.bore)
 	def foc2cel(self, dfoc):
-		foc = self.ref_foc + dfoc
+		# Broadcast our references against dfoc[{x,y},...]
+		bcast= (slice(None),)+(None,)*(np.ndim(dfoc)-1)
+		foc = self.ref_foc[bcast] + dfoc
 		cel = foc2cel(foc, self.site, self.mjd, self.bore)
-		dcel = utils.rewind(cel-self.ref_cel)
+		dcel = utils.rewind(cel-self.ref_cel[bcast])
 		return dcel
 	def cel2foc(self, dcel):
-		cel = self.ref_cel + dcel
+		bcast= (slice(None),)+(None,)*(np.ndim(dcel)-1)
+		cel = self.ref_cel[bcast] + dcel
 		foc = cel2foc(cel, self.site, self.mjd, self.bore)
-		dfoc = utils.rewind(foc-self.ref_foc)
+		dfoc = utils.rewind(foc-self.ref_foc[bcast])
 		return dfoc
 
 class SrclikMulti:
@@ -263,11 +266,118 @@ class SrclikMulti:
 			res.marg  += penalty
 		return res
 
+class SrclikFFT:
+	"""Batched version of SrclikMulti. For a single source the chisquare improvement
+	at profile position p is rho(p)**2/kappa(p), with rho(p) = sum_x B(x-p) div(x) map(x)
+	and kappa(p) = sum_x B(x-p)**2 div(x). Since the beam is translation invariant in
+	each thumbnail's pixels, rho and kappa for every trial position are fft-based
+	cross-correlations. Their spectral derivatives give the analytic gradient and
+	hessian. Off-pixel positions are found by spline interpolation. The correlations
+	are periodic on the padded grid, so they are extended periodically by npad pixels
+	on each side and spline filtered once here rather than on every lookup. The
+	padding keeps the edge effects of the non-periodic spline filter below 1e-6."""
+	def __init__(self, lik, order=3):
+		self.lik   = lik
+		self.order = order
+		self.npad  = 4*order
+		self.comps = []
+		for l in lik.liks:
+			m, div = l.map, l.div
+			ny, nx = m.shape[-2:]
+			N      = (2*ny, 2*nx)
+			# Beam kernel for offsets relative to the central pixel, wrapped so that
+			# zero offset is at index 0 of the padded grid
+			c      = np.array([ny//2, nx//2])
+			rvec   = m.posmap()[::-1] - m.pix2sky(c)[::-1,None,None]
+			kern   = np.zeros(N)
+			kern[:ny,:nx] = l.beam.eval(rvec)
+			kern   = np.roll(np.roll(kern, -c[0], 0), -c[1], 1)
+			def pad(a):
+				res = np.zeros(N)
+				res[:ny,:nx] = a
+				return res
+			# Cross-correlations and their first and second derivatives wrt. the
+			# profile position, in pixel units: [{rho,kappa},{f,fy,fx,fyy,fyx,fxx},2ny,2nx]
+			ky  = 2*np.pi*np.fft.fftfreq(N[0])[:,None]
+			kx  = 2*np.pi*np.fft.fftfreq(N[1])[None,:]
+			ops = [1, 1j*ky, 1j*kx, -ky**2, -ky*kx, -kx**2]
+			comps = np.zeros((2,6)+N)
+			for i, (a, b) in enumerate([(kern, div*m), (kern**2, div)]):
+				fa = np.conj(np.fft.fft2(a))*np.fft.fft2(pad(b))
+				for j, op in enumerate(ops):
+					comps[i,j] = np.fft.ifft2(fa*op).real
+			# Prefilter for fast lookups
+			self.comps.append(np.array([[ndimage.spline_filter(np.pad(c, self.npad, mode="wrap"), order=order)
+				for c in cs] for cs in comps]))
+	def calc_pix(self, dpos):
+		"""Get the pixel positions [{y,x},...] in each thumbnail for the focalplane
+		offsets dpos[{x,y},...]"""
+		res = []
+		for l, trf, s in zip(self.lik.liks, self.lik.trfs, self.lik.sdata):
+			dcel = trf.foc2cel(dpos)
+			pos  = s.srcpos[(slice(None),)+(None,)*(dcel.ndim-1)] + dcel
+			res.append(l.map.sky2pix(pos[::-1]))
+		return res
+	def interpol(self, comps, pix):
+		N    = np.array(comps.shape[-2:])-2*self.npad
+		pix  = np.asarray(pix) % N[(slice(None),)+(None,)*(pix.ndim-1)] + self.npad
+		ishape = comps.shape[:-2]
+		comps  = comps.reshape((-1,)+comps.shape[-2:])
+		res  = np.array([ndimage.map_coordinates(c, pix, order=self.order, mode="nearest", prefilter=False) for c in comps])
+		return res.reshape(ishape+pix.shape[1:])
+	def eval_grid(self, dpos):
+		"""Evaluate the chisquare improvement and amplitudes for all the focalplane
+		offsets dpos[{x,y},...] at once. Returns dchisq[...], amps[nsrc,...]"""
+		dpos   = np.asarray(dpos)
+		dchisq = np.zeros(dpos.shape[1:])
+		amps   = np.zeros((len(self.comps),)+dpos.shape[1:])
+		for i, (comps, pix) in enumerate(zip(self.comps, self.calc_pix(dpos))):
+			rho, kappa = self.interpol(comps[:,0], pix)
+			good   = kappa > 0
+			amps[i,good] = rho[good]/kappa[good]
+			dchisq[good]+= rho[good]**2/kappa[good]
+		return dchisq, amps
+	def eval(self, dpos, step=0.01*utils.arcmin):
+		"""Evaluate the chisquare, its gradient and its hessian with respect to the
+		focalplane offset dpos[{x,y}], including the prior. Returns chisq, grad[2], hess[2,2]"""
+		dpos  = np.asarray(dpos, float)
+		chisq = self.lik.chisq0
+		grad  = np.zeros(2)
+		hess  = np.zeros((2,2))
+		# Jacobian of the pixel positions with respect to dpos. This only involves
+		# the coordinate transformation, not the likelihood
+		offs  = np.array([[0,0],[step,0],[0,step]]).T
+		pixs  = self.calc_pix(dpos[:,None]+offs)
+		for comps, pix in zip(self.comps, pixs):
+			jac  = (pix[:,1:]-pix[:,:1])/step # [{y,x},{dx,dy}]
+			v    = self.interpol(comps, pix[:,:1])[...,0]
+			(r, ry, rx, ryy, ryx, rxx), (k, ky, kx, kyy, kyx, kxx) = v
+			if k <= 0: continue
+			dr, dk = np.array([ry,rx]), np.array([ky,kx])
+			Hr, Hk = np.array([[ryy,ryx],[ryx,rxx]]), np.array([[kyy,kyx],[kyx,kxx]])
+			# f = r**2/k, and chisq = chisq0 - sum(f)
+			df = 2*r*dr/k - r**2*dk/k**2
+			Hf = (2*(np.outer(dr,dr)+r*Hr)/k - 2*r*(np.outer(dr,dk)+np.outer(dk,dr))/k**2
+					- r**2*Hk/k**2 + 2*r**2*np.outer(dk,dk)/k**3)
+			chisq -= r**2/k
+			grad  -= jac.T.dot(df)
+			hess  -= jac.T.dot(Hf).dot(jac)
+		# Add prior
+		rmax = self.lik.rmax
+		dist = np.sum(dpos**2)**0.5
+		if dist > rmax:
+			e     = dpos/dist
+			chisq+= (20*(dist/rmax-1))**2
+			grad += 800/rmax*(dist/rmax-1)*e
+			hess += 800/rmax**2*np.outer(e,e) + 800/rmax*(dist/rmax-1)/dist*(np.eye(2)-np.outer(e,e))
+		return chisq, grad, hess
+
 class SrcFitterML:
 	def __init__(self, sdata, fwhm, ctrans=DposTransFoc):
 		self.sdata = sdata
 		self.nsrc  = len(self.sdata)
 		self.lik   = SrclikMulti(sdata, fwhm, ctrans=ctrans)
+		self.flik  = SrclikFFT(self.lik)
 		self.fwhm  = fwhm
 		self.ctrans= ctrans
 		self.scale = 0.5*utils.arcmin
@@ -277,20 +387,19 @@ class SrcFitterML:
 		return self.lik.eval(dpos).chisq
 	def calc_chisq_wrapper(self, x):
 		dpos  = x*self.scale
-		L     = self.lik.eval(dpos)
+		chisq = self.flik.eval(dpos)[0]
 		if self.verbose:
-			print "%4d %9.4f %9.4f %15.7f" % (self.i, dpos[0]/utils.arcmin, dpos[1]/utils.arcmin, L.chisq0-L.chisq)
+			print "%4d %9.4f %9.4f %15.7f" % (self.i, dpos[0]/utils.arcmin, dpos[1]/utils.arcmin, self.lik.chisq0-chisq)
 		self.i += 1
-		return L.chisq
-	def calc_deriv(self, dpos, step=0.05*utils.arcmin):
-		return np.array([
-			self.calc_chisq(dpos+[step,0])-self.calc_chisq(dpos-[step,0]),
-			self.calc_chisq(dpos+[0,step])-self.calc_chisq(dpos-[0,step])])/(2*step)
-	def calc_hessian(self, dpos, step=0.05*utils.arcmin):
-		return np.array([
-			self.calc_deriv(dpos+[step,0])-self.calc_deriv(dpos-[step,0]),
-			self.calc_deriv(dpos+[0,step])-self.calc_deriv(dpos-[0,step])
-		])/(2*step)
+		return chisq
+	def calc_deriv_wrapper(self, x):
+		return self.calc_deriv(x*self.scale)*self.scale
+	def calc_deriv(self, dpos):
+		return self.flik.eval(dpos)[1]
+	def calc_hessian(self, dpos):
+		return self.flik.eval(dpos)[2]
+	def optimize(self, dpos):
+		return optimize.fmin_bfgs(self.calc_chisq_wrapper, dpos/self.scale, fprime=self.calc_deriv_wrapper, disp=False)*self.scale
 	def calc_full_result(self, dpos, marginalize=True):
 		res = self.lik.eval(dpos)
 		res.poss_cel = res.poss
@@ -298,7 +407,7 @@ class SrcFitterML:
 				coordinates.transform("cel","hor",res.poss_cel[i],utils.ctime2mjd(self.sdata[i].ctime),site=self.sdata[i].site) for i in range(self.nsrc)
 			])
 		# Get the position uncertainty
-		hess  = self.calc_hessian(dpos, step=0.1*utils.arcmin)
+		hess  = self.calc_hessian(dpos)
 		hess  = 0.5*(hess+hess.T)
 		try:
 			pcov  = np.linalg.inv(0.5*hess)
@@ -351,16 +460,16 @@ class SrcFitterML:
 			return bpos
 	def likgrid(self, R, n, super=1, marg=False, verbose=False):
 		shape, wcs = enmap.geometry(pos=np.array([[-R,-R],[R,R]]), shape=(n,n), proj="car")
-		dchisqs = enmap.zeros(shape, wcs)
-		amps    = enmap.zeros((self.nsrc,)+shape, wcs)
-		pos     = dchisqs.posmap()
-		for i,p in enumerate(pos.reshape(2,-1).T):
-			if np.sum(p**2)**0.5 > R: continue
-			L = self.lik.eval(p)
-			if verbose:
-				print "%6d %7.3f %7.3f %15.7f" % (i, p[0]/utils.arcmin, p[1]/utils.arcmin, L.chisq0-L.chisq)
-			dchisqs.reshape(-1)[i]          = L.chisq0-L.chisq
-			amps.reshape(self.nsrc,-1)[:,i] = L.amps
+		pos     = enmap.posmap(shape, wcs)
+		# Evaluate all grid points at once
+		dchisqs, amps = self.flik.eval_grid(pos)
+		outside = np.sum(pos**2,0)**0.5 > R
+		dchisqs[outside] = 0
+		amps[:,outside]  = 0
+		dchisqs = enmap.ndmap(dchisqs, wcs)
+		amps    = enmap.ndmap(amps, wcs)
+		if verbose:
+			print "Max grid dchisq %15.7f" % np.max(dchisqs)
 		if super > 1:
 			# Use bicubic spline interpolation to upscale
 			shape2, wcs2 = enmap.geometry(pos=np.array([[-R,-R],[R,R]]), shape=(n*super,n*super), proj="car")
@@ -371,7 +480,7 @@ class SrcFitterML:
 		self.verbose = verbose
 		t1   = time.time()
 		dpos = self.find_starting_point()
-		dpos = optimize.fmin_powell(self.calc_chisq_wrapper, dpos/self.scale, disp=False)*self.scale
+		dpos = self.optimize(dpos)
 		res  = self.calc_full_result(dpos, marginalize=marg)
 		res.time = time.time()-t1
 		return res
@@ -403,7 +512,7 @@ class SrcFitterML:
 		maxpos  = maxpos[:,inds]
 		maxamps = maxamps[:,inds]
 		# Perform ML fit for the highest one
-		dpos = optimize.fmin_powell(self.calc_chisq_wrapper, maxpos[:,0]/self.scale, disp=False)*self.scale
+		dpos = self.optimize(maxpos[:,0])
 		res  = self.calc_full_result(dpos, marginalize=False)
 		if False and verbose:
 			for i, m in enumerate(res.models):
@@ -441,7 +441,7 @@ def find_obs_times(radecs, targ_el, t0, site, step=1, tol=1e-4, maxiter=100):
 	# will just skip them.
 	maxel = np.pi/2 - np.abs(radecs[1]-site.lat*utils.degree)
 	good  = np.where(maxel > targ_el)[0]
-	if len(good) == 0: return np.full(radecs_shape[1], np.nan)
+	if len(good) == 0: return np.full(radecs.shape[1:], np.nan)
 	def getel(dt): return coordinates.transform("cel", "tele", radecs, time=utils.ctime2mjd(t0+dt), site=site)[1]
 	def getder(dt): return (getel(dt+step/2)-getel(dt-step/2))/step
 	dt    = np.zeros(radecs.shape[1:])
@@ -534,19 +534,28 @@ def build_src_jacobi(info, spos_cel, stimes, delta=1*utils.arcmin):
 	return jac_osys, jac_opix
 
 def build_map(info, scans, dtype=np.float32, tag=None, comm=None):
+	maps, ivars = build_maps(info, scans, [(info.shape, info.wcs)], dtype=dtype, tag=tag, comm=comm)
+	return maps[0], ivars[0]
+
+def build_maps(info, scans, geoms, dtype=np.float32, tag=None, comm=None):
+	"""Solve jointly for maps with each of the geometries geoms[i] = (shape,wcs),
+	with a single equation system and CG. Returns maps, ivars."""
 	if comm is None: comm = mpi.COMM_WORLD
 	pre = "" if tag is None else tag + " "
 	L.info(pre + "Initializing equation system")
 	signal_cut  = mapmaking.SignalCut(scans, dtype=dtype, comm=comm)
-	area        = enmap.zeros((ncomp,)+info.shape, info.wcs, dtype)
-	signal_sky  = mapmaking.SignalMap(scans, area, comm=comm, sys=info.sys)
+	signals_sky = []
+	for gi, (shape, wcs) in enumerate(geoms):
+		area    = enmap.zeros((ncomp,)+shape, wcs, dtype)
+		signals_sky.append(mapmaking.SignalMap(scans, area, comm=comm, sys=info.sys, name="sky%d" % gi))
 	window      = mapmaking.FilterWindow(config.get("tod_window"))
-	eqsys       = mapmaking.Eqsys(scans, [signal_cut, signal_sky], weights=[window], dtype=dtype, comm=comm)
+	eqsys       = mapmaking.Eqsys(scans, [signal_cut]+signals_sky, weights=[window], dtype=dtype, comm=comm)
 	L.info(pre + "Building RHS")
 	eqsys.calc_b()
 	L.info(pre + "Building preconditioner")
 	signal_cut.precon = mapmaking.PreconCut(signal_cut, scans)
-	signal_sky.precon = mapmaking.PreconMapBinned(signal_sky, scans, [window])
+	for signal_sky in signals_sky:
+		signal_sky.precon = mapmaking.PreconMapBinned(signal_sky, scans, [window])
 	L.info(pre + "Solving")
 	solver = cg.CG(eqsys.A, eqsys.b, M=eqsys.M, dot=eqsys.dot)
 	while solver.i < args.niter:
@@ -554,10 +563,103 @@ def build_map(info, scans, dtype=np.float32, tag=None, comm=None):
 		solver.step()
 		t2 = time.time()
 		L.info(pre + "CG step %5d %15.7e %6.1f %6.3f" % (solver.i, solver.err, (t2-t1), (t2-t1)/len(scans)))
-	# Ok, now that we have our map. Extract it and ivar. That's the only stuff we need from this
-	map  = eqsys.dof.unzip(solver.x)[1]
-	ivar = signal_sky.precon.div[0,0]
-	return map, ivar
+	# Ok, now that we have our maps. Extract them and ivar. That's the only stuff we need from this
+	maps  = eqsys.dof.unzip(solver.x)[1:]
+	ivars = [signal_sky.precon.div[0,0] for signal_sky in signals_sky]
+	return maps, ivars
+
+def build_patch_boxes(shape, wcs, spos, tsize, margin=0):
+	"""Build disjoint pixel boxes [npatch,{from,to},{y,x}] that each cover a thumbnail
+	of size tsize plus margin around the sources with output coordinates
+	spos[{ra,dec},nsrc]. Sources whose boxes would overlap share a patch.
+	Returns boxes, patch_of_src[nsrc]."""
+	spix  = utils.nint(enmap.sky2pix(shape, wcs, spos[::-1]).T)
+	boxes = np.moveaxis([spix-tsize//2-margin, spix-tsize//2+tsize+margin],0,1)
+	owner = np.arange(len(boxes))
+	# Merge groups of overlapping boxes until they are all disjoint. Merged boxes
+	# are bigger, so they can overlap new boxes, hence the loop
+	while len(boxes) > 1:
+		centers = 0.5*(boxes[:,0]+boxes[:,1])
+		halfs   = 0.5*(boxes[:,1]-boxes[:,0])
+		tree    = spatial.cKDTree(centers)
+		pairs   = tree.query_pairs(2*np.max(halfs), p=np.inf, output_type="ndarray")
+		pairs   = pairs[np.all(np.abs(centers[pairs[:,0]]-centers[pairs[:,1]]) < halfs[pairs[:,0]]+halfs[pairs[:,1]],1)]
+		if len(pairs) == 0: break
+		graph   = sparse.coo_matrix((np.ones(len(pairs)),(pairs[:,0],pairs[:,1])), shape=(len(boxes),len(boxes)))
+		n, labels = csgraph.connected_components(graph, directed=False)
+		boxes   = np.array([[np.min(boxes[labels==l,0],0),np.max(boxes[labels==l,1],0)] for l in range(n)])
+		owner   = labels[owner]
+	boxes = np.maximum(boxes, 0)
+	boxes[:,1] = np.minimum(boxes[:,1], shape[-2:])
+	return boxes, owner
+
+def find_patch_times(info, spos_cel, rad):
+	"""Find the time range [{from,to},nsrc] where each source with celestial coordinates
+	spos_cel[{ra,dec},nsrc] can be hit by a detector, given a patch radius rad around
+	each. Since we scan at constant elevation, this is when the source is within
+	arad+rad of the array center elevation. Falls back on the full time range for
+	sources that never reach those elevations."""
+	acenter_el = coordinates.recenter(info.acenter, [0,0,0,info.bel])[1]
+	r      = info.arad + rad
+	times  = np.array([find_obs_times(spos_cel, acenter_el+off, info.t0, info.site) for off in [-r,r]])
+	times  = np.sort(times,0)
+	for i in range(2):
+		times[i,~np.isfinite(times[i])] = info.trange[i]
+	return times
+
+def slice_scans_time(scans, trange, nmin=100):
+	"""Restrict scans to the samples in the ctime range trange, skipping those with
+	fewer than nmin samples left"""
+	res = []
+	for scan in scans:
+		t = utils.mjd2ctime(scan.mjd0) + scan.boresight[:,0]
+		i1, i2 = np.searchsorted(t, trange)
+		if i2-i1 < nmin: continue
+		res.append(scan[:,i1:i2])
+	return res
+
+def build_thumbs_patches(info, scans, spos_cel, spos_flat, samps, tsize=30, margin=0, minsize=None, dtype=np.float32, tag=None):
+	"""Map only a set of disjoint patches around the sources, instead of the whole area
+	covered by the scans, and cut thumbnails from those. The patches are solved for
+	jointly, as separate signals in a single equation system, using only the samples
+	from the time range where they can be hit, so the map area scales with the number
+	of sources rather than the sky footprint. Each patch is at least minsize pixels
+	wide (default 3 thumbnails), so that neighbouring sources share a patch and enough
+	area is left for the noise model once all sources are masked. The final noise model
+	is the mean of the patch noise models weighted by their unmasked area. Returns tdata, ps2d like
+	extract_srcs and build_noise_model_simple for the full map would."""
+	pre    = "" if tag is None else tag + " "
+	if minsize is None: minsize = 3*tsize
+	pmargin= max(margin, (minsize-tsize+1)//2)
+	boxes, owner = build_patch_boxes(info.shape, info.wcs, spos_flat, tsize, margin=pmargin)
+	stimes = find_patch_times(info, spos_cel, (tsize//2+pmargin)*2**0.5*args.res*utils.arcmin)
+	pscans = slice_scans_time(scans, [np.min(stimes[0]), np.max(stimes[1])])
+	if len(pscans) == 0: return bunch.Bunch(inds=np.zeros(0,int)), None
+	geoms  = [enmap.slice_geometry(info.shape, info.wcs, (slice(box[0,0],box[1,0]),slice(box[0,1],box[1,1]))) for box in boxes]
+	maps, ivars = build_maps(info, pscans, geoms, dtype=dtype, tag=pre + "%d patches" % len(boxes), comm=mpi.COMM_SELF)
+	del pscans
+	tdatas, ps2ds, pweights = [], [], []
+	for pi, ((pshape, pwcs), map, ivar) in enumerate(zip(geoms, maps, ivars)):
+		psel   = np.where(owner == pi)[0]
+		ivar  *= build_exposure_mask(ivar)
+		ptdata = extract_srcs(map, ivar, spos_flat[:,psel], tsize=tsize)
+		if len(ptdata.inds) == 0: continue
+		ptdata.inds = psel[ptdata.inds]
+		tdatas.append(ptdata)
+		# Patches cut by the edge of the geometry may be too small for a noise model
+		if np.any(np.array(pshape[-2:]) < tsize): continue
+		# Mask all sources, not just the bright ones, including sources from other
+		# patches that fall inside this one
+		src_mask = mask_bright_srcs(pshape, pwcs, spos_flat, samps, amp_lim=-np.inf)
+		pweight  = np.sum((ivar*src_mask)>0)
+		if pweight == 0: continue
+		ps2ds.append(build_noise_model_simple(map, ivar*src_mask, tsize=tsize))
+		pweights.append(pweight)
+	del maps, ivars
+	if len(tdatas) == 0 or len(ps2ds) == 0: return bunch.Bunch(inds=np.zeros(0,int)), None
+	tdata = bunch.Bunch(**{key: np.concatenate([t[key] for t in tdatas]) for key in ["inds","maps","ivars","centers","pixshapes"]})
+	ps2d  = enmap.samewcs(np.sum([p*w for p, w in zip(ps2ds, pweights)],0)/np.sum(pweights), ps2ds[0])
+	return tdata, ps2d
 
 def build_exposure_mask(ivar, quant=0.9, tol=0.01, edge=2*utils.arcmin, ignore=1*utils.arcmin, thin=100):
 	samps= ivar[ivar>0]
@@ -1050,7 +1152,8 @@ if mode == "build":
 	from enlib  import config, coordinates, mapmaking, bench, scanutils, log, cg, dory
 	from pixell import utils, enmap, pointsrcs, bunch, mpi
 	from enact  import filedb, actdata, actscan, files
-	from scipy  import ndimage, optimize, spatial
+	from scipy  import ndimage, optimize, spatial, sparse
+	from scipy.sparse import csgraph
 
 	config.default("map_bits", 32, "Bit-depth to use for maps and TOD")
 	config.default("downsample", 1, "Factor with which to downsample the TOD")
@@ -1079,7 +1182,12 @@ if mode == "build":
 	parser.add_argument("-F", "--fix",       type=str, default=None)
 	parser.add_argument(      "--freq-cats", type=str, default=None)
 	parser.add_argument(      "--isys",      type=str, default="cel")
+	parser.add_argument("-P", "--patches",   action="store_true", help="Only map disjoint patches around the sources instead of the whole area")
+	parser.add_argument(      "--patch-margin", type=float, default=5, help="Extra margin around each thumbnail in patch mode, in arcmins")
+	parser.add_argument(      "--patch-tiles",  type=int,   default=3, help="Minimum width of each patch in patch mode, in thumbnails. Leaves room for the noise model after masking the sources")
 	args = parser.parse_args()
+	if args.patches and args.maps:
+		raise ValueError("--maps can't be used with --patches, since no full map is built")
 
 	utils.mkdir(args.odir)
 	comm_world  = mpi.COMM_WORLD
@@ -1183,6 +1291,11 @@ if mode == "build":
 			tinds  = utils.find(sinds, idata.table["sid"])
 			tdata  = bunch.Bunch(inds=tinds, maps=idata.maps, ivars=idata.ivars,
 					centers=idata.table["center"], pixshapes=idata.table["pixshape"])
+		elif args.patches:
+			# Map only the area around the sources, as a set of patches
+			tdata, ps2d = build_thumbs_patches(info, scans, spos_cel[:,sinds], spos_flat[:,sinds], srcs.I[sinds],
+					tsize=tsize, margin=utils.nint(args.patch_margin/args.res), minsize=args.patch_tiles*tsize, dtype=dtype, tag=tag)
+			if maybe_skip(len(tdata.inds)==0, tag + " No sources properly hit", ename): continue
 		else:
 			map, ivar   = build_map(info, scans, dtype=dtype, tag=tag, comm=comm_self)
 			if args.maps > 0:
@@ -12,9 +12,13 @@ parser.add_argument("--exclude",         type=str, default=None)
 parser.add_argument("--only",            type=str, default=None)
 parser.add_argument("--repixwin",        type=str, default=None)
 parser.add_argument("--suffix",          type=str, default="")
+parser.add_argument("-b", "--bsize",     type=int, default=1000, help="Number of rows to process at a time in coadds and sums")
+parser.add_argument("--stream-blocks",   action="store_true", help="Let several tasks write blocks of the same output file. odir must not be on an NFS-like filesystem; see fitsstream")
 args = parser.parse_args()
 import numpy as np, glob, re, os, shutil, sys
 from enlib import enmap, utils, retile, bunch, mpi
+from fitsstream import prepare_output, write_rows
+from scheduling import schedule_lpt
 
 comm = mpi.COMM_WORLD
 outputs = set(args.output.split(","))
@@ -58,6 +62,7 @@ if args.repixwin:
 		)
 else:
 	def mapfix(map, ivar): return map
+mapop = mapfix if args.repixwin else None
 
 # Look for map files in the input directory
 datasets = {}
@@ -129,6 +134,71 @@ def read_map(ifile, slice=None):
 	map = map.astype(dtype, copy=False)
 	return map
 
+# Coadds and sums are done a block of rows at a time, so that we never need
+# more than a few blocks in memory, and so that big ones can be spread over
+# several tasks. The inputs can be either fits files or directories of tiles.
+tile_fmt     = "/tile%(y)03d_%(x)03d.fits"
+tile_layouts = {}
+def get_tile_layout(idir):
+	"""Return the first tile and the pixel edges of the tile rows and
+	columns of the tiled map in idir"""
+	if idir not in tile_layouts:
+		(ty1,tx1), (ty2,tx2) = retile.find_tile_range(idir + tile_fmt)
+		ys = [enmap.read_map_geometry(idir + tile_fmt % {"y":ty,"x":tx1})[0][-2] for ty in range(ty1,ty2)]
+		xs = [enmap.read_map_geometry(idir + tile_fmt % {"y":ty1,"x":tx})[0][-1] for tx in range(tx1,tx2)]
+		tile_layouts[idir] = ((ty1,tx1), np.concatenate([[0],np.cumsum(ys)]), np.concatenate([[0],np.cumsum(xs)]))
+	return tile_layouts[idir]
+
+def get_geometry(ifile):
+	if not os.path.isdir(ifile): return enmap.read_map_geometry(ifile)
+	t1, yedges, xedges = get_tile_layout(ifile)
+	shape, wcs = enmap.read_map_geometry(ifile + tile_fmt % {"y":t1[0],"x":t1[1]})
+	return shape[:-2]+(yedges[-1],xedges[-1]), wcs
+
+def read_rows(ifile, y1, y2, slice=None):
+	"""Like read_map, but only reads rows y1:y2"""
+	if not os.path.isdir(ifile):
+		map = enmap.read_map(ifile, sel=np.s_[...,y1:y2,:])
+	else:
+		t1, yedges, xedges = get_tile_layout(ifile)
+		rows = []
+		for ty in range(len(yedges)-1):
+			if yedges[ty+1] <= y1 or yedges[ty] >= y2: continue
+			tiles = [enmap.read_map(ifile + tile_fmt % {"y":t1[0]+ty,"x":t1[1]+tx}) for tx in range(len(xedges)-1)]
+			row   = enmap.samewcs(np.concatenate(tiles,-1), tiles[0])
+			rows.append(row[...,max(y1-yedges[ty],0):min(y2,yedges[ty+1])-yedges[ty],:])
+		map = enmap.samewcs(np.concatenate(rows,-2), rows[0])
+	if slice: map = eval("map"+slice)
+	map = map.astype(dtype, copy=False)
+	return map
+
+def get_size(path):
+	"""Total size of a file or directory in bytes. Used as the cost estimate"""
+	if not os.path.exists(path): return 0
+	if not os.path.isdir(path): return os.path.getsize(path)
+	return sum([os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)])
+
+def coadd_rows(imapfiles, idivfiles, y1, y2):
+	if len(imapfiles) == 1:
+		return read_rows(imapfiles[0], y1, y2), read_rows(idivfiles[0], y1, y2, slice=".preflat[0]")
+	omap, odiv = 0, 0
+	for imapfile, idivfile in zip(imapfiles, idivfiles):
+		imap = read_rows(imapfile, y1, y2)
+		idiv = read_rows(idivfile, y1, y2, slice=".preflat[0]")
+		omap += imap*idiv
+		odiv += idiv
+		del imap, idiv
+	mask = odiv > 0
+	omap[...,mask] /= odiv[mask]
+	return omap, odiv
+
+def add_rows(ifiles, y1, y2, slice=None, factors=None):
+	if factors is None: factors = [1]*len(ifiles)
+	omap = read_rows(ifiles[0], y1, y2, slice=slice)*factors[0]
+	for i in range(1, len(ifiles)):
+		omap += read_rows(ifiles[i], y1, y2, slice=slice)*factors[i]
+	return omap
+
 def copy_mono(ifile, ofile, slice=None):
 	if args.cont and os.path.exists(ofile): return
 	if verbose: print("%3d copy_mono %s" % (comm.rank, ofile))
@@ -201,10 +271,37 @@ def link(ifile, ofile):
 	if verbose: print("%d link %s" % (comm.rank, ofile))
 	os.symlink(ifile, ofile)
 
-queue = []
+# The queue has the plain jobs, which run as a whole on one task. Blocked jobs
+# have a list of input files, which are summed or coadded a block of rows at a
+# time into the output files.
+queue   = []
+blocked = []
 def schedule(func, *fargs, **kwargs):
 	queue.append([func, fargs, kwargs])
 
+def schedule_coadd(imapfiles, idivfiles, omapfile, odivfile, op=None):
+	# Fourier operations need the whole map at once
+	if op is not None:
+		return schedule(coadd_mono, imapfiles, idivfiles, omapfile, odivfile, op=op)
+	blocked.append(bunch.Bunch(kind="coadd", ifiles=imapfiles+idivfiles, ofiles=[omapfile, odivfile],
+		args=(imapfiles, idivfiles), kwargs={}))
+
+def schedule_add(ifiles, ofile, slice=None, factors=None):
+	blocked.append(bunch.Bunch(kind="add", ifiles=ifiles, ofiles=[ofile],
+		args=(ifiles,), kwargs={"slice":slice, "factors":factors}))
+
+def run_block(job, y1, y2):
+	if job.kind == "coadd":
+		oblocks = coadd_rows(*job.args, y1=y1, y2=y2)
+	else:
+		oblocks = [add_rows(*job.args, y1=y1, y2=y2, **job.kwargs)]
+	for ofile, hlen, oshape, oblock in zip(job.ofiles, job.hlens, job.oshapes, oblocks):
+		write_rows(ofile + ".tmp", hlen, oshape, oblock, y1)
+
+def run_job(job):
+	for y1 in range(0, job.shape[-2], args.bsize):
+		run_block(job, y1, min(y1+args.bsize, job.shape[-2]))
+
 utils.mkdir(args.odir)
 # We can now process each dataset
 all_files = [os.path.basename(p) for p in glob.glob(args.idir + "/*")]
@@ -216,7 +313,7 @@ for iname in sorted(datasets.keys()):
 		ipre = args.idir + "/" + sub.name + "_"
 		opre = obase + "_%dway_set%d_" % (len(d),si) + args.suffix
 		if "map"  in outputs:
-			schedule(coadd_mono, [ipre + "sky_map%04d.fits" % sub.it], [ipre + "sky_div.fits"], opre + "map.fits", opre + "ivar.fits", op=mapfix)
+			schedule_coadd([ipre + "sky_map%04d.fits" % sub.it], [ipre + "sky_div.fits"], opre + "map.fits", opre + "ivar.fits", op=mapop)
 		if "ivar" in outputs and "map" not in outputs:
 			schedule(copy_mono, ipre + "sky_div.fits", opre + "ivar.fits", slice=".preflat[0]")
 		if "div" in outputs:
@@ -232,27 +329,72 @@ for iname in sorted(datasets.keys()):
 	if "totmap" in outputs:
 		imaps = [args.idir + "/" + sub.name + "_sky_map%04d.fits" % sub.it for sub in d]
 		idivs = [args.idir + "/" + sub.name + "_sky_div.fits" for sub in d]
-		schedule(coadd_mono, imaps, idivs, opre + "map.fits", opre + "ivar.fits", op=mapfix)
+		schedule_coadd(imaps, idivs, opre + "map.fits", opre + "ivar.fits", op=mapop)
 	if "tothits" in outputs:
 		imaps = [args.idir + "/" + sub.name + "_sky_hits.fits" for sub in d]
-		schedule(add_mono, imaps, opre + "hits.fits")
+		schedule_add(imaps, opre + "hits.fits")
 	if "totxlink" in outputs:
 		imaps = [args.idir + "/" + sub.name + "_sky_crosslink.fits" for sub in d]
-		schedule(add_mono, imaps, opre + "xlink.fits")
+		schedule_add(imaps, opre + "xlink.fits")
 	if "toticov" in outputs:
 		imaps = [args.idir + "/" + sub.name + "_sky_icov.fits" for sub in d]
-		schedule(add_mono,  imaps, opre + "icov.fits", slice=".preflat[0]")
+		schedule_add( imaps, opre + "icov.fits", slice=".preflat[0]")
 		schedule(copy_plain, args.idir + "/" + d[0].name + "_sky_icov_pix.txt", opre + "icov_pix.txt")
 	if "totsens"  in outputs:
 		ifiles = [args.idir + "/" + sub.name + "_noise.txt" for sub in d]
 		schedule(cat_files, ifiles, opre + "sens.txt")
 
+# Skip already done blocked jobs, and allocate the output files for the rest,
+# so that the tasks can write their blocks into them directly. By default all
+# the blocks of a job go to the same task, which is safe on any filesystem.
+# With --stream-blocks they are spread over tasks, which needs a filesystem
+# that handles concurrent writes to one file; see fitsstream.
+if args.cont:
+	blocked = [job for job in blocked if not all([os.path.exists(ofile) for ofile in job.ofiles])]
+for job in blocked:
+	job.shape, job.wcs = get_geometry(job.args[0][0])
+	job.nblock = (job.shape[-2]+args.bsize-1)//args.bsize
+if comm.rank == 0 and not args.dry:
+	hlens, oshapes = [], []
+	for job in blocked:
+		if job.kind == "coadd": pre = [job.shape[:-2], ()]
+		else: pre = [read_rows(job.args[0][0], 0, 1, slice=job.kwargs["slice"]).shape[:-2]]
+		oshapes.append([p + job.shape[-2:] for p in pre])
+		hlens.append([prepare_output(ofile + ".tmp", oshape, job.wcs, dtype) for ofile, oshape in zip(job.ofiles, oshapes[-1])])
+else: hlens, oshapes = None, None
+hlens, oshapes = comm.bcast((hlens, oshapes))
+for ji, job in enumerate(blocked):
+	if verbose and comm.rank == 0: print("%3d %s %s in %d blocks" % (comm.rank, job.kind, job.ofiles[0], job.nblock))
+	if args.dry: continue
+	job.hlens, job.oshapes = hlens[ji], oshapes[ji]
+
+# Build the full list of work units with the sizes of the files they touch as the cost
+units = [["plain", i] for i in range(len(queue))]
+costs = []
+for func, fargs, kwargs in queue:
+	ifiles = [fargs[0]] if isinstance(fargs[0], str) else fargs[0]
+	costs.append(sum([get_size(ifile) for ifile in ifiles]))
+if not args.dry:
+	for ji, job in enumerate(blocked):
+		jcost = sum([get_size(ifile) for ifile in job.ifiles])/job.nblock
+		if args.stream_blocks:
+			for bi in range(job.nblock):
+				units.append(["block", ji, bi*args.bsize, min((bi+1)*args.bsize, job.shape[-2])])
+				costs.append(jcost)
+		else:
+			units.append(["job", ji])
+			costs.append(jcost*job.nblock)
+
 # Process the scheduled items
-np.random.seed(0)
-inds = np.random.permutation(len(queue))
-for i in range(comm.rank, len(queue), comm.size):
-	ind = inds[i]
-	func, fargs, kwargs = queue[ind]
+myunits = schedule_lpt(costs, comm.size)[comm.rank]
+for ui in myunits:
+	unit = units[ui]
+	if unit[0] == "plain":
+		func, fargs, kwargs = queue[unit[1]]
+	elif unit[0] == "job":
+		func, fargs, kwargs = run_job, (blocked[unit[1]],), {}
+	else:
+		func, fargs, kwargs = run_block, (blocked[unit[1]], unit[2], unit[3]), {}
 	try:
 		func(*fargs, **kwargs)
 	except Exception as e:
@@ -260,3 +402,10 @@ for i in range(comm.rank, len(queue), comm.size):
 		sys.stderr.write(str(fargs) + "\n")
 		sys.stderr.write(str(kwargs) + "\n")
 		raise
+
+# Move the finished blocked outputs into place
+comm.Barrier()
+if comm.rank == 0 and not args.dry:
+	for job in blocked:
+		for ofile in job.ofiles:
+			shutil.move(ofile + ".tmp", ofile)
@@ -1,7 +1,8 @@
-import numpy as np
+import numpy as np, os, hashlib
 from pixell import enmap, utils, mpi, fft
 from enlib import pmat, sampcut, config, errors, pulsar, array_ops, log, gapfill
 from enact import filedb, actdata, actscan, cuts
+import pixblocks
 config.default("verbosity", 1, "Verbosity for output. Higher means more verbose. 0 outputs only errors etc. 1 outputs INFO-level and 2 outputs DEBUG-level messages.")
 config.default("eig_limit", 1e-3, "Smallest relative eigenvalue to invert in eigenvalue inversion. Ones smaller than this are set to zero.")
 parser = config.ArgumentParser()
@@ -21,8 +22,13 @@ parser.add_argument("-I", "--inject",      type=str,   default=None)
 parser.add_argument("-D", "--dump-tods",   type=str,   default=None)
 parser.add_argument("-L", "--load-tods",   type=str,   default=None)
 parser.add_argument(      "--dump-phase",  type=str,   default=None)
+parser.add_argument(      "--phase-cache", type=str,   default=None, help="Directory to cache the phase of each tod in, as a piecewise polynomial in time")
+parser.add_argument(      "--phase-tseg",  type=float, default=10, help="Length of each phase cache polynomial segment in seconds")
+parser.add_argument(      "--phase-order", type=int,   default=3)
+parser.add_argument(      "--phase-tol",   type=float, default=1e-4, help="Max error of the cached phase, in cycles. Tods that can't be represented this well aren't cached")
 parser.add_argument(      "--dscale",      type=float, default=1)
 parser.add_argument(      "--weight",      type=str,   default="ivar")
+parser.add_argument(      "--div-bsize",   type=int,   default=32, help=pixblocks.bsize_help)
 args = parser.parse_args()
 
 def lowpass_tod(tod, srate, fknee=3, alpha=-10):
@@ -40,6 +46,71 @@ def planet_filter(scan, coords, tod, R=0.2*utils.degree, fknee=3, alpha=-10):
 	model      = lowpass_tod(model, srate=scan.srate, fknee=fknee, alpha=alpha)
 	tod       -= model
 
+# Evaluating the phase with the ephemeris and timing model for every sample is slow,
+# but it's smooth in time, so we cache it as a piecewise polynomial per tod. Each
+# row of the cache is [t0,coeffs], with the coefficients applying to ctime-t0 and
+# giving the unwrapped phase in cycles.
+def fit_phase_poly(ctime, phase, tseg=10, order=3):
+	uphase = np.unwrap(phase*2*np.pi)/(2*np.pi)
+	edges  = np.searchsorted(ctime, np.arange(ctime[0], ctime[-1], tseg))
+	edges  = np.concatenate([edges, [len(ctime)]])
+	poly   = []
+	for i1, i2 in zip(edges[:-1], edges[1:]):
+		if i2-i1 <= order: continue
+		t0 = ctime[i1]
+		poly.append(np.concatenate([[t0],np.polyfit(ctime[i1:i2]-t0, uphase[i1:i2], order)]))
+	return np.array(poly)
+
+def eval_phase_poly(poly, ctime):
+	seg   = np.clip(np.searchsorted(poly[:,0], ctime, "right")-1, 0, len(poly)-1)
+	x     = ctime - poly[seg,0]
+	phase = np.zeros(len(ctime))
+	for i in range(1, poly.shape[1]):
+		phase = phase*x + poly[seg,i]
+	return phase % 1
+
+def get_phase_cache_name(cache_dir, id):
+	h = hashlib.md5()
+	h.update(("%s %.8f %.8f %s %.3f %d" % (id, coords[0], coords[1], pulseph, args.phase_tseg, args.phase_order)).encode())
+	with open(args.timing_file, "rb") as ifile:
+		h.update(ifile.read())
+	return "%s/phase_%s_%s.npy" % (cache_dir, id.replace(":","_"), h.hexdigest()[:16])
+
+def calc_phase(id, ctime):
+	if not args.phase_cache:
+		return pulsar.obstime2phase(ctime, coords, pulstime, ephem=pulseph, interp=True)
+	cache_name = get_phase_cache_name(args.phase_cache, id)
+	if os.path.isfile(cache_name):
+		return eval_phase_poly(np.load(cache_name), ctime)
+	phase = pulsar.obstime2phase(ctime, coords, pulstime, ephem=pulseph, interp=True)
+	poly  = fit_phase_poly(ctime, phase, tseg=args.phase_tseg, order=args.phase_order)
+	if len(poly) == 0: return phase
+	err   = np.max(np.abs((eval_phase_poly(poly, ctime)-phase+0.5)%1-0.5))
+	if err > args.phase_tol:
+		L.debug("%s phase not cached: max error %.2e" % (id, err))
+	else:
+		np.save(cache_name, poly)
+	return phase
+
+def accumulate_div(pmap, scan, bini, det_ivar, div, bsize=32):
+	"""Accumulate the ncomp x ncomp pointing weights of each phase bin directly into
+	div[ncomp,nbin*ncomp,ny,nx], using the pointing and the bin of each sample. This
+	replaces ncomp forward and backward projections of the whole bin stack with a
+	single pass over the pointing."""
+	ncomp  = div.shape[0]
+	nbin   = div.shape[1]//ncomp
+	ny, nx = div.shape[-2:]
+	divs   = [div[i].reshape(nbin,ncomp,ny*nx) for i in range(ncomp)]
+	# Compress to the [bin,pixel] combinations actually hit
+	for d1, d2, uinds, inv, ok, ph in pixblocks.pixel_blocks(pmap, scan, div.shape, div.wcs, bsize, bins=bini):
+		ub, up = np.divmod(uinds, ny*nx)
+		w    = np.broadcast_to(det_ivar[d1:d2,None], ok.shape)[ok]
+		for i in range(ncomp):
+			for j in range(i, ncomp):
+				dij = np.bincount(inv, w*ph[:,i]*ph[:,j], minlength=len(uinds))
+				divs[i][ub,j,up] += dij
+				if j != i: divs[j][ub,i,up] += dij
+
 filedb.init()
 comm       = mpi.COMM_WORLD
 ids        = filedb.scans[args.sel]
@@ -66,6 +137,7 @@ if args.inject:
 	inject_map = enmap.read_map(args.inject)
 
 utils.mkdir(args.odir)
+if args.phase_cache: utils.mkdir(args.phase_cache)
 prefix = args.odir + "/"
 if args.tag: prefix += args.tag + "_"
 
@@ -102,7 +174,7 @@ for ind in range(comm.rank, len(ids), comm.size):
 	#ctime_test  = 603295716.09406399727
 	#ctime_test += -0.637457
 	#print(pulsar.obstime2phase(ctime_test, coords, pulstime, ephem=pulseph, site=jodrell_site))
-	phase = pulsar.obstime2phase(ctime, coords, pulstime, ephem=pulseph, interp=True)
+	phase = calc_phase(id, ctime)
 	bini  = utils.nint(phase*nbin) % nbin
 	# Set up our pointing matrix
 	pmap = pmat.PmatMap(scan, rhs, split=bini, sys=sys)
@@ -153,15 +225,7 @@ for ind in range(comm.rank, len(ids), comm.size):
 	pmap.backward(tod, rhs)
 	L.debug("%s rhs" % id)
 	# Update div
-	for i in range(ncomp):
-		one = div[0]*0
-		one[i::ncomp] = 1
-		tod[:] = 0
-		pmap.forward(tod, one)
-		tod *= det_ivar[:,None]
-		sampcut.gapfill_const(scan.cut, tod, 0, inplace=True)
-		pmap.backward(tod, div[i])
-		del one
+	accumulate_div(pmap, scan, bini, det_ivar, div, bsize=args.div_bsize)
 	L.debug("%s div" % id)
 	del scan, tod, pmap
 	good_ids.append(id)
@@ -0,0 +1,39 @@
+"""Static load balancing helpers shared by the mpi scripts"""
+import numpy as np, heapq
+
+def schedule_lpt(costs, nbin):
+	"""Distribute jobs with the given costs over nbin workers, assigning the
+	most expensive remaining job to the least loaded worker (LPT scheduling).
+	The result is deterministic, so all tasks agree on it. Returns a list of
+	job indices for each worker, in ascending order."""
+	heap = [(0.0, i) for i in range(nbin)]
+	res  = [[] for i in range(nbin)]
+	for ji in np.argsort(-np.asarray(costs), kind="stable"):
+		load, bi = heapq.heappop(heap)
+		res[bi].append(ji)
+		heapq.heappush(heap, (load+costs[ji], bi))
+	return [sorted(r) for r in res]
+
+def pack_jobs(nodes, nnode):
+	"""First-fit decreasing packing of jobs needing nodes[i] nodes each
+	into allocations of nnode nodes. Returns a list of lists of job indices."""
+	bins, free = [], []
+	for i in np.argsort(-np.asarray(nodes), kind="stable"):
+		for bi in range(len(bins)):
+			if free[bi] >= nodes[i]:
+				bins[bi].append(i)
+				free[bi] -= nodes[i]
+				break
+		else:
+			bins.append([i])
+			free.append(nnode-nodes[i])
+	return bins
+
+def estimate_map_cost(sel, scans):
+	"""Estimate the cost of mapping the given selection from the scan
+	database scans, typically filedb.scans. Returns the number of tods and
+	their total duration in hours, which is proportional to the number of samples."""
+	from enact import todinfo
+	ids = todinfo.get_tods(sel, scans)
+	db  = scans.select(ids)
+	return len(ids), np.sum(db.data["dur"])/3600
@@ -16,22 +16,24 @@ args = parser.parse_args()
 import numpy as np, sys, glob, re, os
 from enlib import utils
 with utils.nowarn():
-	from enlib import fastweight, enmap
+	from enlib import fastweight, enmap, mpi
 	from enact import filedb, actdata
 
+comm   = mpi.COMM_WORLD
 filedb.init()
 ids    = filedb.scans[args.sel]
 db     = filedb.scans.select(ids)
 ntod   = len(db)
 nsplit = args.nsplit
 if len(ids) < nsplit:
-	print("%d tods is too few for %d splits" % (ntod, nsplit))
+	if comm.rank == 0: print("%d tods is too few for %d splits" % (ntod, nsplit))
 	sys.exit(1)
 nopt   = args.nopt if nsplit > 1 else 0
 optimize_subsets = (args.mode == "crosslink" or args.mode=="scanpat")
 detdir = args.odir + "/details"
-utils.mkdir(args.odir)
-utils.mkdir(detdir)
+if comm.rank == 0:
+	utils.mkdir(args.odir)
+	utils.mkdir(detdir)
 
 # Determine which arrays we have. We can't process arrays independently,
 # as they in principle have correlated noise. But we also want to distinguish
@@ -191,41 +193,78 @@ else:
 
 sys.stderr.write("using %s workspace with resolution %.2f deg" % (str(shape), args.res) + "\n")
 
-# Get the hitmap for each block
-hits = enmap.zeros((nblock,narray)+shape, wcs)
+# Get the hitmap for each block. Each day-block only touches a small part of
+# the sky, so we store them as sparse [{pix},{val}] lists over the flattened map
+# instead of a dense [nblock,narray,ny,nx] array. The blocks are distributed over
+# the mpi tasks, and gathered on the root, which does the optimization.
+npix = shape[-2]*shape[-1]
 ndig = calc_ndig(nblock)
-sys.stderr.write("estimating hitmap for block %*d/%d" % (ndig,0,nblock))
-for bi in range(nblock):
+my_blocks = np.arange(comm.rank, nblock, comm.size)
+my_hits   = []
+if comm.rank == 0: sys.stderr.write("estimating hitmap for block %*d/%d" % (ndig,0,nblock))
+for i, bi in enumerate(my_blocks):
 	for ai in range(narray):
 		block_db = db.select(block_inds[bi,ai])
-		hits[bi,ai] = fastweight.fastweight(shape, wcs, block_db, array_rad=args.rad*utils.degree, site=site, weight=args.weight)
-	sys.stderr.write("%s%*d/%d" % ("\b"*(1+2*ndig),ndig,bi+1,nblock))
-sys.stderr.write("\n")
+		bhits    = fastweight.fastweight(shape, wcs, block_db, array_rad=args.rad*utils.degree, site=site, weight=args.weight).reshape(-1)
+		pix      = np.nonzero(bhits)[0]
+		my_hits.append((bi, ai, pix.astype(np.int32), bhits[pix]))
+	if comm.rank == 0: sys.stderr.write("%s%*d/%d" % ("\b"*(1+2*ndig),ndig,min((i+1)*comm.size,nblock),nblock))
+if comm.rank == 0: sys.stderr.write("\n")
+all_hits = comm.gather(my_hits, root=0)
+if comm.rank > 0: sys.exit(0)
+hit_pix = [[None for ai in range(narray)] for bi in range(nblock)]
+hit_val = [[None for ai in range(narray)] for bi in range(nblock)]
+for rank_hits in all_hits:
+	for bi, ai, pix, val in rank_hits:
+		hit_pix[bi][ai] = pix
+		hit_val[bi][ai] = val
+del all_hits, my_hits
 
 # Build a mask for the region of interest per array
 mask           = enmap.zeros((narray,)+shape, wcs, bool)
 nblock_per_pix = enmap.zeros((narray,)+shape, wcs, int)
 nblock_lim     = np.zeros(narray)
 for ai in range(narray):
-	ahits   = hits[:,ai]
-	ref     = np.median(ahits[ahits>0])
-	nblock_per_pix[ai] = np.sum(ahits>ref*0.2,0)
+	avals   = np.concatenate([hit_val[bi][ai] for bi in range(nblock)])
+	ref     = np.median(avals[avals>0])
+	nblock_per_pix[ai] = np.bincount(np.concatenate([hit_pix[bi][ai][hit_val[bi][ai]>ref*0.2] for bi in range(nblock)]),
+			minlength=npix).reshape(shape)
 	nblock_ref         = np.median(nblock_per_pix[ai][nblock_per_pix[ai]>0])
 	nblock_lim[ai]     = min(2*nsplit, nblock_ref*0.2)
 	mask[ai]           = nblock_per_pix[ai] > nblock_lim[ai]
 sys.stderr.write("[%s] pixels hit by at least [%s] blocks\n" % (
 	atolist(np.sum(mask,(-2,-1))), atolist(nblock_lim)))
 
-def calc_delta_score(split_hits, bhits, mask):
+# Only the masked pixels of each block contribute to the score
+mask_flat = mask.reshape(narray,-1)
+hit_msel  = [[mask_flat[ai,hit_pix[bi][ai]] for ai in range(narray)] for bi in range(nblock)]
+
+def calc_delta_score(split_hits, bi):
 	# fractional improvement is (split_hits + bhits)/split_hits -1 = bhits/split_hits
 	# This will often lead to division by zero. That is not catastrophic, but loses
 	# the ability to distinguish between multiple cases that would all fill in empty pixels.
-	# So we cap the ratio to a large number.
-	with utils.nowarn():
-		ratio = bhits/split_hits
-		ratio[np.isnan(ratio)] = 0
-		ratio = np.minimum(ratio, 1000)
-	return np.sum(ratio[:,mask],-1)
+	# So we cap the ratio to a large number. Pixels the block doesn't hit contribute
+	# nothing, so we only need to visit the block's own masked pixels.
+	score = np.zeros(len(split_hits))
+	for ai in range(narray):
+		msel = hit_msel[bi][ai]
+		pix  = hit_pix[bi][ai][msel]
+		if len(pix) == 0: continue
+		with utils.nowarn():
+			ratio = hit_val[bi][ai][msel]/split_hits[:,ai,pix]
+			ratio[np.isnan(ratio)] = 0
+			ratio = np.minimum(ratio, 1000)
+		score += np.sum(ratio,-1)
+	return score
+
+def add_block(split_hits, si, bi):
+	for ai in range(narray):
+		split_hits[si,ai,hit_pix[bi][ai]] += hit_val[bi][ai]
+
+def remove_block(split_hits, si, bi):
+	for ai in range(narray):
+		pix = hit_pix[bi][ai]
+		split_hits[si,ai,pix] = np.maximum(0, split_hits[si,ai,pix] - hit_val[bi][ai])
 
 # Perform the split. Can't use the traditional greedy
 # bucket algorithm where one always allocates to the
@@ -235,25 +274,27 @@ def calc_delta_score(split_hits, bhits, mask):
 # be prioritized, while increasing already high areas counts less.
 #target = np.sum(hits,0)/nsplit
 split_hits   = enmap.zeros((nsplit,narray)+shape, wcs)
-split_blocks = [[] for i in range(nsplit)]
+split_flat   = split_hits.reshape(nsplit,narray,-1)
+split_blocks = [set() for i in range(nsplit)]
 split_fixed  = [np.where(block_ownership==i)[0] for i in range(nsplit)]
+block_split  = np.full(nblock,-1,int)
 ndig_free  = calc_ndig(nfree)
 ndig_fixed = calc_ndig(nfixed)
 if nfixed > 0:
 	sys.stderr.write("allocating fixed block %*d/%d" % (ndig_fixed,0,nfixed))
 	for i, bi in enumerate(fixed_blocks):
-		split_hits[block_ownership[bi]] += hits[bi]
+		add_block(split_flat, block_ownership[bi], bi)
 		sys.stderr.write("%s%*d/%d" % ("\b"*(1+2*ndig_fixed),ndig_fixed,i+1,nfixed))
 	sys.stderr.write("\n")
 	sys.stderr.write("allocating free block %*d/%d" % (ndig_free,0,nfree))
 else:
 	sys.stderr.write("allocating block %*d/%d" % (ndig_free,0,nfree))
 for i, bi in enumerate(free_blocks):
-	bhits = hits[bi]
-	score = calc_delta_score(split_hits, bhits, mask)
+	score = calc_delta_score(split_flat, bi)
 	best  = np.argmax(score)
-	split_hits[best] += bhits
-	split_blocks[best].append(bi)
+	add_block(split_flat, best, bi)
+	split_blocks[best].add(bi)
+	block_split[bi] = best
 	sys.stderr.write("%s%*d/%d" % ("\b"*(1+2*ndig_free),ndig_free,i+1,nfree))
 sys.stderr.write("\n")
 
@@ -266,28 +307,23 @@ elif args.opt_mode == "random":
 sys.stderr.write("optimizing %*d/%d [%*d]" % (odig, 0, nopt, odig, 0))
 for oi, i in enumerate(opt_order):
 	bi    = free_blocks[i]
-	bhits = hits[bi]
-	# Which split is this block currently in? This could be sped up with a set, but
-	# will probably be fast enough anyway
-	for scur in range(nsplit):
-		if bi in split_blocks[scur]:
-			break
-	else: raise AssertionError("block not in any splits!")
-	# Simulate removing and readding
-	# Find the score decrease from removing it from this split
-	split_hits[scur] = np.maximum(0, split_hits[scur] - bhits)
+	scur  = block_split[bi]
+	if scur < 0: raise AssertionError("block not in any splits!")
+	# Simulate removing and readding. Only the pixels this block touches change
+	remove_block(split_flat, scur, bi)
 	split_blocks[scur].remove(bi)
-	score = calc_delta_score(split_hits, bhits, mask)
+	score = calc_delta_score(split_flat, bi)
 	best  = np.argmax(score)
-	split_hits[best] += bhits
-	split_blocks[best].append(bi)
+	add_block(split_flat, best, bi)
+	split_blocks[best].add(bi)
+	block_split[bi] = best
 	if scur != best: nswap += 1
 	sys.stderr.write("%s%*d/%d [%*d]" % ("\b"*(3*odig+4),odig,oi+1,nopt,odig,nswap))
 sys.stderr.write("\n")
 
 # Merge the fixed and free groups
 split_blocks = [np.concatenate([
-		np.array(split_blocks[i],int),
+		np.array(sorted(split_blocks[i]),int),
 		np.array(split_fixed[i], int),
 	]) for i in range(nsplit)]
 
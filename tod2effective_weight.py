@@ -4,6 +4,7 @@ from enlib import log, bench, dmap, coordinates, scan as enscan, rangelist, scan
 from enlib import pointsrcs, bunch
 from enlib.cg import CG
 from enact import actscan, nmat_measure, filedb, todinfo
+import pixblocks
 
 config.default("map_bits", 32, "Bit-depth to use for maps and TOD")
 config.default("downsample", 1, "Factor with which to downsample the TOD")
@@ -32,9 +33,31 @@ L = log.init(level=log_level, rank=comm.rank)
 # Set up our output map.
 osig = enmap.zeros((1,)+area.shape[-2:], area.wcs, dtype)
 odiv = osig*0
-sig_all = np.zeros(len(ids))
-sig_med = sig_all*0
-div_all, div_med = sig_all*0, sig_med*0
+mystats = []
+
+def spectral_var(ft, n):
+	"""Compute the variance of each row of the real tod[:,n] from its
+	unnormalized real fourier transform ft[:,n//2+1] using Parseval's theorem"""
+	w = np.full(ft.shape[-1], 2.0)
+	w[0] = 1
+	if n % 2 == 0: w[-1] = 1
+	return np.sum(w*np.abs(ft)**2,-1)/n**2 - (ft[:,0].real/n)**2
+
+def project_weights(pmap, d, sig_w, div_w, window, osig, odiv, bsize=32):
+	"""Accumulate the per-detector weights sig_w[ndet] into osig and the per-sample
+	weights div_w[ndet]*window[nsamp] into odiv in a single pass over the pointing,
+	skipping cut samples. Returns the per-detector sum of the uncut div weights."""
+	sflat  = osig.reshape(-1)
+	dflat  = odiv.reshape(-1)
+	dsum   = np.zeros(d.ndet)
+	for d1, d2, upix, inv, ok, ph in pixblocks.pixel_blocks(pmap, d, osig.shape, osig.wcs, bsize):
+		uncut= ~d.cut[d1:d2].to_mask()
+		resp = ph[:,0]
+		dw   = div_w[d1:d2,None]*window
+		sflat[upix] += np.bincount(inv, resp*np.broadcast_to(sig_w[d1:d2,None], ok.shape)[ok], minlength=len(upix))
+		dflat[upix] += np.bincount(inv, resp*dw[ok], minlength=len(upix))
+		dsum[d1:d2]  = np.sum(dw*uncut,-1)
+	return dsum
 
 # Read in all our scans
 for ind in range(comm.rank, len(ids), comm.size):
@@ -59,44 +82,36 @@ for ind in range(comm.rank, len(ids), comm.size):
 	nmat.apply_window(tod, winsize)
 	d.noise = d.noise.update(tod, d.srate)
 	L.debug("Noise %s" % id)
-	# Apply it, to get N"d
-	d.noise.apply(tod)
-	nmat.apply_window(tod, winsize)
-	# Compute the variance per detector. If our noise model
-	# were correct and our data were pure noise, this would be
-	# N"<nn'>N" = N". But our noise model isn't totally accurate.
-	vars = np.var(tod,1)
-	# Project each detectors result on the sky
-	tod[:] = vars[:,None]
+	# Apply it in fourier space to get N"d, and compute the variance per detector
+	# directly from that. If our noise model were correct and our data were pure
+	# noise, this would be N"<nn'>N" = N". But our noise model isn't totally accurate.
+	ft   = fft.rfft(tod)
+	del tod
+	d.noise.apply_ft(ft, d.nsamp, dtype)
+	vars = spectral_var(ft, d.nsamp)
+	del ft
+	# Project each detector's result and the fiducial white noise model on the sky
+	# together. The white noise weight of each sample is ivar times the squared window.
+	window = np.ones((1,d.nsamp), dtype)
+	nmat.apply_window(window, winsize)
+	window = window[0]**2
 	pmap = pmat.PmatMap(d, osig)
-	pcut = pmat.PmatCut(d)
-	junk = np.zeros(pcut.njunk, dtype=dtype)
-	pcut.backward(tod, junk)
-	pmap.backward(tod, osig)
-	# Also do the fiducial noise model
-	tod[:] = 1
-	nmat.apply_window(tod, winsize)
-	d.noise.white(tod)
-	nmat.apply_window(tod, winsize)
-	pcut.backward(tod, junk)
-	pmap.backward(tod, odiv)
+	dsum = project_weights(pmap, d, vars, d.noise.ivar, window, osig, odiv)
 	# Collect some statistics
-	sig_all[ind] = np.sum(vars)*d.nsamp
-	sig_med[ind] = np.median(vars)*d.ndet*d.nsamp
-	div_all[ind] = np.sum(tod)
-	div_med[ind] = np.median(np.sum(tod,1))*d.ndet
+	mystats.append([ind, np.sum(vars)*d.nsamp, np.median(vars)*d.ndet*d.nsamp, np.sum(dsum), np.median(dsum)*d.ndet])
+	del d, pmap
 
 # Collect result
 osig[:] = utils.allreduce(osig, comm)
 odiv[:] = utils.allreduce(odiv, comm)
-sig_all = utils.allreduce(sig_all, comm)
-sig_med = utils.allreduce(sig_med, comm)
-div_all = utils.allreduce(div_all, comm)
-div_med = utils.allreduce(div_med, comm)
+stats   = utils.allgatherv(np.array(mystats).reshape(-1,5), comm)
 
 if comm.rank == 0:
 	enmap.write_map(root + "sig.fits", osig[0])
 	enmap.write_map(root + "div.fits", odiv[0])
+	# Tods we didn't process get zero stats, as before
+	ostats = np.zeros((len(ids),4))
+	ostats[stats[:,0].astype(int)] = stats[:,1:]
 	with open(root + "stats.txt", "w") as f:
-		for ind, id in enumerate(ids):
-			f.write("%s %15.7e %15.7e %15.7e %15.7e\n" % (id, sig_all[ind], sig_med[ind], div_all[ind], div_med[ind]))
+		for id, row in zip(ids, ostats):
+			f.write("%s %15.7e %15.7e %15.7e %15.7e\n" % ((id,)+tuple(row)))
@@ -1,6 +1,7 @@
 import numpy as np, sys, os
 from enlib import enmap, config, log, pmat, mpi, utils, scan as enscan, errors
 from enact import actscan, filedb, todinfo
+import pixblocks
 
 config.default("downsample", 1, "Factor with which to downsample the TOD")
 config.default("verbosity",  1, "Verbosity for output. Higher means more verbose. 0 outputs only errors etc. 1 outputs INFO-level and 2 outputs DEBUG-level messages.")
@@ -10,6 +11,7 @@ parser.add_argument("sel")
 parser.add_argument("area")
 parser.add_argument("odir")
 parser.add_argument("prefix",nargs="?")
+parser.add_argument("-b", "--bsize", type=int, default=32, help=pixblocks.bsize_help)
 args = parser.parse_args()
 
 filedb.init()
@@ -17,7 +19,7 @@ ids = filedb.scans[args.sel]
 
 comm  = mpi.COMM_WORLD
 dtype = np.float64
-area  = enmap.read_map(args.area).astype(dtype)
+shape, wcs = enmap.read_map_geometry(args.area)
 
 utils.mkdir(args.odir)
 root = args.odir + "/" + (args.prefix + "_" if args.prefix else "")
@@ -30,8 +32,18 @@ L = log.init(level=log_level, file=logfile, rank=comm.rank)
 
 L.info("Initialized")
 
-# Loop through each scan, and compute the hits
-hits = enmap.zeros((3,)+area.shape[-2:], area.wcs, dtype=dtype)
+def accumulate_hits(pmap, scan, hits, bsize=32):
+	"""Add the number of uncut samples hitting each pixel to hits[ny,nx]. The
+	pointing is evaluated for bsize detectors at a time, so unlike projecting
+	a tod of ones this never needs anything the size of the tod."""
+	flat   = hits.reshape(-1)
+	for d1, d2, upix, inv, ok, ph in pixblocks.pixel_blocks(pmap, scan, hits.shape, hits.wcs, bsize):
+		flat[upix] += np.bincount(inv, minlength=len(upix))
+
+# Loop through each scan, and compute the hits. Only the geometry of
+# the template is used.
+template = enmap.zeros((3,)+shape[-2:], wcs, dtype=dtype)
+hits     = enmap.zeros(shape[-2:], wcs, dtype=dtype)
 myinds = np.arange(comm.rank, len(ids), comm.size)
 for ind in myinds:
 	id = ids[ind]
@@ -46,13 +58,9 @@ for ind in myinds:
 	scan = scan[:,::config.get("downsample")]
 	L.debug("Processing %s" % str(id))
 
-	pmap = pmat.PmatMap(scan, hits)
-	pcut = pmat.PmatCut(scan)
-	tod  = np.full([scan.ndet, scan.nsamp], 1, dtype=dtype)
-	junk = np.zeros(pcut.njunk, dtype=dtype)
-	pcut.backward(tod, junk)
-	pmap.backward(tod, hits)
-hits = hits[0]
+	pmap = pmat.PmatMap(scan, template)
+	accumulate_hits(pmap, scan, hits, bsize=args.bsize)
+	del scan, pmap
 
 # Collect result
 L.info("Reducing")
@@ -3,6 +3,7 @@
 
 from __future__ import division, print_function
 import numpy as np, argparse, h5py, os, sys, shutil, time
+from multiprocessing.pool import ThreadPool
 from enlib import fft, utils, errors, config, mpi, colors
 from enact import filedb, actdata, filters
 parser = config.ArgumentParser(os.environ["HOME"] + "/.enkirc")
@@ -11,6 +12,7 @@ parser.add_argument("ofile")
 parser.add_argument("-b", "--bins", type=str, default="2e-2:2e-2:9999", help="Bin definitions. Comma-separated list of first,width,num. For example, 3:0.1:4 will result in the bins [[3.0:3.1],[3.1:3.2],[3.2:3.3],[3.3:3.4]].")
 parser.add_argument("-B", "--bins-status", type=str, default="1e-1:1e-1:30,3:0.5:14,10:10:19", help="Bin definitions for progress prints in terminal.")
 parser.add_argument("-s", "--seed", type=int, default=0)
+parser.add_argument("-T", "--nthread", type=int, default=1, help="Number of threads to split the detectors of each tod over")
 args = parser.parse_args()
 
 filedb.init()
@@ -38,17 +40,21 @@ def calc_bin_of_inds(bins, nf):
 		res[b[0]:b[1]] = i
 	return res
 
+def calc_bin_sums(ps, nbin, inds):
+	"""Sum ps[ndet,nfreq] into the bins given by inds[nfreq] for all detectors
+	at once. inds is piecewise constant, so a single reduceat over its runs does
+	the work over frequencies, after which the few runs are added into their bins."""
+	starts = np.concatenate([[0],np.where(inds[1:]!=inds[:-1])[0]+1])
+	runs   = np.add.reduceat(ps, starts, -1)
+	res    = np.zeros([ps.shape[0],nbin+1])
+	np.add.at(res.T, inds[starts], runs.T)
+	return res[:,:nbin]
+
 def calc_bin_moments(ps, nbin, inds):
-	res    = np.zeros([3,nbin])
-	ndet   = ps.shape[0]
-	perdet = np.zeros([nbin,ndet])
 	# Get the mean in bins per detector
 	hits   = np.maximum(1,np.bincount(inds, minlength=nbin)[:nbin])
-	for i in range(ndet):
-		perdet[:,i] = np.bincount(inds, ps[i], minlength=nbin)[:nbin]/hits
-	for i in range(3):
-		res[i] = np.sum(perdet**i,1)
-	return res
+	perdet = calc_bin_sums(ps, nbin, inds)/hits
+	return np.array([np.full(nbin, len(perdet), float), np.sum(perdet,0), np.sum(perdet**2,0)])
 
 def calc_bin_stats(ps, bin_freqs, nsamp, srate):
 	nbin  = len(bin_freqs)
@@ -56,6 +62,18 @@ def calc_bin_stats(ps, bin_freqs, nsamp, srate):
 	binds = calc_bin_of_inds(bins, ps.shape[1])
 	return calc_bin_moments(ps, nbin, binds)
 
+def calc_bin_stats_threaded(ft, bin_freqs_list, nsamp, srate):
+	"""Compute the power spectrum of ft and its bin moments for each of the
+	bin definitions in bin_freqs_list. The detectors are split into blocks that
+	are handled in parallel, and the moments, which are sums over detectors,
+	are then added up."""
+	bsize  = (len(ft)+args.nthread-1)//args.nthread
+	def handle(dsel):
+		ps = np.abs(ft[dsel])**2/(nsamp*srate)
+		return [calc_bin_stats(ps, bin_freqs, nsamp, srate) for bin_freqs in bin_freqs_list]
+	res = pool.map(handle, [slice(i,i+bsize) for i in range(0, len(ft), bsize)])
+	return [np.sum([r[i] for r in res],0) for i in range(len(bin_freqs_list))]
+
 def bin_mean_ps(ps, bin_freqs, nsamp, srate):
 	nbin  = len(bin_freqs)
 	bins  = (bin_freqs * nsamp / srate).astype(int)
@@ -78,6 +96,7 @@ def get_token(mean, dev, moff=100**2, doff=0.02):
 	dind = max(0,min(len(cols)-1,  int(lrdev - np.log2(doff))))
 	return cols[dind] + letters[lind] + colors.reset
 
+pool      = ThreadPool(args.nthread)
 bin_freqs = parse_bin_freqs(args.bins)
 bin_freqs_status = parse_bin_freqs(args.bins_status)
 nbin  = len(bin_freqs)
@@ -101,15 +120,12 @@ for ind in range(comm.rank, ntod, comm.size):
 		srate = d.srate
 		ft    = fft.rfft(d.tod)
 		del d.tod
-		ps      = np.abs(ft)**2/(nsamp*srate)
 		ps_mean = np.abs(np.mean(ft,0))**2/(nsamp*srate)
-		del ft
 		# Want mean and dev between detectors. These can
 		# be built from ps and ps**2
-		stats[:,ind] = calc_bin_stats(ps, bin_freqs, nsamp, srate)
+		stats[:,ind], (n, a, a2) = calc_bin_stats_threaded(ft, [bin_freqs, bin_freqs_status], nsamp, srate)
 		stats_mean[ind] = bin_mean_ps(ps_mean, bin_freqs, nsamp, srate)
-		n, a, a2 = calc_bin_stats(ps, bin_freqs_status, nsamp, srate)
-		del ps
+		del ft
 		amean = a/n
 		adev  = (a2/n - amean**2)**0.5
 		print(id + " " + "".join([get_token(me,de) for me,de in zip(amean,adev)]) + " %5.2f" % pwvs[ind])
@@ -5,6 +5,7 @@
 # low white noise floors.
 
 import numpy as np, argparse, h5py, os, sys, shutil
+from multiprocessing.pool import ThreadPool
 from enlib import fft, utils, enmap, errors, config, mpi, todfilter
 from enact import filedb, actdata, filters
 config.default("gfilter_jon_nhwp", 200, "The number of hwp modes to fit/subtract in Jon's polynomial ground filter.")
@@ -15,6 +16,7 @@ parser.add_argument("-f", type=str, default="10:1,100:1")
 parser.add_argument("-R", type=str, default="0.5:3")
 parser.add_argument("--max-sens", type=float, default=20, help="Reject detectors more than this times more sensitive than the median at any of the indicated frequencies. Set to 0 to disable.")
 parser.add_argument("--full-stats", action="store_true")
+parser.add_argument("--nthread", type=int, default=1, help="Number of threads to split the detectors of each tod over")
 args = parser.parse_args()
 
 comm  = mpi.COMM_WORLD
@@ -28,6 +30,29 @@ tmp  = [[float(tok) for tok in word.split(":")] for word in args.f.split(",")]
 bins = np.array([[t[0]-t[1]/2,t[0]+t[1]/2] for t in tmp])
 rate = [float(w) for w in args.R.split(":")]
 
+def calc_band_sums(ps, inds):
+	"""Sum ps[:,i1:i2] for all the bands [[i1,i2],...] in inds at once. A single
+	reduceat over the sorted band edges does the work over frequencies, after which
+	each band is the sum of a few of the resulting segments. Returns [nband,ndet]"""
+	nf    = ps.shape[-1]
+	edges = np.unique(inds[inds<nf])
+	segs  = np.add.reduceat(ps, edges, -1)
+	lo, hi= [np.searchsorted(edges, i) for i in inds.T]
+	return np.array([np.sum(segs[:,l:h],-1) for l, h in zip(lo, hi)])
+
+def calc_band_rms(ft, inds, taus, freqs, butter, norm):
+	"""Compute the raw and deconvolved rms in each of the bands [[i1,i2],...] for
+	the fourier-space tod ft, which is deconvolved in-place. Returns rms_raw, rms_dec,
+	both [ndet,nband]"""
+	width = np.maximum(1, inds[:,1]-inds[:,0])[:,None]
+	rms_raw = (calc_band_sums(np.abs(ft)**2/norm, inds)/width).T**0.5
+	for di, tau in enumerate(taus):
+		tconst = filters.tconst_filter(freqs, tau)
+		ft[di] /= tconst*butter
+	rms_dec = (calc_band_sums(np.abs(ft)**2/norm, inds)/width).T**0.5
+	return rms_raw, rms_dec
+
+pool = ThreadPool(args.nthread)
 filedb.init()
 ids = filedb.scans[args.sel]
 ntod= len(ids)
@@ -53,33 +78,24 @@ for si in range(comm.rank, ntod, comm.size):
 		#d.tod = todfilter.filter_poly_jon(d.tod, d.boresight[1], hwp=d.hwp)
 
 		ft    = fft.rfft(d.tod)
-		ps    = np.abs(ft)**2/(d.tod.shape[1]*srate)
-		inds  = bins*ps.shape[1]/fmax
-		bfreqs= np.mean(bins,1)
-
-		#tod_moo = fft.irfft(ft, normalize=True)
-		#ind = np.where(d.dets==640)[0]
-		#with h5py.File("foo.hdf", "w") as hfile:
-		#	hfile["moo"] = tod_moo[ind]
-		#	hfile["ps"] = ps[ind]
-		#	hfile["tod"] = d.tod[ind]
-
-		rms_raw = np.array([np.mean(ps[:,b[0]:b[1]],1) for b in inds]).T**0.5
-		#print rms_raw[ind]
+		nf    = ft.shape[1]
+		inds  = np.clip((bins*nf/fmax).astype(int), 0, nf)
+		norm  = d.tod.shape[1]*srate
 
-		# Compute amount of deconvolution
-		freqs  = np.linspace(0, d.srate/2, ft.shape[-1])
+		# Compute the raw and deconvolved band rms. The detectors are split
+		# into blocks that are handled in parallel
+		freqs  = np.linspace(0, d.srate/2, nf)
 		butter = filters.butterworth_filter(freqs)
-		for di, det in enumerate(d.dets):
-			tconst = filters.tconst_filter(freqs, d.tau[di])
-			ft[di] /= tconst*butter
-		ps = np.abs(ft)**2/(d.tod.shape[1]*srate)
-		rms_dec = np.array([np.mean(ps[:,b[0]:b[1]],1) for b in inds]).T**0.5
+		bsize  = utils.ceil(d.ndet/float(args.nthread))
+		dblocks= [slice(i,i+bsize) for i in range(0, d.ndet, bsize)]
+		res    = pool.map(lambda dsel: calc_band_rms(ft[dsel], inds, d.tau[dsel], freqs, butter, norm), dblocks)
+		rms_raw= np.concatenate([r[0] for r in res])
+		rms_dec= np.concatenate([r[1] for r in res])
+		del ft, res
 
 		if args.full_stats:
-			for i in range(2):
-				stats[si,d.dets,i+0] = rms_raw[:,i]
-				stats[si,d.dets,i+2] = rms_dec[:,i]
+			stats[si,d.dets,0:2] = rms_raw[:,:2]
+			stats[si,d.dets,2:4] = rms_dec[:,:2]
 		ratio = rms_dec[:,1]/rms_dec[:,0]
 		sens  = rms_dec**-2
 		med_sens = np.median(sens, 0)